@@ -19,6 +19,15 @@ module kb_ke_apps {
     dist_cutoff_rate: the threshold to apply when forming flat clusters
 
     Optional arguments:
+    row_dist_cutoff_rates: Several row cutoff rates to sweep in one run, overriding
+                           row_dist_cutoff_rate. The linkage is computed once and one
+                           ClusterSet is saved per rate (<cluster_set_name>_row_cutoff_<rate>).
+    col_dist_cutoff_rates: Same for the columns (<cluster_set_name>_column_cutoff_<rate>).
+    row_maxclust: Row cluster counts to sweep, one ClusterSet per count formed with the
+                  "maxclust" criterion (<cluster_set_name>_row_maxclust_<count>).
+                  Without cutoff rates, only the given row_dist_cutoff_rate is added.
+    col_maxclust: Same for the columns (<cluster_set_name>_column_maxclust_<count>).
+
     dist_metric: The distance metric to use. Default set to 'euclidean'.
                  The distance function can be
                  ["braycurtis", "canberra", "chebyshev", "cityblock", "correlation", "cosine", 
@@ -39,6 +48,46 @@ module kb_ke_apps {
                         ["inconsistent", "distance", "maxclust"]
                         Details refer to:
                         https://docs.scipy.org/doc/scipy/reference/generated/scipy.cluster.hierarchy.fcluster.html
+
+    precision: The floating point precision to compute in. Default set to 'float64'.
+               The precision can be ["float64", "float32"]
+               float32 halves the memory of the matrix and distance data.
+
+    invalid_data_action: What to do with all-NaN, constant and non-finite rows and columns,
+                         checked before any distance computation.
+                         Default set to 'keep' (only reported).
+                         The action can be ["keep", "drop", "fail"]
+
+    top_n_by_variance: Only cluster the top N rows with the largest variance.
+    min_variance: Only cluster rows with a variance of at least min_variance.
+    variance_measure: The row variance measure used by top_n_by_variance and min_variance.
+                      Default set to 'variance'.
+                      The measure can be ["variance", "mad", "cv"]
+                      (median absolute deviation, coefficient of variation)
+                      The kept row ids are recorded in clustering_parameters.
+
+    collapse_duplicates: Cluster identical rows (and columns) once and expand the flat
+                         clusters back to every id. Default set to 0.
+                         Only applied with the "single", "complete", "weighted" and
+                         "median" linkage and the "distance" and "maxclust" criterion,
+                         where the clusters are identical to clustering every row.
+
+    n_jobs: Number of processes computing the distance matrix. Default set to 1.
+
+    approximate: Build the linkage from an approximate k-nearest-neighbor graph
+                 (random projection trees refined by NN-descent) instead of the full
+                 distance matrix, for matrices too large for exact clustering.
+                 Default set to 0.
+                 Only the "single" and "average" linkage (default 'average') and the
+                 "euclidean", "sqeuclidean", "cosine" and "correlation" metric apply.
+                 The heatmap is not built in this mode.
+    n_neighbors: Number of nearest neighbors per row in the approximate mode.
+                 Default set to 15.
+    matrix_free: Build the linkage from cluster centroids instead of the distance
+                 matrix, for matrices whose distance matrix does not fit in memory.
+                 Default set to 0.
+                 Only the "ward", "centroid" and "median" linkage (default 'ward') and
+                 the "euclidean" metric apply. The linkage is the same as the exact one.
   */
   typedef structure {
     obj_ref matrix_ref;
@@ -46,10 +95,24 @@ module kb_ke_apps {
     string cluster_set_name;
     float row_dist_cutoff_rate;
     float col_dist_cutoff_rate;
+    list<float> row_dist_cutoff_rates;
+    list<float> col_dist_cutoff_rates;
+    list<int> row_maxclust;
+    list<int> col_maxclust;
 
     string dist_metric;
     string linkage_method;
     string fcluster_criterion;
+    string precision;
+    string invalid_data_action;
+    boolean collapse_duplicates;
+    int top_n_by_variance;
+    float min_variance;
+    string variance_measure;
+    int n_jobs;
+    boolean approximate;
+    int n_neighbors;
+    boolean matrix_free;
   } HierClusterParams;
 
   /* Ouput of the run_hierarchical_cluster function
@@ -81,6 +144,25 @@ module kb_ke_apps {
                   "yule"]
                  Details refer to:
                  https://docs.scipy.org/doc/scipy/reference/generated/scipy.spatial.distance.pdist.html
+
+    precision: The floating point precision to compute in. Default set to 'float64'.
+               The precision can be ["float64", "float32"]
+               float32 halves the memory of the matrix and distance data.
+
+    invalid_data_action: What to do with all-NaN, constant and non-finite rows and columns,
+                         checked before any distance computation.
+                         Default set to 'keep' (only reported).
+                         The action can be ["keep", "drop", "fail"]
+
+    top_n_by_variance: Only cluster the top N rows with the largest variance.
+    min_variance: Only cluster rows with a variance of at least min_variance.
+    variance_measure: The row variance measure used by top_n_by_variance and min_variance.
+                      Default set to 'variance'.
+                      The measure can be ["variance", "mad", "cv"]
+                      (median absolute deviation, coefficient of variation)
+                      The kept row ids are recorded in clustering_parameters.
+
+    n_jobs: Number of processes computing the distance matrix. Default set to 1.
   */
   typedef structure {
     obj_ref matrix_ref;
@@ -89,6 +171,12 @@ module kb_ke_apps {
     int k_num;
 
     string dist_metric;
+    string precision;
+    string invalid_data_action;
+    int top_n_by_variance;
+    float min_variance;
+    string variance_measure;
+    int n_jobs;
   } KmeansClusterParams;
 
   /* Ouput of the run_kmeans_cluster function
@@ -110,12 +198,23 @@ module kb_ke_apps {
     workspace_name: the name of the workspace
     pca_matrix_name: name of PCA (KBaseFeatureValues.FloatMatrix2D) object
     n_components - number of components (default 2)
+    precision - compute precision, "float64" (default) or "float32"
+    invalid_data_action - all-NaN, constant or non-finite rows and columns are
+                          "keep" (default, only reported), "drop" or "fail"
+    top_n_by_variance - only project the top N most variable rows
+    min_variance - only project rows with at least this variance
+    variance_measure - "variance" (default), "mad" or "cv" (coefficient of variation)
   */
   typedef structure {
     obj_ref cluster_set_ref;
     string workspace_name;
     string pca_matrix_name;
     int n_components;
+    string precision;
+    string invalid_data_action;
+    int top_n_by_variance;
+    float min_variance;
+    string variance_measure;
   } PCAParams;
 
   /* Ouput of the run_pca function
@@ -0,0 +1,324 @@
+import os
+import json
+import uuid
+import errno
+import shutil
+import hashlib
+import time
+
+import numpy as np
+import scipy.sparse as sp
+
+from kb_ke_apps.Utils.MatrixUtil import DataMatrix, SparseDataMatrix, log
+from kb_ke_apps.Utils.ChunkedUtil import ChunkedDataMatrix
+
+
+class _DiskCache:
+    """
+    _DiskCache: size-limited on-disk cache of entry directories keyed by string
+
+    Entries are written to a tmp_ directory and published with an atomic rename so
+    concurrent workers can share the cache; the least recently used entries (by directory
+    mtime, refreshed on every read) are evicted once the cache grows past max_bytes.
+    """
+
+    # cache kind shown in log messages
+    CACHE_NAME = 'disk'
+
+    DEFAULT_MAX_BYTES = 10 * 1024 ** 3
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_bytes)
+        self._mkdir_p(self.cache_dir)
+
+    def _mkdir_p(self, path):
+        """
+        _mkdir_p: make directory for given path
+        """
+        if not path:
+            return
+        try:
+            os.makedirs(path)
+        except OSError as exc:
+            if exc.errno == errno.EEXIST and os.path.isdir(path):
+                pass
+            else:
+                raise
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def _entry_size(self, entry_dir):
+        size = 0
+        for file_name in os.listdir(entry_dir):
+            size += os.path.getsize(os.path.join(entry_dir, file_name))
+        return size
+
+    def _list_entries(self):
+        """
+        _list_entries: list (last_used, size, entry_dir) for every published entry
+        """
+        entries = []
+        for entry_name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, entry_name)
+            if entry_name.startswith('tmp_') or not os.path.isdir(entry_dir):
+                continue
+            try:
+                entries.append((os.path.getmtime(entry_dir), self._entry_size(entry_dir),
+                                entry_dir))
+            except OSError:
+                # entry removed by a concurrent worker
+                continue
+        return entries
+
+    def _evict(self, keep=None):
+        """
+        _evict: remove least recently used entries until cache fits in max_bytes
+        """
+        entries = sorted(self._list_entries())
+        total_size = sum([entry[1] for entry in entries])
+
+        for last_used, size, entry_dir in entries:
+            if total_size <= self.max_bytes:
+                break
+            if entry_dir == keep:
+                continue
+            log('evicting {} cache entry {}'.format(self.CACHE_NAME,
+                                                    os.path.basename(entry_dir)))
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+
+    def _touch(self, entry_dir):
+        """
+        _touch: mark an entry as used now
+        """
+        # explicit timestamp, filesystem clock may be too coarse to order entries
+        last_used = time.time()
+        os.utime(entry_dir, (last_used, last_used))
+
+    def _too_large(self, key, size):
+        if size > self.max_bytes:
+            log('{} {} ({} bytes) exceeds cache size, skip caching'.format(self.CACHE_NAME,
+                                                                          key, size))
+            return True
+        return False
+
+    def _new_entry(self):
+        """
+        _new_entry: create an unpublished entry directory
+        """
+        tmp_dir = os.path.join(self.cache_dir, 'tmp_' + str(uuid.uuid4()))
+        self._mkdir_p(tmp_dir)
+        return tmp_dir
+
+    def _publish(self, key, tmp_dir):
+        """
+        _publish: atomically publish an entry directory written by _new_entry under key
+        """
+        entry_dir = self._entry_dir(key)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # another worker already published this entry
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self._evict(keep=entry_dir)
+
+
+class MatrixCache(_DiskCache):
+    """
+    MatrixCache: on-disk cache of fetched matrices keyed by versioned object reference
+
+    Each entry is a directory holding values.npy (or data.npy, indices.npy and indptr.npy
+    for sparse matrices), opened as read-only memory maps, and labels.json.
+    """
+
+    CACHE_NAME = 'matrix'
+
+    VALUES_FILE = 'values.npy'
+    LABELS_FILE = 'labels.json'
+    CSR_FILES = ['data', 'indices', 'indptr']
+
+    def get(self, key):
+        """
+        get: return cached DataMatrix (values memory mapped read-only) or None on miss
+        """
+        entry_dir = self._entry_dir(key)
+
+        try:
+            with open(os.path.join(entry_dir, self.LABELS_FILE), 'r') as labels_file:
+                labels = json.load(labels_file)
+            if labels.get('format') == 'csr':
+                values = sp.csr_matrix(tuple([np.load(os.path.join(entry_dir, name + '.npy'),
+                                                      mmap_mode='r')
+                                              for name in self.CSR_FILES]),
+                                       shape=(len(labels['row_ids']), len(labels['col_ids'])))
+            else:
+                values = np.load(os.path.join(entry_dir, self.VALUES_FILE), mmap_mode='r')
+            self._touch(entry_dir)
+        except (IOError, OSError, ValueError):
+            log('matrix cache miss for {}'.format(key))
+            return None
+
+        log('matrix cache hit for {}'.format(key))
+        if labels.get('format') == 'csr':
+            return SparseDataMatrix(values, labels['row_ids'], labels['col_ids'])
+        return DataMatrix(values, labels['row_ids'], labels['col_ids'])
+
+    def put(self, key, matrix):
+        """
+        put: store DataMatrix under key and return the cached (memory mapped) copy
+        """
+        is_sparse = isinstance(matrix, SparseDataMatrix)
+        if is_sparse:
+            matrix_size = sum([getattr(matrix.values, name).nbytes for name in self.CSR_FILES])
+        else:
+            matrix_size = matrix.values.nbytes
+
+        if self._too_large(key, matrix_size):
+            return matrix
+
+        tmp_dir = self._new_entry()
+
+        if is_sparse:
+            for name in self.CSR_FILES:
+                np.save(os.path.join(tmp_dir, name + '.npy'), getattr(matrix.values, name))
+        else:
+            np.save(os.path.join(tmp_dir, self.VALUES_FILE), np.ascontiguousarray(matrix.values))
+        with open(os.path.join(tmp_dir, self.LABELS_FILE), 'w') as labels_file:
+            json.dump({'key': key,
+                       'format': 'csr' if is_sparse else 'dense',
+                       'row_ids': matrix.row_ids.tolist(),
+                       'col_ids': matrix.col_ids.tolist()}, labels_file)
+
+        self._publish(key, tmp_dir)
+
+        return self.get(key) or matrix
+
+
+def matrix_digest(matrix):
+    """
+    matrix_digest: sha1 of matrix content (format, dtype, row and column ids and values)
+
+    Values are hashed as laid out in the matrix format (row blocks of chunked matrices,
+    CSR arrays of sparse matrices), so the digest of a transposed matrix differs.
+    """
+    digest = hashlib.sha1()
+
+    if isinstance(matrix, ChunkedDataMatrix):
+        matrix_format, dtype = 'chunked', matrix.dtype
+    else:
+        matrix_format = 'csr' if isinstance(matrix, SparseDataMatrix) else 'dense'
+        dtype = matrix.values.dtype
+
+    digest.update(json.dumps([matrix_format, str(dtype), matrix.row_ids.tolist(),
+                              matrix.col_ids.tolist()]).encode('utf-8'))
+
+    if isinstance(matrix, ChunkedDataMatrix):
+        for start, end, values in matrix.iter_row_blocks():
+            digest.update(np.ascontiguousarray(values).tobytes())
+    elif isinstance(matrix, SparseDataMatrix):
+        for name in MatrixCache.CSR_FILES:
+            digest.update(np.ascontiguousarray(getattr(matrix.values, name)).tobytes())
+    else:
+        digest.update(np.ascontiguousarray(matrix.values).tobytes())
+
+    return digest.hexdigest()
+
+
+def artifact_key(kind, digest, **params):
+    """
+    artifact_key: cache key of an artifact derived from the matrix with content digest
+    """
+    return json.dumps([kind, digest, params], sort_keys=True)
+
+
+class ArtifactCache(_DiskCache):
+    """
+    ArtifactCache: on-disk cache of arrays derived from matrices (condensed distances,
+                   linkage matrices, PCA results), shared across runs
+
+    Keys are content addressed (see artifact_key): a digest of the matrix plus the
+    parameters the artifact depends on. Each entry holds artifact.npy, opened as a
+    read-only memory map, and meta.json. hits and misses count lookups since the cache
+    was opened.
+    """
+
+    CACHE_NAME = 'artifact'
+
+    ARTIFACT_FILE = 'artifact.npy'
+    META_FILE = 'meta.json'
+
+    def __init__(self, cache_dir, max_bytes=_DiskCache.DEFAULT_MAX_BYTES):
+        super(ArtifactCache, self).__init__(cache_dir, max_bytes=max_bytes)
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self, key):
+        """
+        _load: (artifact, meta) of a published entry or None
+        """
+        entry_dir = self._entry_dir(key)
+
+        try:
+            with open(os.path.join(entry_dir, self.META_FILE), 'r') as meta_file:
+                meta = json.load(meta_file)
+            artifact = np.load(os.path.join(entry_dir, self.ARTIFACT_FILE), mmap_mode='r')
+            self._touch(entry_dir)
+        except (IOError, OSError, ValueError):
+            return None
+
+        return artifact, meta['meta']
+
+    def get(self, key):
+        """
+        get: return cached (artifact, meta) (artifact memory mapped read-only) or None on miss
+        """
+        cached = self._load(key)
+        if cached is None:
+            self.misses += 1
+            log('artifact cache miss for {}'.format(key))
+        else:
+            self.hits += 1
+            log('artifact cache hit for {}'.format(key))
+
+        return cached
+
+    def _publish_artifact(self, key, tmp_dir, meta):
+        with open(os.path.join(tmp_dir, self.META_FILE), 'w') as meta_file:
+            json.dump({'key': key, 'meta': meta}, meta_file)
+
+        self._publish(key, tmp_dir)
+
+    def put(self, key, artifact, meta=None):
+        """
+        put: store artifact (ndarray) and its json-serializable meta under key and return
+             the cached (artifact, meta), or (artifact, meta) unchanged if it is too large
+        """
+        artifact = np.asarray(artifact)
+        if self._too_large(key, artifact.nbytes):
+            return artifact, meta
+
+        tmp_dir = self._new_entry()
+        np.save(os.path.join(tmp_dir, self.ARTIFACT_FILE), np.ascontiguousarray(artifact))
+        self._publish_artifact(key, tmp_dir, meta)
+
+        return self._load(key) or (artifact, meta)
+
+    def put_file(self, key, file_path, meta=None):
+        """
+        put_file: move an .npy file (e.g. a memory mapped distance matrix written in scratch)
+                  into the cache without copying it
+
+        return the cached (artifact, meta), or None if the file was left in place because it
+        is too large
+        """
+        if self._too_large(key, os.path.getsize(file_path)):
+            return None
+
+        tmp_dir = self._new_entry()
+        shutil.move(file_path, os.path.join(tmp_dir, self.ARTIFACT_FILE))
+        self._publish_artifact(key, tmp_dir, meta)
+
+        return self._load(key)
@@ -0,0 +1,458 @@
+import os
+import re
+import json
+import uuid
+import errno
+import shutil
+
+import numpy as np
+from numpy.lib.format import open_memmap
+from scipy.spatial.distance import cdist
+
+from kb_ke_apps.Utils.MatrixUtil import (DataMatrix, DataMatrixParser, condensed_start,
+                                          fix_component_signs, log)
+from kb_ke_apps.Utils.NanUtil import nan_pca_blocks
+
+
+# target size of a single column block / row block read from the store
+BLOCK_BYTES = 64 * 1024 ** 2
+
+
+def _mkdir_p(path):
+    """
+    _mkdir_p: make directory for given path
+    """
+    if not path:
+        return
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno == errno.EEXIST and os.path.isdir(path):
+            pass
+        else:
+            raise
+
+
+class ChunkedMatrixWriter:
+    """
+    ChunkedMatrixWriter: write matrix rows incrementally into a column-blocked store
+
+    The store is a directory of block_<k>.npy files, each holding every row for a range of
+    columns, plus meta.json which is written last and marks the store as complete.
+    """
+
+    META_FILE = 'meta.json'
+
+    def __init__(self, store_dir, row_ids, col_ids, dtype=np.float64, block_bytes=BLOCK_BYTES):
+        self.store_dir = store_dir
+        self.row_ids = list(row_ids)
+        self.col_ids = list(col_ids)
+        self.dtype = np.dtype(dtype)
+
+        n_rows, n_cols = len(self.row_ids), len(self.col_ids)
+        block_cols = max(1, min(n_cols, block_bytes // (self.dtype.itemsize * max(n_rows, 1))))
+        self.col_bounds = list(range(0, n_cols, block_cols)) + [n_cols]
+
+        _mkdir_p(self.store_dir)
+        self.blocks = []
+        for block_pos, (start, end) in enumerate(zip(self.col_bounds[:-1],
+                                                     self.col_bounds[1:])):
+            block_path = os.path.join(self.store_dir, 'block_{}.npy'.format(block_pos))
+            self.blocks.append(open_memmap(block_path, mode='w+', dtype=self.dtype,
+                                           shape=(n_rows, end - start)))
+        self.n_written = 0
+
+    def write_rows(self, rows):
+        """
+        write_rows: append rows (list of value lists, None as NaN, or 2D array)
+        """
+        rows = np.array(rows, dtype=float).reshape(-1, len(self.col_ids))
+        end_row = self.n_written + rows.shape[0]
+        if end_row > len(self.row_ids):
+            raise ValueError('Writing {} rows into matrix store of {} rows'.format(
+                                                                end_row, len(self.row_ids)))
+
+        for block, start, end in zip(self.blocks, self.col_bounds[:-1], self.col_bounds[1:]):
+            block[self.n_written:end_row] = rows[:, start:end]
+        self.n_written = end_row
+
+    def close(self):
+        """
+        close: flush blocks, publish meta.json and return the stored ChunkedDataMatrix
+        """
+        if self.n_written != len(self.row_ids):
+            raise ValueError('Matrix store got {} of {} rows'.format(self.n_written,
+                                                                     len(self.row_ids)))
+        for block in self.blocks:
+            block.flush()
+        self.blocks = []
+
+        meta = {'row_ids': self.row_ids,
+                'col_ids': self.col_ids,
+                'dtype': self.dtype.name,
+                'col_bounds': self.col_bounds}
+        tmp_meta_path = os.path.join(self.store_dir, 'tmp_' + self.META_FILE)
+        with open(tmp_meta_path, 'w') as meta_file:
+            json.dump(meta, meta_file)
+        os.rename(tmp_meta_path, os.path.join(self.store_dir, self.META_FILE))
+
+        return ChunkedDataMatrix(self.store_dir)
+
+
+class MatrixRowsParser(DataMatrixParser):
+    """
+    MatrixRowsParser: incremental parser for the value rows of a workspace get_objects2
+                      response
+
+    The response is read in chunks; only the path down to the matrix values
+    (result[0].data[0].data.data.values) is followed, other members are skipped, and the
+    rows are handed out in batches so a matrix larger than memory can be written straight
+    into a ChunkedMatrixWriter.
+    """
+
+    PAYLOAD_NAME = 'workspace response'
+
+    VALUES_PATH = ['result', 0, 'data', 0, 'data', 'data', 'values']
+
+    _KEY_RE = re.compile(r'\s*' + DataMatrixParser._STRING + r'\s*:')
+    _ROW_RE = re.compile(r'\s*\[([^\[\]]*)\]\s*([,\]])')
+
+    def _skip_value(self):
+        """
+        _skip_value: skip the json value at the current position (a member off the path)
+        """
+        decoder = json.JSONDecoder()
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos].isspace():
+                self._pos += 1
+            try:
+                end = decoder.raw_decode(self._buf, self._pos)[1]
+                # a number at the end of the buffer may continue in the next chunk
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return
+            except ValueError:
+                if self._eof:
+                    self._error('invalid value')
+            # incomplete value, read more
+            self._fill()
+
+    def _descend(self, step):
+        """
+        _descend: move into list item 0 or into the member named step of an object
+        """
+        if isinstance(step, int):
+            if not self._expect('['):
+                self._error('expected "["')
+            return
+
+        if not self._expect('{'):
+            self._error('expected "{"')
+        while True:
+            match = self._match(self._KEY_RE)
+            if not match:
+                self._error('expected "{}"'.format(step))
+            self._pos = match.end()
+            if self._decode_key(match.group(1)) == step:
+                return
+            self._skip_value()
+            if self._expect(',') is None:
+                self._error('expected "{}"'.format(step))
+
+    def iter_rows(self, batch_rows):
+        """
+        iter_rows: yield lists of at most batch_rows value rows (null as None), in order
+        """
+        for step in self.VALUES_PATH:
+            self._descend(step)
+
+        if not self._expect('['):
+            self._error('expected "["')
+        if self._expect(']'):
+            return
+
+        rows = []
+        while True:
+            match = self._match(self._ROW_RE)
+            if not match:
+                self._error('expected a row of values')
+            self._pos = match.end()
+            rows.append(match.group(1))
+
+            if len(rows) == batch_rows or match.group(2) == ']':
+                yield json.loads('[[' + '],['.join(rows) + ']]')
+                rows = []
+            if match.group(2) == ']':
+                return
+
+
+def write_matrix_rows(stream, store_dir, row_ids, col_ids, batch_rows):
+    """
+    write_matrix_rows: write the value rows of a streamed workspace get_objects2 response
+                       into a chunked matrix store
+
+    stream: file-like object (e.g. an HTTP response body) read a chunk at a time
+    batch_rows: rows parsed and written at a time
+
+    return the stored ChunkedDataMatrix
+    """
+    writer = ChunkedMatrixWriter(store_dir, row_ids, col_ids)
+
+    for rows in MatrixRowsParser(stream).iter_rows(batch_rows):
+        log('writing matrix rows {} to {} of {}'.format(writer.n_written,
+                                                        writer.n_written + len(rows),
+                                                        len(row_ids)))
+        writer.write_rows(rows)
+
+    return writer.close()
+
+
+class ChunkedDataMatrix:
+    """
+    ChunkedDataMatrix: matrix kept in a column-blocked on-disk store
+
+    Same labels interface as DataMatrix, but values are only read block by block through
+    iter_row_blocks / iter_col_blocks / read, so the full array never has to fit in memory.
+    The transpose is a view of the same store.
+    """
+
+    def __init__(self, store_dir, transposed=False, meta=None, row_index=None,
+                 col_index=None):
+        self.store_dir = store_dir
+        self.transposed = transposed
+
+        if meta is None:
+            with open(os.path.join(store_dir, ChunkedMatrixWriter.META_FILE), 'r') as meta_file:
+                meta = json.load(meta_file)
+        self._meta = meta
+        self._col_bounds = np.array(meta['col_bounds'])
+        self._blocks = [np.load(os.path.join(store_dir, 'block_{}.npy'.format(block_pos)),
+                                mmap_mode='r')
+                        for block_pos in range(len(self._col_bounds) - 1)]
+        self.dtype = np.dtype(meta['dtype'])
+
+        row_ids, col_ids = meta['row_ids'], meta['col_ids']
+        if transposed:
+            row_ids, col_ids = col_ids, row_ids
+        self.row_ids = np.asarray(row_ids, dtype=object)
+        self.col_ids = np.asarray(col_ids, dtype=object)
+
+        if row_index is None:
+            row_index = {row_id: pos for pos, row_id in enumerate(self.row_ids)}
+        if col_index is None:
+            col_index = {col_id: pos for pos, col_id in enumerate(self.col_ids)}
+
+        self.row_index = row_index
+        self.col_index = col_index
+
+    @classmethod
+    def open(cls, store_dir):
+        """
+        open: open a complete store, None if the store does not exist or is incomplete
+        """
+        if not os.path.isfile(os.path.join(store_dir, ChunkedMatrixWriter.META_FILE)):
+            return None
+        return cls(store_dir)
+
+    @property
+    def shape(self):
+        return (self.row_ids.size, self.col_ids.size)
+
+    @property
+    def T(self):
+        """
+        T: transposed matrix reading the same store (no copy)
+        """
+        return ChunkedDataMatrix(self.store_dir, transposed=not self.transposed,
+                                 meta=self._meta, row_index=self.col_index,
+                                 col_index=self.row_index)
+
+    def _read_stored(self, row_pos, col_pos):
+        """
+        _read_stored: dense (row_pos x col_pos) array in stored orientation
+        """
+        row_pos = np.asarray(row_pos, dtype=np.int64)
+        col_pos = np.asarray(col_pos, dtype=np.int64)
+        values = np.empty((row_pos.size, col_pos.size), dtype=self.dtype)
+
+        block_of_col = np.searchsorted(self._col_bounds, col_pos, side='right') - 1
+        for block_pos in np.unique(block_of_col):
+            selected = np.flatnonzero(block_of_col == block_pos)
+            local_cols = col_pos[selected] - self._col_bounds[block_pos]
+            values[:, selected] = self._blocks[block_pos][np.ix_(row_pos, local_cols)]
+
+        return values
+
+    def read(self, row_pos=None, col_pos=None):
+        """
+        read: dense array of the given row and column positions (None reads the whole axis)
+        """
+        if row_pos is None:
+            row_pos = np.arange(self.shape[0])
+        if col_pos is None:
+            col_pos = np.arange(self.shape[1])
+
+        if self.transposed:
+            return self._read_stored(col_pos, row_pos).T
+        return self._read_stored(row_pos, col_pos)
+
+    def _row_bounds(self, block_rows=None):
+        if self.transposed:
+            # rows of the transpose are stored columns, read them one stored block at a time
+            return list(zip(self._col_bounds[:-1], self._col_bounds[1:]))
+
+        if block_rows is None:
+            block_rows = max(1, BLOCK_BYTES // (self.dtype.itemsize * max(self.shape[1], 1)))
+        n_rows = self.shape[0]
+        return [(start, min(start + block_rows, n_rows))
+                for start in range(0, n_rows, block_rows)]
+
+    def iter_row_blocks(self, block_rows=None):
+        """
+        iter_row_blocks: yield (start, end, dense rows[start:end]) blocks
+        """
+        for start, end in self._row_bounds(block_rows=block_rows):
+            yield start, end, self.read(row_pos=np.arange(start, end))
+
+    def iter_col_blocks(self, block_cols=None):
+        """
+        iter_col_blocks: yield (start, end, dense columns[:, start:end]) blocks
+        """
+        for start, end, values in self.T.iter_row_blocks(block_rows=block_cols):
+            yield start, end, values.T
+
+    def _new_store_dir(self):
+        return os.path.join(os.path.dirname(os.path.abspath(self.store_dir)),
+                            str(uuid.uuid4()))
+
+    def take(self, row_pos=None, col_pos=None):
+        """
+        take: sub-matrix of the given row and column positions, written to a new store
+        """
+        if row_pos is None and col_pos is None:
+            return self
+
+        row_pos = np.arange(self.shape[0]) if row_pos is None else np.asarray(row_pos)
+        col_pos = np.arange(self.shape[1]) if col_pos is None else np.asarray(col_pos)
+
+        writer = ChunkedMatrixWriter(self._new_store_dir(), self.row_ids[row_pos],
+                                     self.col_ids[col_pos], dtype=self.dtype)
+        block_rows = max(1, BLOCK_BYTES // (self.dtype.itemsize * max(self.shape[1], 1)))
+        for start in range(0, row_pos.size, block_rows):
+            writer.write_rows(self.read(row_pos=row_pos[start:start + block_rows],
+                                        col_pos=col_pos))
+
+        return writer.close()
+
+    def astype(self, dtype):
+        """
+        astype: matrix with values cast to dtype, written to a new store
+        """
+        if np.dtype(dtype) == self.dtype:
+            return self
+
+        writer = ChunkedMatrixWriter(self._new_store_dir(), self.row_ids, self.col_ids,
+                                     dtype=dtype)
+        for start, end, values in self.iter_row_blocks():
+            writer.write_rows(values)
+
+        return writer.close()
+
+    def remove(self):
+        """
+        remove: delete the store from disk
+        """
+        self._blocks = []
+        shutil.rmtree(self.store_dir, ignore_errors=True)
+
+    def to_dense(self):
+        """
+        to_dense: load the whole matrix into DataMatrix
+        """
+        return DataMatrix(self.read(), self.row_ids, self.col_ids,
+                          row_index=self.row_index, col_index=self.col_index)
+
+    def to_dataframe(self):
+        """
+        to_dataframe: load the whole matrix as pandas dataframe
+        """
+        return self.to_dense().to_dataframe()
+
+    def to_json(self):
+        """
+        to_json: serialize matrix as data_matrix json (as returned by GenericsAPI.fetch_data)
+        """
+        return self.to_dataframe().to_json()
+
+
+def chunked_pdist(matrix, metric='euclidean', block_rows=None, pair_dist=None, out=None,
+                  rows=None):
+    """
+    chunked_pdist: condensed pairwise row distances computed one pair of row blocks at a time
+
+    pair_dist: function (block_a, block_b) -> dense distance tile, scipy cdist by default
+    out: condensed output buffer (e.g. memory mapped), allocated if not given
+    rows: (first, last) only fill the pairs of the row blocks starting in first:last
+
+    Only two row blocks are held in memory next to the condensed output.
+    """
+    if pair_dist is None:
+        def pair_dist(block_a, block_b):
+            return cdist(block_a, block_b, metric=metric)
+
+    n = matrix.shape[0]
+    row_bounds = matrix._row_bounds(block_rows=block_rows)
+    dist_matrix = np.empty(n * (n - 1) // 2, dtype=np.float64) if out is None else out
+
+    first, last = rows or (0, n)
+    for block_pos, (start, end) in enumerate(row_bounds):
+        if not first <= start < last:
+            continue
+        block = matrix.read(row_pos=np.arange(start, end))
+
+        # pairs within the block
+        block_dist = pair_dist(block, block)
+        for i in range(start, end - 1):
+            offset = condensed_start(i, n)
+            dist_matrix[offset:offset + end - i - 1] = block_dist[i - start, i - start + 1:]
+
+        # pairs against every later block
+        for other_start, other_end in row_bounds[block_pos + 1:]:
+            other_dist = pair_dist(block, matrix.read(row_pos=np.arange(other_start,
+                                                                        other_end)))
+            for i in range(start, end):
+                offset = condensed_start(i, n) + other_start - i - 1
+                dist_matrix[offset:offset + other_end - other_start] = other_dist[i - start]
+
+    return dist_matrix
+
+
+def chunked_pca(matrix, n_components=2):
+    """
+    chunked_pca: principal component scores of a chunked matrix
+
+    Accumulates the covariance of the smaller dimension block by block. Tall matrices run
+    nan_pca over row blocks, so missing values are handled as for a dense matrix
+    (pairwise-complete covariance). Wide ones use the row Gram matrix of the centered
+    column blocks, which has no pairwise-complete form: missing values are rejected.
+    Returns (rows x n_components) scores.
+    """
+    n_rows, n_cols = matrix.shape
+
+    if n_cols <= n_rows:
+        return nan_pca_blocks(matrix.iter_row_blocks, n_rows, n_cols,
+                              n_components=n_components)
+
+    gram = np.zeros((n_rows, n_rows))
+    for start, end, values in matrix.iter_col_blocks():
+        values = values.astype(np.float64)
+        if np.isnan(values).any():
+            raise ValueError('PCA of a chunked matrix with more columns ({}) than rows ({}) '
+                             'does not support missing values'.format(n_cols, n_rows))
+        values -= values.mean(axis=0)
+        gram += values.dot(values.T)
+    eigvals, eigvecs = np.linalg.eigh(gram)
+    order = np.argsort(eigvals)[::-1][:n_components]
+    scores = eigvecs[:, order] * np.sqrt(np.maximum(eigvals[order], 0))
+
+    return fix_component_signs(scores)
@@ -0,0 +1,711 @@
+import time
+import mmap
+import multiprocessing
+
+import numpy as np
+from scipy.spatial.distance import cdist
+from scipy.cluster.vq import vq
+
+from kb_ke_apps.Utils.MatrixUtil import DataMatrix, SparseDataMatrix, condensed_start, log
+from kb_ke_apps.Utils.SparseUtil import SPARSE_METRIC, sparse_pdist
+from kb_ke_apps.Utils.ChunkedUtil import ChunkedDataMatrix, chunked_pdist
+from kb_ke_apps.Utils.NanUtil import NAN_METRIC, has_nan, nan_pdist
+
+
+DISTANCE_ENGINE = ["local", "remote", "distributed"]
+
+# metrics computed from row statistics and one matrix product (Gram matrix)
+BLAS_METRIC = ["euclidean", "sqeuclidean", "cosine", "correlation"]
+
+# metrics computed from the contingency counts of bit-packed boolean rows
+BOOLEAN_METRIC = ["dice", "hamming", "jaccard", "kulsinski", "matching", "rogerstanimoto",
+                  "russellrao", "sokalmichener", "sokalsneath", "yule"]
+# boolean metrics recent scipy no longer provides, computed on the non-zero pattern of
+# any matrix (as older scipy pdist did); other boolean metrics only for 0/1 matrices
+BOOLEAN_ONLY_METRIC = ["kulsinski", "sokalmichener"]
+
+# float64 tiles (and temporaries of the same size) held per block while filling the output
+TILE_COPIES = 8
+
+DEFAULT_MEMORY_BYTES = 1024 ** 3
+
+# row ranges per worker process, smaller ranges balance uneven tile run times
+TILES_PER_JOB = 4
+
+# task run by parallel_fill workers, inherited through fork instead of pickled
+_PARALLEL_TASK = None
+
+# first, scale and max wait between polls of distributed distance jobs (seconds)
+JOB_CHECK_TIME = 1.0
+JOB_CHECK_TIME_SCALE = 1.5
+JOB_CHECK_MAX_TIME = 60.0
+# failed status checks of one job tolerated in a row (as baseclient.run_job)
+JOB_CHECK_RETRYS = 3
+
+_POPCOUNT_TABLE = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+
+
+def _fill_condensed(dist_matrix, tile, start, end, n):
+    """
+    _fill_condensed: copy a (rows start:end x rows start:n) tile into the condensed matrix
+    """
+    for i in range(start, end):
+        offset = condensed_start(i, n)
+        dist_matrix[offset:offset + n - i - 1] = tile[i - start, i - start + 1:]
+
+
+def budget_block_rows(n_rows, memory_bytes=DEFAULT_MEMORY_BYTES, row_bytes=None):
+    """
+    budget_block_rows: rows per block so one block of tiles fits in memory_bytes
+
+    row_bytes: bytes held per block row, TILE_COPIES float64 rows of n_rows by default
+               (a block of rows against every later row)
+    """
+    if row_bytes is None:
+        row_bytes = TILE_COPIES * 8 * max(n_rows, 1)
+    return int(max(1, min(n_rows, memory_bytes // row_bytes)))
+
+
+def open_condensed(file_path, n_rows, dtype=np.float64):
+    """
+    open_condensed: writable memory mapped .npy condensed distance matrix for n_rows rows
+    """
+    return np.lib.format.open_memmap(file_path, mode='w+', dtype=dtype,
+                                     shape=(n_rows * (n_rows - 1) // 2,))
+
+
+def square_row_block(dist_matrix, n, start, end):
+    """
+    square_row_block: rows start:end of the square form of a condensed distance matrix
+
+    Every piece is a contiguous run of the condensed matrix: pairs (j, i) with j < i come
+    from condensed row j, pairs (i, j) with j > i from condensed row i.
+    """
+    block = np.zeros((end - start, n), dtype=dist_matrix.dtype)
+    for j in range(end - 1):
+        first = max(start, j + 1)
+        pos = condensed_start(j, n) + first - j - 1
+        block[first - start:, j] = dist_matrix[pos:pos + end - first]
+    for i in range(start, end):
+        pos = condensed_start(i, n)
+        block[i - start, i + 1:] = dist_matrix[pos:pos + n - i - 1]
+    return block
+
+
+def kmeans_condensed(dist_matrix, k_num, iterations=10, block_rows=1024, seed=0):
+    """
+    kmeans_condensed: k-means of rows described by their distances to every row
+
+    Clusters the rows of the square form of a condensed distance matrix, as
+    kb_ke_util.run_kmeans2 does, reading it a block of square rows at a time. Centroids
+    start at k_num distinct random rows (kmeans2 minit='points'), a centroid without rows
+    keeps its position, and the iterations stop early once no row changes cluster.
+
+    return (centroids, idx): (k_num x rows) centroids and the centroid index of every row
+    """
+    n = int(np.ceil(np.sqrt(2 * len(dist_matrix))))
+    if n * (n - 1) // 2 != len(dist_matrix):
+        raise ValueError('Distance matrix is not a condensed distance matrix')
+    if not 0 < k_num <= n:
+        raise ValueError('Cannot form {} clusters from {} rows'.format(k_num, n))
+
+    seeds = np.sort(np.random.RandomState(seed).choice(n, k_num, replace=False))
+    centroids = np.vstack([square_row_block(dist_matrix, n, i, i + 1)
+                           for i in seeds]).astype(np.float64)
+
+    idx = None
+    for iteration in range(iterations):
+        sums = np.zeros_like(centroids)
+        counts = np.zeros(k_num)
+        new_idx = np.empty(n, dtype=np.int64)
+        for start in range(0, n, block_rows):
+            end = min(start + block_rows, n)
+            block = square_row_block(dist_matrix, n, start, end).astype(np.float64)
+            codes = vq(block, centroids, check_finite=False)[0]
+            new_idx[start:end] = codes
+
+            members = np.zeros((k_num, end - start))
+            members[codes, np.arange(end - start)] = 1
+            sums += members.dot(block)
+            counts += members.sum(axis=1)
+
+        assigned = counts > 0
+        centroids[assigned] = sums[assigned] / counts[assigned][:, None]
+        converged = idx is not None and np.array_equal(new_idx, idx)
+        idx = new_idx
+        if converged:
+            break
+
+    return centroids, idx
+
+
+def tiled_pdist(values, metric='euclidean', block_rows=2048, out=None, rows=None):
+    """
+    tiled_pdist: condensed pairwise distances from scipy cdist on blocks of rows
+
+    Same values as scipy.spatial.distance.pdist, but only one (block_rows x rows) tile is
+    held in memory next to the output.
+
+    out: condensed output buffer (e.g. memory mapped), allocated if not given
+    rows: (first, last) only fill the pairs of rows first:last (for parallel workers)
+    """
+    n = values.shape[0]
+    dist_matrix = np.empty(n * (n - 1) // 2, dtype=np.float64) if out is None else out
+
+    first, last = rows or (0, n - 1)
+    for start in range(first, last, block_rows):
+        end = min(start + block_rows, last)
+        _fill_condensed(dist_matrix, cdist(values[start:end], values[start:], metric=metric),
+                        start, end, n)
+
+    return dist_matrix
+
+
+def _blas_prepare(values, metric, shift=None):
+    """
+    _blas_prepare: rows and row statistics for the Gram matrix product
+
+    correlation rows are centered, cosine/correlation rows scaled to unit length (zero
+    rows become NaN, as in scipy), euclidean rows are moved by shift (distances are
+    translation invariant, smaller norms lose less precision) and keep their squared norms
+    """
+    dtype = np.float32 if values.dtype == np.float32 else np.float64
+    values = np.asarray(values, dtype=dtype)
+
+    if metric == 'correlation':
+        values = values - values.mean(axis=1, keepdims=True)
+    elif metric in ['euclidean', 'sqeuclidean'] and shift is not None:
+        values = values - shift
+
+    norms = np.einsum('ij,ij->i', values, values)
+    if metric in ['cosine', 'correlation']:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = values / np.sqrt(norms)[:, None]
+
+    return values, norms
+
+
+def _blas_tile(rows, other_rows, metric):
+    """
+    _blas_tile: dense distance tile between two prepared row blocks
+
+    rows / other_rows: (values, norms) as returned by _blas_prepare
+    """
+    values, norms = rows
+    other_values, other_norms = other_rows
+    dist = values.dot(other_values.T)
+
+    if metric in ['cosine', 'correlation']:
+        np.subtract(1, dist, out=dist)
+        # rounding can push 1 - cos just outside [0, 2]
+        return np.clip(dist, 0, 2, out=dist)
+
+    dist *= -2
+    dist += norms[:, None]
+    dist += other_norms[None, :]
+    # clamp tiny negative values from cancellation
+    np.maximum(dist, 0, out=dist)
+
+    # cancellation dominates for (near) identical rows, compute those pairs directly
+    tol = np.sqrt(np.finfo(dist.dtype).eps)
+    rows_pos, other_pos = np.nonzero(dist <= tol * (norms[:, None] + other_norms[None, :]))
+    if rows_pos.size:
+        diff = values[rows_pos] - other_values[other_pos]
+        dist[rows_pos, other_pos] = np.einsum('ij,ij->i', diff, diff)
+
+    if metric == 'euclidean':
+        np.sqrt(dist, out=dist)
+
+    return dist
+
+
+def _shift(values):
+    """
+    _shift: column means ignoring NaN, used to center rows before the Gram product
+    """
+    return np.where(np.isnan(values), 0, values).mean(axis=0)
+
+
+def blas_pair_dist(metric):
+    """
+    blas_pair_dist: function (block_a, block_b) -> distance tile for a BLAS metric
+    """
+    def pair_dist(block_a, block_b):
+        shift = _shift(block_a)
+        return _blas_tile(_blas_prepare(block_a, metric, shift=shift),
+                          _blas_prepare(block_b, metric, shift=shift), metric)
+    return pair_dist
+
+
+def blas_pdist(values, metric='euclidean', block_rows=2048, out=None, rows=None):
+    """
+    blas_pdist: condensed pairwise distances from row norms and a blocked Gram matrix
+
+    Each block of rows is multiplied against every later row in a single matrix product
+    (BLAS), so the work runs at matrix multiply speed on all cores. float32 input is
+    computed and returned in float32.
+
+    out: condensed output buffer (e.g. memory mapped), allocated if not given
+    rows: (first, last) only fill the pairs of rows first:last (for parallel workers)
+    """
+    if metric not in BLAS_METRIC:
+        raise ValueError('Metric [{}] has no BLAS fast path'.format(metric))
+
+    values, norms = _blas_prepare(values, metric, shift=_shift(values))
+    n = values.shape[0]
+    dist_matrix = np.empty(n * (n - 1) // 2, dtype=values.dtype) if out is None else out
+
+    first, last = rows or (0, n - 1)
+    for start in range(first, last, block_rows):
+        end = min(start + block_rows, last)
+        tile = _blas_tile((values[start:end], norms[start:end]),
+                          (values[start:], norms[start:]), metric)
+        _fill_condensed(dist_matrix, tile, start, end, n)
+
+    return dist_matrix
+
+
+def _popcount(words):
+    """
+    _popcount: number of set bits of every uint64 word
+    """
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    words = np.ascontiguousarray(words)
+    return _POPCOUNT_TABLE[words.view(np.uint8)].reshape(words.shape + (8,)).sum(axis=-1)
+
+
+def _pack_block(values):
+    """
+    _pack_block: pack the non-zero pattern of dense rows into uint64 words
+    """
+    packed = np.packbits(np.asarray(values) != 0, axis=1)
+    n_bytes = -(-packed.shape[1] // 8) * 8
+    if n_bytes != packed.shape[1]:
+        packed = np.hstack([packed, np.zeros((packed.shape[0], n_bytes - packed.shape[1]),
+                                             dtype=np.uint8)])
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+
+def _iter_dense_blocks(matrix, block_rows=4096):
+    """
+    _iter_dense_blocks: dense row blocks of DataMatrix, SparseDataMatrix or ChunkedDataMatrix
+    """
+    if isinstance(matrix, ChunkedDataMatrix):
+        for start, end, values in matrix.iter_row_blocks():
+            yield values
+        return
+
+    for start in range(0, matrix.shape[0], block_rows):
+        values = matrix.values[start:start + block_rows]
+        yield values.toarray() if isinstance(matrix, SparseDataMatrix) else values
+
+
+def is_binary(matrix):
+    """
+    is_binary: True if every matrix value is 0 or 1 (presence/absence matrix)
+    """
+    if isinstance(matrix, SparseDataMatrix):
+        return bool(np.all((matrix.values.data == 0) | (matrix.values.data == 1)))
+
+    return all([np.all((values == 0) | (values == 1))
+                for values in _iter_dense_blocks(matrix)])
+
+
+def pack_rows(matrix):
+    """
+    pack_rows: bit-packed non-zero pattern of matrix rows, (rows x ceil(cols / 64)) uint64
+    """
+    return np.vstack([_pack_block(values) for values in _iter_dense_blocks(matrix)])
+
+
+def _boolean_tile(packed, other_packed, counts, other_counts, n_features, metric):
+    """
+    _boolean_tile: boolean dissimilarity tile from the contingency counts of packed rows
+
+    ntt (both true) comes from popcount(a & b); ntf, nft and nff follow from the row
+    popcounts. Formulas and degenerate cases match scipy.spatial.distance.
+    """
+    ntt = np.zeros((packed.shape[0], other_packed.shape[0]), dtype=np.int64)
+    for word in range(packed.shape[1]):
+        ntt += _popcount(packed[:, word, None] & other_packed[None, :, word])
+
+    ntf = counts[:, None] - ntt
+    nft = other_counts[None, :] - ntt
+    nff = n_features - ntt - ntf - nft
+    not_equal = (ntf + nft).astype(np.float64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if metric in ['hamming', 'matching']:
+            return not_equal / n_features
+        if metric == 'dice':
+            return not_equal / (2 * ntt + not_equal)
+        if metric == 'jaccard':
+            return np.where(ntt + not_equal == 0, 0, not_equal / (ntt + not_equal))
+        if metric == 'kulsinski':
+            return (not_equal - ntt + n_features) / (not_equal + n_features)
+        if metric in ['rogerstanimoto', 'sokalmichener']:
+            return 2 * not_equal / (ntt + nff + 2 * not_equal)
+        if metric == 'russellrao':
+            return (n_features - ntt).astype(np.float64) / n_features
+        if metric == 'sokalsneath':
+            return 2 * not_equal / (ntt + 2 * not_equal)
+        if metric == 'yule':
+            half_r = (ntf * nft).astype(np.float64)
+            return np.where(half_r == 0, 0, 2 * half_r / (ntt * nff + half_r))
+
+    raise ValueError('Metric [{}] is not a boolean metric'.format(metric))
+
+
+def boolean_pdist(packed, n_features, metric, block_rows=256, out=None, rows=None):
+    """
+    boolean_pdist: condensed boolean dissimilarities between bit-packed rows
+
+    packed: (rows x words) uint64 as returned by pack_rows
+    n_features: number of columns before packing
+    out: condensed output buffer (e.g. memory mapped), allocated if not given
+    rows: (first, last) only fill the pairs of rows first:last (for parallel workers)
+    """
+    if metric not in BOOLEAN_METRIC:
+        raise ValueError('Metric [{}] is not a boolean metric'.format(metric))
+
+    n = packed.shape[0]
+    counts = _popcount(packed).sum(axis=1).astype(np.int64)
+    dist_matrix = np.empty(n * (n - 1) // 2, dtype=np.float64) if out is None else out
+
+    first, last = rows or (0, n - 1)
+    for start in range(first, last, block_rows):
+        end = min(start + block_rows, last)
+        tile = _boolean_tile(packed[start:end], packed[start:], counts[start:end],
+                             counts[start:], n_features, metric)
+        _fill_condensed(dist_matrix, tile, start, end, n)
+
+    return dist_matrix
+
+
+def balanced_row_bounds(n_rows, n_tiles, boundaries=None):
+    """
+    balanced_row_bounds: split the rows of a condensed matrix into contiguous
+                         (first, last) ranges holding about the same number of pairs
+
+    Row i has n_rows - i - 1 pairs, so early ranges hold fewer rows than late ones.
+    boundaries: rows a range may start at (e.g. stored block starts), every row by default
+    """
+    if boundaries is None:
+        boundaries = np.arange(max(n_rows - 1, 1))
+    boundaries = np.asarray(boundaries, dtype=np.int64)
+
+    n_pairs = n_rows * (n_rows - 1) // 2
+    targets = [n_pairs * tile // n_tiles for tile in range(1, n_tiles)]
+    starts = boundaries[np.searchsorted(condensed_start(boundaries, n_rows), targets)
+                        .clip(0, len(boundaries) - 1)]
+    starts = sorted(set([int(boundaries[0])] + starts.tolist()))
+
+    return list(zip(starts, starts[1:] + [max(n_rows - 1, starts[-1] + 1)]))
+
+
+def shared_condensed(n_rows, dtype=np.float64):
+    """
+    shared_condensed: condensed distance buffer in anonymous shared memory
+
+    Writes of forked worker processes are seen by the parent, nothing is pickled.
+    """
+    n_pairs = n_rows * (n_rows - 1) // 2
+    buffer = mmap.mmap(-1, max(n_pairs * np.dtype(dtype).itemsize, 1))
+    return np.frombuffer(buffer, dtype=dtype, count=n_pairs)
+
+
+def _run_parallel_task(rows):
+    _PARALLEL_TASK(rows)
+    return rows
+
+
+def parallel_fill(task, row_bounds, n_jobs):
+    """
+    parallel_fill: run task(rows) for every (first, last) range in a pool of n_jobs
+                   forked processes
+
+    task writes its rows into a shared output buffer (shared_condensed or a memory mapped
+    file), so only the row ranges travel between processes.
+    """
+    global _PARALLEL_TASK
+
+    context = multiprocessing.get_context('fork')
+    _PARALLEL_TASK = task
+    try:
+        pool = context.Pool(processes=n_jobs)
+        try:
+            for rows in pool.imap_unordered(_run_parallel_task, row_bounds):
+                pass
+        finally:
+            pool.terminate()
+    finally:
+        _PARALLEL_TASK = None
+
+
+def _dense_rows(matrix, row_pos):
+    """
+    _dense_rows: dense values of the rows at row_pos of any matrix type
+    """
+    if isinstance(matrix, ChunkedDataMatrix):
+        return matrix.read(row_pos=row_pos)
+    values = matrix.values[row_pos]
+    return values.toarray() if isinstance(matrix, SparseDataMatrix) else np.asarray(values)
+
+
+def _next_prime(low):
+    """
+    _next_prime: smallest prime >= low
+    """
+    prime = max(low, 2)
+    while any(prime % factor == 0 for factor in range(2, int(prime ** 0.5) + 1)):
+        prime += 1
+    return prime
+
+
+def plane_jobs(n_rows, job_rows):
+    """
+    plane_jobs: row blocks and run_pdist jobs covering every pair of rows once
+
+    Rows are split into q * q blocks, the points of the affine plane over the integers
+    modulo a prime q, and every line of the plane (q blocks) is one job of at most job_rows
+    rows. Two blocks lie on exactly one line, so every pair across blocks is computed by one
+    job; only the in-block pairs are computed again by the other q lines through a block,
+    which puts the duplicated work at 1 / q of the total (a job per pair of blocks computes
+    every pair about twice).
+
+    return (block_bounds, jobs): [(start, end)] of every block and [(blocks, own_blocks)]
+           of every job, own_blocks being the blocks whose in-block pairs it fills
+    """
+    if n_rows <= job_rows:
+        return [(0, n_rows)], ([([0], {0})] if n_rows > 1 else [])
+
+    prime = _next_prime(-(-n_rows // job_rows))
+    while prime * -(-n_rows // prime ** 2) > job_rows:
+        prime = _next_prime(prime + 1)
+    n_blocks = prime ** 2
+    starts = [n_rows * block // n_blocks for block in range(n_blocks + 1)]
+    block_bounds = list(zip(starts[:-1], starts[1:]))
+
+    lines = [[x * prime + (slope * x + offset) % prime for x in range(prime)]
+             for slope in range(prime) for offset in range(prime)]
+    lines += [[x * prime + y for y in range(prime)] for x in range(prime)]
+
+    jobs = []
+    owned = set()
+    for blocks in lines:
+        if sum(end - start for start, end in (block_bounds[block] for block in blocks)) < 2:
+            continue
+        own_blocks = set(blocks) - owned
+        owned.update(own_blocks)
+        jobs.append((blocks, own_blocks))
+    return block_bounds, jobs
+
+
+def _fill_job_result(dist_matrix, pdist_ret, row_pos, block_of, own_blocks):
+    """
+    _fill_job_result: copy the pairs a run_pdist job owns into the condensed matrix
+
+    pdist_ret: run_pdist return ({'dist_matrix': condensed, 'labels': row ids})
+    row_pos: row id -> row position in the whole matrix
+    own_blocks: blocks whose in-block pairs this job fills; pairs across two blocks are
+                always kept
+    """
+    n = len(block_of)
+    positions = np.array([row_pos[label] for label in pdist_ret['labels']], dtype=np.int64)
+    first, second = np.triu_indices(len(positions), 1)
+    first, second = positions[first], positions[second]
+    job_dist = np.asarray(pdist_ret['dist_matrix'], dtype=np.float64)
+
+    keep = ((block_of[first] != block_of[second]) |
+            np.isin(block_of[first], list(own_blocks)))
+    first, second, job_dist = first[keep], second[keep], job_dist[keep]
+
+    low, high = np.minimum(first, second), np.maximum(first, second)
+    dist_matrix[condensed_start(low, n) + high - low - 1] = job_dist
+
+
+def distributed_pdist(matrix, metric, job_client, block_rows=2000, max_jobs=16, out=None,
+                      check_time=JOB_CHECK_TIME):
+    """
+    distributed_pdist: condensed pairwise distances computed by concurrent run_pdist jobs
+
+    Rows are split into blocks grouped into run_pdist jobs of at most 2 * block_rows rows
+    (see plane_jobs), at most max_jobs running at once, and all running jobs are polled
+    together, so the work spreads over the nodes of the job service. Each result is written
+    into the condensed matrix as soon as its job finishes. A status check failing with a
+    connection error is retried JOB_CHECK_RETRYS times; a failed job raises ValueError
+    naming its row blocks.
+
+    job_client: kb_ke_util client (_run_pdist_submit / _check_job) or a stand-in with the
+                same methods
+    out: condensed output buffer (e.g. memory mapped), allocated if not given
+    """
+    n = matrix.shape[0]
+    dist_matrix = np.empty(n * (n - 1) // 2, dtype=np.float64) if out is None else out
+
+    block_bounds, jobs = plane_jobs(n, 2 * block_rows)
+    block_of = np.repeat(np.arange(len(block_bounds)),
+                         [end - start for start, end in block_bounds])
+    row_pos = dict([(row_id, pos) for pos, row_id in enumerate(matrix.row_ids.tolist())])
+    log('submitting {} distance jobs for {} row blocks'.format(len(jobs), len(block_bounds)))
+
+    pending = list(reversed(jobs))
+    running = {}
+    check_failures = {}
+    wait_time = check_time
+    while pending or running:
+        while pending and len(running) < max_jobs:
+            blocks, own_blocks = pending.pop()
+            job_rows = np.concatenate([np.arange(*block_bounds[block]) for block in blocks])
+            data_matrix = DataMatrix(_dense_rows(matrix, job_rows), matrix.row_ids[job_rows],
+                                     matrix.col_ids).to_json()
+            job_id = job_client._run_pdist_submit({'data_matrix': data_matrix,
+                                                   'metric': metric})
+            running[job_id] = (blocks, own_blocks)
+            check_failures[job_id] = 0
+
+        time.sleep(wait_time)
+        finished = False
+        for job_id in list(running):
+            blocks, own_blocks = running[job_id]
+            try:
+                job_state = job_client._check_job(job_id)
+            except (IOError, OSError) as e:
+                # requests ConnectionError is an IOError
+                check_failures[job_id] += 1
+                log('checking distance job {} failed ({} of {}): {}'.format(
+                                        job_id, check_failures[job_id], JOB_CHECK_RETRYS, e))
+                if check_failures[job_id] >= JOB_CHECK_RETRYS:
+                    raise
+                continue
+            check_failures[job_id] = 0
+
+            if job_state['finished']:
+                if not job_state.get('result'):
+                    raise ValueError('Distance job {} for row blocks {} failed: {}'.format(
+                        job_id, ', '.join(['[{}:{}]'.format(*block_bounds[block])
+                                           for block in blocks]),
+                        job_state.get('error')))
+                _fill_job_result(dist_matrix, job_state['result'][0], row_pos, block_of,
+                                 own_blocks)
+                del running[job_id]
+                finished = True
+
+        # back off while nothing finishes
+        wait_time = check_time if finished else min(wait_time * JOB_CHECK_TIME_SCALE,
+                                                    JOB_CHECK_MAX_TIME)
+
+    return dist_matrix
+
+
+def _dist_dtype(matrix):
+    """
+    _dist_dtype: float32 distances for float32 matrices, float64 otherwise
+    """
+    dtype = matrix.dtype if isinstance(matrix, ChunkedDataMatrix) else matrix.values.dtype
+    return np.float32 if dtype == np.float32 else np.float64
+
+
+def _pdist_task(matrix, metric, memory_bytes):
+    """
+    _pdist_task: engine for matrix and metric as (task(out, rows), row boundaries, uses BLAS)
+    """
+    n = matrix.shape[0]
+    block_rows = budget_block_rows(n, memory_bytes=memory_bytes)
+
+    if metric in BOOLEAN_METRIC and (metric in BOOLEAN_ONLY_METRIC or is_binary(matrix)):
+        log('calculating {} distance on bit-packed rows'.format(metric))
+        packed = pack_rows(matrix)
+
+        def task(out, rows=None):
+            return boolean_pdist(packed, matrix.shape[1], metric, block_rows=block_rows,
+                                 out=out, rows=rows)
+        return task, None, False
+
+    if isinstance(matrix, SparseDataMatrix):
+        if metric in SPARSE_METRIC:
+            def task(out, rows=None):
+                return sparse_pdist(matrix.values, metric=metric, block_rows=block_rows,
+                                    out=out, rows=rows)
+            return task, None, False
+
+        log('densifying sparse matrix for metric [{}]'.format(metric))
+        values = matrix.values.toarray()
+
+        def task(out, rows=None):
+            return tiled_pdist(values, metric=metric, block_rows=block_rows, out=out, rows=rows)
+        return task, None, False
+
+    if isinstance(matrix, ChunkedDataMatrix):
+        # two blocks of rows and their square tile
+        chunk_rows = min(budget_block_rows(n, memory_bytes=memory_bytes // 2,
+                                           row_bytes=2 * 8 * max(matrix.shape[1], 1)),
+                         int(np.sqrt(memory_bytes // 2 // (TILE_COPIES * 8))) or 1)
+        pair_dist = blas_pair_dist(metric) if metric in BLAS_METRIC else None
+
+        def task(out, rows=None):
+            return chunked_pdist(matrix, metric=metric, block_rows=chunk_rows,
+                                 pair_dist=pair_dist, out=out, rows=rows)
+        boundaries = [start for start, end in matrix._row_bounds(block_rows=chunk_rows)]
+        return task, boundaries, metric in BLAS_METRIC
+
+    if metric in NAN_METRIC and has_nan(matrix.values):
+        log('calculating pairwise-complete {} distance skipping missing values'.format(metric))
+
+        def task(out, rows=None):
+            return nan_pdist(matrix.values, metric=metric, block_rows=block_rows, out=out,
+                             rows=rows)
+        return task, None, False
+
+    if metric in BLAS_METRIC:
+        def task(out, rows=None):
+            return blas_pdist(matrix.values, metric=metric, block_rows=block_rows, out=out,
+                              rows=rows)
+        return task, None, True
+
+    def task(out, rows=None):
+        return tiled_pdist(matrix.values, metric=metric, block_rows=block_rows, out=out,
+                           rows=rows)
+    return task, None, False
+
+
+def calc_dist_matrix(matrix, metric='euclidean', out_path=None,
+                     memory_bytes=DEFAULT_MEMORY_BYTES, n_jobs=1):
+    """
+    calc_dist_matrix: condensed pairwise distances between matrix rows
+
+    matrix: DataMatrix, SparseDataMatrix or ChunkedDataMatrix
+    metric: any scipy.spatial.distance.pdist metric
+            (NAN_METRIC distances of dense rows with missing values are pairwise-complete)
+    out_path: write the distances into a memory mapped .npy file at out_path
+    memory_bytes: memory budget for the row blocks tiled at a time (on top of the output)
+    n_jobs: number of worker processes, each filling balanced ranges of condensed rows
+            (BLAS metrics already run on every core through the matrix product)
+
+    Returns the condensed distance matrix as a float ndarray (same layout as pdist), a
+    numpy.memmap if out_path is given.
+    Raises ValueError for a metric the installed scipy does not provide.
+    """
+    metric = metric or 'euclidean'
+    n = matrix.shape[0]
+    n_jobs = max(1, min(int(n_jobs or 1), multiprocessing.cpu_count(), n - 1))
+
+    # the budget is shared by all workers
+    task, boundaries, uses_blas = _pdist_task(matrix, metric, memory_bytes // n_jobs)
+
+    out = None
+    if out_path:
+        out = open_condensed(out_path, n, dtype=_dist_dtype(matrix))
+
+    if n_jobs == 1 or uses_blas:
+        return task(out)
+
+    if out is None:
+        out = shared_condensed(n, dtype=_dist_dtype(matrix))
+
+    row_bounds = balanced_row_bounds(n, n_jobs * TILES_PER_JOB, boundaries=boundaries)
+    log('calculating {} distance with {} processes'.format(metric, n_jobs))
+    parallel_fill(lambda rows: task(out, rows=rows), row_bounds, n_jobs)
+
+    return out
@@ -0,0 +1,341 @@
+import numpy as np
+
+from kb_ke_apps.Utils.MatrixUtil import SparseDataMatrix, log
+from kb_ke_apps.Utils.ChunkedUtil import ChunkedDataMatrix
+
+
+INVALID_DATA_ACTION = ["keep", "drop", "fail"]
+
+# invalid row/column categories reported by find_invalid
+INVALID_TYPES = ['all_nan', 'constant', 'non_finite']
+
+# per-row dispersion measures for the variance prefilter
+VARIANCE_MEASURE = ["variance", "mad", "cv"]
+
+
+def _dense_invalid(values, axis):
+    """
+    _dense_invalid: masks of all-NaN, constant and non-finite slices along axis
+    """
+    nan = np.isnan(values)
+    all_nan = nan.all(axis=axis)
+    non_finite = np.isinf(values).any(axis=axis)
+
+    # min == max over the present values, NaN excluded
+    min_values = np.where(nan, np.inf, values).min(axis=axis)
+    max_values = np.where(nan, -np.inf, values).max(axis=axis)
+    constant = ~all_nan & ~non_finite & (min_values == max_values)
+
+    return {'all_nan': all_nan, 'constant': constant, 'non_finite': non_finite}
+
+
+def _sparse_invalid(values, axis):
+    """
+    _sparse_invalid: masks of all-NaN, constant and non-finite slices along axis of a CSR
+                     matrix (missing values are stored as zeros, so no slice is all-NaN)
+    """
+    inf = values.copy()
+    inf.data = np.isinf(inf.data)
+    non_finite = np.asarray(inf.sum(axis=axis)).ravel() > 0
+
+    # min and max include the implicit zeros
+    min_values = values.min(axis=axis).toarray().ravel()
+    max_values = values.max(axis=axis).toarray().ravel()
+    constant = ~non_finite & (min_values == max_values)
+
+    return {'all_nan': np.zeros(constant.shape, dtype=bool),
+            'constant': constant,
+            'non_finite': non_finite}
+
+
+def _chunked_invalid(matrix):
+    """
+    _chunked_invalid: row and column masks of a chunked matrix, reduced block by block
+    """
+    row_masks = {invalid_type: np.zeros(matrix.shape[0], dtype=bool)
+                 for invalid_type in INVALID_TYPES}
+    col_all_nan = np.ones(matrix.shape[1], dtype=bool)
+    col_non_finite = np.zeros(matrix.shape[1], dtype=bool)
+    col_min = np.full(matrix.shape[1], np.inf)
+    col_max = np.full(matrix.shape[1], -np.inf)
+
+    for start, end, values in matrix.iter_row_blocks():
+        for invalid_type, mask in _dense_invalid(values, 1).items():
+            row_masks[invalid_type][start:end] = mask
+
+        nan = np.isnan(values)
+        col_all_nan &= nan.all(axis=0)
+        col_non_finite |= np.isinf(values).any(axis=0)
+        col_min = np.minimum(col_min, np.where(nan, np.inf, values).min(axis=0))
+        col_max = np.maximum(col_max, np.where(nan, -np.inf, values).max(axis=0))
+
+    col_masks = {'all_nan': col_all_nan,
+                 'constant': ~col_all_nan & ~col_non_finite & (col_min == col_max),
+                 'non_finite': col_non_finite}
+
+    return row_masks, col_masks
+
+
+def find_invalid(matrix):
+    """
+    find_invalid: find all-NaN, constant and non-finite (+/-inf) rows and columns
+
+    All masks are computed with vectorized reductions over the matrix.
+
+    return:
+    {'rows': {'all_nan': row_ids, 'constant': row_ids, 'non_finite': row_ids},
+     'cols': {'all_nan': col_ids, 'constant': col_ids, 'non_finite': col_ids}}
+    """
+    if isinstance(matrix, SparseDataMatrix):
+        row_masks = _sparse_invalid(matrix.values, 1)
+        col_masks = _sparse_invalid(matrix.values, 0)
+    elif isinstance(matrix, ChunkedDataMatrix):
+        row_masks, col_masks = _chunked_invalid(matrix)
+    else:
+        row_masks = _dense_invalid(matrix.values, 1)
+        col_masks = _dense_invalid(matrix.values, 0)
+
+    return {'rows': {invalid_type: matrix.row_ids[mask].tolist()
+                     for invalid_type, mask in row_masks.items()},
+            'cols': {invalid_type: matrix.col_ids[mask].tolist()
+                     for invalid_type, mask in col_masks.items()}}
+
+
+def prune_invalid(matrix, invalid_data_action='keep'):
+    """
+    prune_invalid: report invalid rows and columns and keep, drop or reject them
+
+    invalid_data_action: one of INVALID_DATA_ACTION
+                         "keep" - only log invalid rows and columns
+                         "drop" - remove invalid rows and columns from matrix
+                         "fail" - raise ValueError if any row or column is invalid
+
+    return:
+    matrix: pruned matrix (the input matrix if nothing was dropped)
+    invalid: invalid row and column ids (as returned by find_invalid)
+    """
+    if invalid_data_action not in INVALID_DATA_ACTION:
+        raise ValueError('Invalid data action [{}] is not valid. Available: {}'.format(
+                                                    invalid_data_action, INVALID_DATA_ACTION))
+
+    invalid = find_invalid(matrix)
+
+    summary = []
+    for axis in ['rows', 'cols']:
+        for invalid_type in INVALID_TYPES:
+            ids = invalid[axis][invalid_type]
+            if ids:
+                summary.append('{} {} {}: {}{}'.format(len(ids), invalid_type, axis,
+                                                       ids[:10], ' ...' if len(ids) > 10 else ''))
+
+    if not summary:
+        return matrix, invalid
+
+    log('found invalid matrix data\n' + '\n'.join(summary))
+
+    if invalid_data_action == 'fail':
+        error_msg = 'INPUT ERROR:\nMatrix contains invalid rows or columns.\n'
+        error_msg += '\n'.join(summary)
+        raise ValueError(error_msg)
+
+    if invalid_data_action == 'keep':
+        return matrix, invalid
+
+    drop_rows = set().union(*list(invalid['rows'].values()))
+    drop_cols = set().union(*list(invalid['cols'].values()))
+    row_pos = [pos for pos, row_id in enumerate(matrix.row_ids) if row_id not in drop_rows]
+    col_pos = [pos for pos, col_id in enumerate(matrix.col_ids) if col_id not in drop_cols]
+
+    if not row_pos or not col_pos:
+        raise ValueError('INPUT ERROR:\nNo valid matrix data left after dropping invalid rows '
+                         'and columns.\n' + '\n'.join(summary))
+
+    log('dropping {} rows and {} columns'.format(len(drop_rows), len(drop_cols)))
+
+    return matrix.take(row_pos=row_pos if drop_rows else None,
+                       col_pos=col_pos if drop_cols else None), invalid
+
+
+def _row_keys(matrix):
+    """
+    _row_keys: hashable content key of every matrix row
+    """
+    if isinstance(matrix, ChunkedDataMatrix):
+        return [row.tobytes() for start, end, values in matrix.iter_row_blocks()
+                for row in np.ascontiguousarray(values + 0.0)]
+
+    if isinstance(matrix, SparseDataMatrix):
+        values = matrix.values.copy()
+        values.eliminate_zeros()
+        values.sort_indices()
+        return [(values.indices[start:end].tobytes(), values.data[start:end].tobytes())
+                for start, end in zip(values.indptr[:-1], values.indptr[1:])]
+
+    # + 0.0 folds -0.0 into 0.0 so equal rows have equal bytes
+    values = np.ascontiguousarray(matrix.values + 0.0)
+    return [row.tobytes() for row in values]
+
+
+def collapse_duplicate_rows(matrix):
+    """
+    collapse_duplicate_rows: keep the first of every group of identical rows
+
+    Rows are compared by content hash (NaN equals NaN).
+
+    return:
+    matrix: matrix of unique rows (the input matrix if there are no duplicates)
+    duplicates: representative row id -> ids of the rows it stands for (multiplicity is
+                len + 1)
+    """
+    representatives = {}
+    duplicates = {}
+    row_pos = []
+    for pos, key in enumerate(_row_keys(matrix)):
+        row_id = matrix.row_ids[pos]
+        representative = representatives.get(key)
+        if representative is None:
+            representatives[key] = row_id
+            row_pos.append(pos)
+        else:
+            duplicates.setdefault(representative, []).append(row_id)
+
+    if not duplicates:
+        return matrix, duplicates
+
+    log('collapsed {} rows into {} unique rows'.format(matrix.shape[0], len(row_pos)))
+
+    return matrix.take(row_pos=row_pos), duplicates
+
+
+def expand_duplicate_linkage(linkage_matrix, labels, duplicates, row_ids):
+    """
+    expand_duplicate_linkage: linkage matrix over every row from the linkage of unique rows
+
+    Each representative first merges with its duplicates at height 0, the resulting
+    cluster then takes the representative's place in the unique linkage. For the
+    DEDUP linkage methods this is the linkage of the full matrix.
+
+    linkage_matrix: linkage of the unique rows, leaves in labels order
+    duplicates: representative row id -> ids of the rows it stands for (as returned by
+                collapse_duplicate_rows)
+    row_ids: ids of every row, leaves of the returned linkage
+    """
+    linkage_matrix = np.asarray(linkage_matrix, dtype=np.float64)
+    if not duplicates:
+        return linkage_matrix
+
+    row_pos = dict([(row_id, pos) for pos, row_id in enumerate(row_ids)])
+    n_rows = len(row_ids)
+    sizes = np.ones(2 * n_rows - 1)
+    expanded_rows = []
+
+    def merge(first, second, height):
+        first, second = min(first, second), max(first, second)
+        node = n_rows + len(expanded_rows)
+        sizes[node] = sizes[first] + sizes[second]
+        expanded_rows.append([first, second, height, sizes[node]])
+        return node
+
+    leaf_nodes = []
+    for label in labels:
+        node = row_pos[label]
+        for duplicate in duplicates.get(label, []):
+            node = merge(node, row_pos[duplicate], 0.0)
+        leaf_nodes.append(node)
+
+    n_unique = len(labels)
+    offset = n_rows + len(expanded_rows) - n_unique
+    for first, second, height, size in linkage_matrix:
+        first, second = [leaf_nodes[int(node)] if node < n_unique else int(node) + offset
+                         for node in [first, second]]
+        merge(first, second, height)
+
+    return np.array(expanded_rows)
+
+
+def _dense_dispersion(values, measure):
+    """
+    _dense_dispersion: NaN-aware per-row dispersion of a dense block (NaN if undefined)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    present = np.isfinite(values).any(axis=1)
+    dispersion = np.full(values.shape[0], np.nan)
+    values = values[present]
+
+    if measure == 'variance':
+        dispersion[present] = np.nanvar(values, axis=1)
+    elif measure == 'mad':
+        median = np.nanmedian(values, axis=1)
+        dispersion[present] = np.nanmedian(np.abs(values - median[:, None]), axis=1)
+    elif measure == 'cv':
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dispersion[present] = np.nanstd(values, axis=1) / np.abs(np.nanmean(values, axis=1))
+    else:
+        raise ValueError('Variance measure [{}] is not valid. Available: {}'.format(
+                                                                    measure, VARIANCE_MEASURE))
+
+    return dispersion
+
+
+def row_dispersion(matrix, measure='variance', block_rows=4096):
+    """
+    row_dispersion: per-row variance, median absolute deviation or coefficient of variation
+
+    Sparse matrices are densified block by block of block_rows rows, chunked matrices are
+    read block by block.
+    """
+    if isinstance(matrix, ChunkedDataMatrix):
+        dispersion = np.empty(matrix.shape[0])
+        for start, end, values in matrix.iter_row_blocks():
+            dispersion[start:end] = _dense_dispersion(values, measure)
+        return dispersion
+
+    if not isinstance(matrix, SparseDataMatrix):
+        return _dense_dispersion(matrix.values, measure)
+
+    dispersion = np.empty(matrix.shape[0])
+    for start in range(0, matrix.shape[0], block_rows):
+        end = min(start + block_rows, matrix.shape[0])
+        dispersion[start:end] = _dense_dispersion(matrix.values[start:end].toarray(), measure)
+
+    return dispersion
+
+
+def filter_by_variance(matrix, top_n=None, min_variance=None, measure='variance'):
+    """
+    filter_by_variance: keep the most variable rows of matrix
+
+    top_n: keep at most top_n rows with the largest dispersion
+    min_variance: keep rows with dispersion of at least min_variance
+    measure: one of VARIANCE_MEASURE
+
+    Rows keep their original order; rows without a defined dispersion are dropped.
+
+    return:
+    matrix: filtered matrix (the input matrix if every row is kept)
+    kept_row_ids: ids of the kept rows
+    """
+    dispersion = row_dispersion(matrix, measure=measure)
+    keep = np.isfinite(dispersion)
+
+    if min_variance is not None:
+        keep &= dispersion >= min_variance
+
+    if top_n is not None and keep.sum() > top_n:
+        candidates = np.flatnonzero(keep)
+        # stable sort so ties keep the lower (earlier) row
+        top = candidates[np.argsort(-dispersion[candidates], kind='stable')[:top_n]]
+        keep = np.zeros(keep.shape, dtype=bool)
+        keep[top] = True
+
+    if not keep.any():
+        raise ValueError('INPUT ERROR:\nNo matrix rows left after {} filtering.\n'.format(
+                                                                                    measure))
+
+    if keep.all():
+        return matrix, matrix.row_ids.tolist()
+
+    log('keeping {} of {} rows by {}'.format(keep.sum(), matrix.shape[0], measure))
+    matrix = matrix.take(row_pos=np.flatnonzero(keep))
+
+    return matrix, matrix.row_ids.tolist()
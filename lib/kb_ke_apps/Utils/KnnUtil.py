@@ -0,0 +1,434 @@
+import heapq
+
+import numpy as np
+import scipy.sparse as sp
+import scipy.cluster.hierarchy as hier
+from scipy.spatial.distance import pdist
+
+from kb_ke_apps.Utils.MatrixUtil import SparseDataMatrix, log
+from kb_ke_apps.Utils.ChunkedUtil import ChunkedDataMatrix
+from kb_ke_apps.Utils.DistanceUtil import _blas_prepare
+from kb_ke_apps.Utils.LinkageUtil import _UnionFind, kruskal_merges
+
+
+# metrics ranked by euclidean distance between prepared rows (see _blas_prepare)
+KNN_METRIC = ["euclidean", "sqeuclidean", "cosine", "correlation"]
+
+# linkage methods derived from the sparse kNN graph
+KNN_METHOD = ["single", "average"]
+
+# floats of the (rows x candidates x columns) blocks gathered per NN-descent step
+CANDIDATE_BLOCK_FLOATS = 8 * 1024 ** 2
+
+
+def dense_values(matrix):
+    """
+    dense_values: values of DataMatrix, SparseDataMatrix or ChunkedDataMatrix as ndarray
+    """
+    if isinstance(matrix, ChunkedDataMatrix):
+        return matrix.read()
+    if isinstance(matrix, SparseDataMatrix):
+        return matrix.values.toarray()
+    return np.asarray(matrix.values)
+
+
+def row_values(matrix):
+    """
+    row_values: rows of DataMatrix (ndarray), SparseDataMatrix (CSR matrix) or the
+                ChunkedDataMatrix itself, as read block by block by knn_graph / knn_linkage
+    """
+    if isinstance(matrix, ChunkedDataMatrix):
+        return matrix
+    return matrix.values
+
+
+def _iter_raw_blocks(values, block_rows):
+    """
+    _iter_raw_blocks: yield (start, end, rows[start:end]) of an ndarray, CSR matrix (CSR
+                      blocks) or ChunkedDataMatrix (dense blocks)
+    """
+    if isinstance(values, ChunkedDataMatrix):
+        for start, end, block in values.iter_row_blocks(block_rows=block_rows):
+            yield start, end, block
+        return
+
+    for start in range(0, values.shape[0], block_rows):
+        end = min(start + block_rows, values.shape[0])
+        yield start, end, values[start:end]
+
+
+class _PreparedRows:
+    """
+    _PreparedRows: rows prepared for the euclidean kNN search (see _blas_prepare)
+
+    Dense arrays are prepared once. Chunked stores are read and prepared a block of rows
+    at a time. CSR matrices stay sparse: a prepared row is scale * (row - offset), with
+    the offset (row mean for correlation) and scale (inverse length for cosine and
+    correlation) kept per row, so projections and pair products come from sparse
+    products. Memory stays O(block) instead of O(rows * columns) for both.
+    """
+
+    def __init__(self, values, metric):
+        self.metric = metric
+        self.shape = values.shape
+        # floats held per row read (stored entries for CSR)
+        self.row_floats = max(self.shape[1], 1)
+        self.block_rows = max(1, CANDIDATE_BLOCK_FLOATS // self.row_floats)
+        self.values = None
+        self.chunked = None
+        self.csr = None
+
+        if isinstance(values, ChunkedDataMatrix):
+            self.chunked = values
+        elif sp.issparse(values):
+            self._init_csr(sp.csr_matrix(values, dtype=np.float64))
+            return
+        else:
+            self.values = self._prepare(values)
+
+        self.norms = np.empty(self.shape[0])
+        for start in range(0, self.shape[0], self.block_rows):
+            block = self.read(np.arange(start, min(start + self.block_rows, self.shape[0])))
+            self.norms[start:start + len(block)] = np.einsum('ij,ij->i', block, block)
+
+    def _init_csr(self, csr):
+        self.csr = csr
+        self.row_floats = max(1, csr.nnz // max(self.shape[0], 1))
+        n_cols = self.shape[1]
+        self.sums = np.asarray(csr.sum(axis=1)).ravel()
+        squares = np.asarray(csr.multiply(csr).sum(axis=1)).ravel()
+
+        self.offsets = np.zeros(self.shape[0])
+        self.scales = np.ones(self.shape[0])
+        if self.metric == 'correlation':
+            self.offsets = self.sums / max(n_cols, 1)
+            squares = np.maximum(squares - n_cols * self.offsets ** 2, 0)
+        if self.metric in ['cosine', 'correlation']:
+            # zero (or constant) rows are undefined (NaN), they become zero rows
+            with np.errstate(divide='ignore'):
+                self.scales = np.where(squares > 0, 1 / np.sqrt(squares), 0)
+            self.norms = np.where(squares > 0, 1., 0.)
+        else:
+            self.norms = squares
+
+    def _prepare(self, values):
+        values, norms = _blas_prepare(np.asarray(values, dtype=np.float64), self.metric)
+        # zero rows are undefined for cosine/correlation (NaN), keep them apart from the rest
+        return np.nan_to_num(values)
+
+    def read(self, rows):
+        """
+        read: dense prepared rows at the positions rows (1D, repeats allowed)
+        """
+        if self.values is not None:
+            return self.values[rows]
+
+        # every distinct row is read (and prepared) once, in stored order
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        if self.chunked is not None:
+            block = self._prepare(self.chunked.read(row_pos=unique_rows))
+        else:
+            block = self.csr[unique_rows].toarray() - self.offsets[unique_rows][:, None]
+            block *= self.scales[unique_rows][:, None]
+        return block[inverse.ravel()]
+
+    def project(self, rows, direction):
+        """
+        project: dot products of the prepared rows at the positions rows with direction
+        """
+        if self.csr is not None:
+            return self.scales[rows] * (self.csr[rows].dot(direction) -
+                                        self.offsets[rows] * direction.sum())
+
+        return np.concatenate([self.read(rows[start:start + self.block_rows]).dot(direction)
+                               for start in range(0, len(rows), self.block_rows)] or
+                              [np.empty(0)])
+
+    def pair_dots(self, rows, other_rows):
+        """
+        pair_dots: dot products of the prepared rows pairs (rows[i], other_rows[i])
+        """
+        if self.csr is None:
+            return np.einsum('ij,ij->i', self.read(rows), self.read(other_rows))
+
+        products = np.asarray(self.csr[rows].multiply(self.csr[other_rows]).sum(axis=1)).ravel()
+        # (x - a)(y - b) = xy - b sum(x) - a sum(y) + n a b
+        offsets, other_offsets = self.offsets[rows], self.offsets[other_rows]
+        products -= other_offsets * self.sums[rows] + offsets * self.sums[other_rows]
+        products += self.shape[1] * offsets * other_offsets
+        return products * self.scales[rows] * self.scales[other_rows]
+
+
+def _from_euclidean(dist, metric):
+    """
+    _from_euclidean: metric distance from the euclidean distance between prepared rows
+    """
+    if metric == 'euclidean':
+        return dist
+    if metric == 'sqeuclidean':
+        return dist ** 2
+    # unit rows: |u - v|^2 = 2 - 2 cos
+    return dist ** 2 / 2
+
+
+def _leaf_neighbors(rows, leaf, n_neighbors, knn_idx, knn_dist):
+    """
+    _leaf_neighbors: fill the closest rows of the same leaf as candidates of every leaf row
+    """
+    leaf_values = rows.read(leaf)
+    norms = rows.norms
+    dist = norms[leaf][:, None] + norms[leaf][None, :] - 2 * leaf_values.dot(leaf_values.T)
+    np.maximum(dist, 0, out=dist)
+    np.fill_diagonal(dist, np.inf)
+
+    n_leaf = min(n_neighbors, len(leaf) - 1)
+    order = np.argsort(dist, axis=1)[:, :n_leaf]
+    knn_idx[leaf, :n_leaf] = leaf[order]
+    knn_dist[leaf, :n_leaf] = np.take_along_axis(dist, order, axis=1)
+
+
+def _rp_tree_leaves(rows, leaf_size, random_state):
+    """
+    _rp_tree_leaves: leaves of a random projection tree
+
+    Each node is split at the median projection on the direction between two random rows,
+    so the tree is balanced and every leaf holds at most leaf_size rows.
+    """
+    leaves = []
+    stack = [np.arange(rows.shape[0])]
+    while stack:
+        node = stack.pop()
+        if len(node) <= leaf_size:
+            leaves.append(node)
+            continue
+
+        first, second = rows.read(random_state.choice(node, 2, replace=False))
+        projection = rows.project(node, first - second)
+        order = np.argsort(projection, kind='stable')
+        half = len(node) // 2
+        stack.extend([node[order[:half]], node[order[half:]]])
+
+    return leaves
+
+
+def _top_k(cand_idx, cand_dist, n_neighbors):
+    """
+    _top_k: n_neighbors closest distinct candidates of every row
+
+    cand_idx, cand_dist: (rows x candidates) candidate indices (-1 for none) and squared
+                         distances
+
+    return (rows x n_neighbors) indices (-1 where a row has too few candidates) and
+    squared distances (inf)
+    """
+    n_rows = cand_idx.shape[0]
+    cand_dist = np.where((cand_idx < 0) | (cand_idx == np.arange(n_rows)[:, None]),
+                         np.inf, cand_dist)
+
+    # group repeated candidates of a row, closest first, and drop all but the first
+    order = np.argsort(cand_dist, axis=1, kind='stable')
+    cand_idx = np.take_along_axis(cand_idx, order, axis=1)
+    cand_dist = np.take_along_axis(cand_dist, order, axis=1)
+    order = np.argsort(cand_idx, axis=1, kind='stable')
+    cand_idx = np.take_along_axis(cand_idx, order, axis=1)
+    cand_dist = np.take_along_axis(cand_dist, order, axis=1)
+    cand_dist[:, 1:][cand_idx[:, 1:] == cand_idx[:, :-1]] = np.inf
+
+    order = np.argsort(cand_dist, axis=1, kind='stable')[:, :n_neighbors]
+    knn_idx = np.take_along_axis(cand_idx, order, axis=1)
+    knn_dist = np.take_along_axis(cand_dist, order, axis=1)
+    knn_idx[np.isinf(knn_dist)] = -1
+
+    return knn_idx, knn_dist
+
+
+def _nn_descent_step(rows, knn_idx, knn_dist):
+    """
+    _nn_descent_step: improve the neighbor lists with the neighbors of neighbors
+    """
+    n_rows, n_neighbors = knn_idx.shape
+    norms = rows.norms
+    neighbors = np.where(knn_idx < 0, np.arange(n_rows)[:, None], knn_idx)
+    candidates = neighbors[neighbors].reshape(n_rows, -1)
+
+    block_rows = max(1, CANDIDATE_BLOCK_FLOATS // (candidates.shape[1] * rows.row_floats))
+    cand_dist = np.empty(candidates.shape)
+    for start in range(0, n_rows, block_rows):
+        end = min(start + block_rows, n_rows)
+        block_candidates = candidates[start:end]
+        products = rows.pair_dots(np.repeat(np.arange(start, end), candidates.shape[1]),
+                                  block_candidates.ravel()).reshape(block_candidates.shape)
+        cand_dist[start:end] = norms[start:end, None] + norms[block_candidates] - 2 * products
+    np.maximum(cand_dist, 0, out=cand_dist)
+
+    return _top_k(np.hstack([knn_idx, candidates]), np.hstack([knn_dist, cand_dist]),
+                  n_neighbors)
+
+
+def knn_graph(values, metric='euclidean', n_neighbors=15, n_trees=8, leaf_size=None,
+              n_iters=2, random_state=None):
+    """
+    knn_graph: approximate k-nearest-neighbor graph of matrix rows
+
+    Candidates come from the leaves of a random projection forest of n_trees trees and are
+    refined with n_iters NN-descent steps (neighbors of neighbors). Cost is about
+    O(n_trees * n log n * d + n_iters * n * n_neighbors^2 * d) instead of O(n^2 * d).
+
+    values: (rows x columns) ndarray, CSR matrix or ChunkedDataMatrix; CSR and chunked rows
+            are only densified a block at a time (see _PreparedRows)
+    metric: one of KNN_METRIC
+
+    return (rows x n_neighbors) neighbor indices and distances, closest first (-1 / inf
+    where fewer than n_neighbors other rows exist)
+    """
+    if metric not in KNN_METRIC:
+        raise ValueError('Metric [{}] is not supported for kNN graphs. Available: {}'.format(
+                                                                        metric, KNN_METRIC))
+
+    rows = _PreparedRows(values, metric)
+
+    n_rows = rows.shape[0]
+    n_neighbors = min(n_neighbors, max(n_rows - 1, 1))
+    leaf_size = leaf_size or max(2 * n_neighbors, 32)
+    random_state = np.random.RandomState(random_state)
+
+    knn_idx = np.full((n_rows, n_neighbors), -1, dtype=np.int64)
+    knn_dist = np.full((n_rows, n_neighbors), np.inf)
+    for tree in range(n_trees):
+        tree_idx = np.full((n_rows, n_neighbors), -1, dtype=np.int64)
+        tree_dist = np.full((n_rows, n_neighbors), np.inf)
+        for leaf in _rp_tree_leaves(rows, leaf_size, random_state):
+            _leaf_neighbors(rows, leaf, n_neighbors, tree_idx, tree_dist)
+
+        knn_idx, knn_dist = _top_k(np.hstack([knn_idx, tree_idx]),
+                                   np.hstack([knn_dist, tree_dist]), n_neighbors)
+
+    for step in range(n_iters):
+        knn_idx, knn_dist = _nn_descent_step(rows, knn_idx, knn_dist)
+
+    return knn_idx, _from_euclidean(np.sqrt(knn_dist), metric)
+
+
+def _single_linkage(knn_idx, knn_dist):
+    """
+    _single_linkage: merges of single linkage on the kNN graph (Kruskal's algorithm)
+
+    return list of [node, node, height, size] and the union-find of the merged rows
+    """
+    n_rows = knn_idx.shape[0]
+    rows = np.repeat(np.arange(n_rows), knn_idx.shape[1])
+    cols, dists = knn_idx.ravel(), knn_dist.ravel()
+    found = cols >= 0
+
+    return kruskal_merges(rows[found], cols[found], dists[found], n_rows)
+
+
+def _average_linkage(knn_idx, knn_dist):
+    """
+    _average_linkage: merges of average linkage on the kNN graph
+
+    Clusters are merged by the mean of the graph distances between them (pairs without a
+    kNN edge are unknown and left out), closest first.
+
+    return list of [node, node, height, size] and the union-find of the merged rows
+    """
+    n_rows = knn_idx.shape[0]
+    # cluster root -> neighbor root -> [sum of distances, number of edges]
+    edges = [dict() for row in range(n_rows)]
+    for row, col, dist in zip(np.repeat(np.arange(n_rows), knn_idx.shape[1]).tolist(),
+                              knn_idx.ravel().tolist(), knn_dist.ravel().tolist()):
+        if col < 0 or col == row or col in edges[row]:
+            continue
+        edges[row][col] = [dist, 1]
+        edges[col][row] = [dist, 1]
+
+    heap = [(dist_sum / count, row, col) for row in range(n_rows)
+            for col, (dist_sum, count) in edges[row].items() if row < col]
+    heapq.heapify(heap)
+
+    sets = _UnionFind(n_rows)
+    merges = []
+    while heap:
+        dist, first, second = heapq.heappop(heap)
+        if (sets.parent[first] != first or sets.parent[second] != second or
+                second not in edges[first]):
+            # stale entry of a merged cluster
+            continue
+        dist_sum, count = edges[first][second]
+        if dist_sum / count != dist:
+            continue
+
+        first_node, second_node = sets.node[first], sets.node[second]
+        merged = sets.union(first, second, n_rows + len(merges))
+        other = second if merged == first else first
+        merges.append([min(first_node, second_node), max(first_node, second_node), dist,
+                       sets.size[merged]])
+
+        # fold the edges of the absorbed cluster into the merged one, only those
+        # averages change (heap entries of the other edges stay valid)
+        del edges[merged][other]
+        del edges[other][merged]
+        for neighbor, (other_sum, other_count) in edges[other].items():
+            del edges[neighbor][other]
+            edge = edges[merged].setdefault(neighbor, [0., 0])
+            edge[0] += other_sum
+            edge[1] += other_count
+            edges[neighbor][merged] = edge
+            heapq.heappush(heap, (edge[0] / edge[1], min(merged, neighbor),
+                                  max(merged, neighbor)))
+        edges[other] = {}
+
+    return merges, sets
+
+
+def knn_linkage(values, knn_idx, knn_dist, metric='euclidean', method='average'):
+    """
+    knn_linkage: linkage matrix of matrix rows from their kNN graph
+
+    values: (rows x columns) ndarray, CSR matrix or ChunkedDataMatrix, used to join
+            disconnected graph components (read a block of rows at a time)
+    method: one of KNN_METHOD
+
+    Components the graph leaves apart are joined last, by the given method on the
+    distances between their centroids (never below the highest graph merge).
+    """
+    if method not in KNN_METHOD:
+        raise ValueError('Linkage method [{}] is not supported for kNN graphs. '
+                         'Available: {}'.format(method, KNN_METHOD))
+
+    n_rows = knn_idx.shape[0]
+    if method == 'single':
+        merges, sets = _single_linkage(knn_idx, knn_dist)
+    else:
+        merges, sets = _average_linkage(knn_idx, knn_dist)
+
+    roots = sorted(set([sets.find(row) for row in range(n_rows)]))
+    if len(roots) > 1:
+        log('joining {} disconnected kNN graph components'.format(len(roots)))
+        root_pos = dict([(root, pos) for pos, root in enumerate(roots)])
+        component = np.array([root_pos[sets.find(row)] for row in range(n_rows)])
+
+        # centroids accumulated over row blocks (component indicator x rows)
+        centroids = np.zeros((len(roots), values.shape[1]))
+        block_rows = max(1, CANDIDATE_BLOCK_FLOATS // max(values.shape[1], 1))
+        for start, end, block in _iter_raw_blocks(values, block_rows):
+            indicator = sp.csr_matrix((np.ones(end - start),
+                                       (component[start:end], np.arange(end - start))),
+                                      shape=(len(roots), end - start))
+            block_sums = indicator.dot(block)
+            centroids += block_sums.toarray() if sp.issparse(block_sums) else block_sums
+        centroids /= np.bincount(component, minlength=len(roots))[:, None]
+        component_linkage = hier.linkage(pdist(np.nan_to_num(centroids), metric=metric),
+                                         method=method)
+        floor = max([merge[2] for merge in merges] or [0.])
+
+        nodes = [sets.node[root] for root in roots]
+        sizes = [sets.size[root] for root in roots]
+        for first, second, dist, size in component_linkage:
+            first_node, second_node = nodes[int(first)], nodes[int(second)]
+            nodes.append(n_rows + len(merges))
+            sizes.append(sizes[int(first)] + sizes[int(second)])
+            merges.append([min(first_node, second_node), max(first_node, second_node),
+                           max(dist, floor), sizes[-1]])
+
+    return np.array(merges, dtype=np.float64).reshape(-1, 4)
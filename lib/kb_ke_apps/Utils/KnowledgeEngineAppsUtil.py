@@ -3,8 +3,9 @@ import json
 import os
 import errno
 import uuid
-import sys
 import shutil
+import hashlib
+import requests
 import pandas as pd
 from matplotlib import pyplot as plt
 import numpy as np
@@ -20,7 +21,22 @@ from DataFileUtil.DataFileUtilClient import DataFileUtil
 from Workspace.WorkspaceClient import Workspace as Workspace
 from KBaseReport.KBaseReportClient import KBaseReport
 from SetAPI.SetAPIServiceClient import SetAPI
-from GenericsAPI.GenericsAPIClient import GenericsAPI
+from kb_ke_apps.Utils.MatrixUtil import DataMatrix, SparseDataMatrix
+from kb_ke_apps.Utils.SparseUtil import sparse_pca
+from kb_ke_apps.Utils.CacheUtil import MatrixCache, ArtifactCache, matrix_digest, artifact_key
+from kb_ke_apps.Utils.ChunkedUtil import write_matrix_rows, ChunkedDataMatrix, chunked_pca
+from kb_ke_apps.Utils.DistanceUtil import (DISTANCE_ENGINE, DEFAULT_MEMORY_BYTES,
+                                            calc_dist_matrix, distributed_pdist,
+                                            open_condensed, kmeans_condensed)
+from kb_ke_apps.Utils.NanUtil import has_nan, nan_pca
+from kb_ke_apps.Utils.LinkageUtil import (NN_CHAIN_METHOD, CENTROID_METHOD, mst_single_linkage,
+                                          nn_chain_linkage, centroid_linkage, tree_depth,
+                                          write_newick)
+from kb_ke_apps.Utils.KnnUtil import (KNN_METRIC, KNN_METHOD, dense_values, row_values,
+                                      knn_graph, knn_linkage)
+from kb_ke_apps.Utils.FilterUtil import (INVALID_DATA_ACTION, prune_invalid,
+                                          collapse_duplicate_rows, expand_duplicate_linkage,
+                                          VARIANCE_MEASURE, filter_by_variance)
 
 
 def log(message, prefix_newline=False):
@@ -39,6 +55,40 @@ class KnowledgeEngineAppsUtil:
 
     CRITERION = ["inconsistent", "distance", "maxclust"]
 
+    PRECISION = ["float64", "float32"]
+
+    # linkage methods and criteria for which clustering unique rows and expanding the
+    # duplicates back gives the same flat clusters as clustering every row
+    # (average and ward depend on cluster sizes, inconsistent on zero height merges)
+    DEDUP_METHOD = ["single", "complete", "weighted", "median"]
+    DEDUP_CRITERION = ["distance", "maxclust"]
+
+    # matrices with at least this fraction of zero cells are kept in sparse (CSR) form
+    SPARSE_ZERO_FRACTION = 0.9
+
+    # matrix objects larger than this (workspace object size) are fetched into a chunked
+    # on-disk store instead of memory
+    CHUNKED_MATRIX_MIN_BYTES = 2 * 1024 ** 3
+    # matrix cells parsed and written at a time when filling the chunked store
+    CHUNKED_FETCH_CELLS = 1000000
+
+    # rows per block and concurrent jobs of the distributed distance engine
+    DISTANCE_BLOCK_ROWS = 2000
+    DISTANCE_MAX_JOBS = 16
+
+    # neighbors per row of the approximate (kNN graph) linkage
+    N_NEIGHBORS = 15
+
+    # deepest tree drawn by the (recursive) plotly heatmap dendrograms, below the default
+    # interpreter recursion limit
+    HEATMAP_MAX_DEPTH = 800
+
+    # matrix object paths needed besides the numeric data
+    MATRIX_METADATA_PATHS = ['/genome_ref', '/row_mapping', '/col_mapping',
+                             '/row_conditionset_ref', '/col_conditionset_ref']
+
+    MATRIX_DATA_PATHS = ['/data/row_ids', '/data/col_ids', '/data/values']
+
     def _mkdir_p(self, path):
         """
         _mkdir_p: make directory for given path
@@ -53,6 +103,78 @@ class KnowledgeEngineAppsUtil:
             else:
                 raise
 
+    def _validate_matrix_params(self, params):
+        """
+        _validate_matrix_params: validates precision and invalid_data_action params
+        """
+
+        precision = params.get('precision')
+        if precision and precision not in self.PRECISION:
+            error_msg = 'INPUT ERROR:\nInput precision [{}] is not valid.\n'.format(precision)
+            error_msg += 'Available precision: {}'.format(self.PRECISION)
+            raise ValueError(error_msg)
+
+        invalid_data_action = params.get('invalid_data_action')
+        if invalid_data_action and invalid_data_action not in INVALID_DATA_ACTION:
+            error_msg = 'INPUT ERROR:\nInput invalid data action [{}] is not valid.\n'.format(
+                                                                        invalid_data_action)
+            error_msg += 'Available invalid data action: {}'.format(INVALID_DATA_ACTION)
+            raise ValueError(error_msg)
+
+    def _validate_positive_int(self, params, key, is_list=False):
+        """
+        _validate_positive_int: validates an optional positive integer param (or, with
+                                is_list, a list of positive integers)
+        """
+
+        value = params.get(key)
+        if value is None:
+            return
+
+        def is_positive_int(item):
+            try:
+                return int(item) == float(item) and int(item) > 0
+            except (TypeError, ValueError, OverflowError):
+                return False
+
+        if is_list:
+            valid = isinstance(value, list) and all([is_positive_int(item) for item in value])
+        else:
+            valid = is_positive_int(value)
+
+        if not valid:
+            error_msg = 'INPUT ERROR:\nInput {} [{}] is not valid.\n'.format(key, value)
+            error_msg += '{} must be {}'.format(key, 'a list of positive integers' if is_list
+                                                else 'a positive integer')
+            raise ValueError(error_msg)
+
+    def _validate_variance_filter_params(self, params):
+        """
+        _validate_variance_filter_params:
+            validates top_n_by_variance, min_variance and variance_measure params
+        """
+
+        self._validate_positive_int(params, 'top_n_by_variance')
+
+        min_variance = params.get('min_variance')
+        if min_variance is not None:
+            try:
+                valid = float(min_variance) >= 0
+            except (TypeError, ValueError):
+                valid = False
+            if not valid:
+                error_msg = 'INPUT ERROR:\nInput min_variance [{}] is not valid.\n'.format(
+                                                                                    min_variance)
+                error_msg += 'min_variance must be a non-negative number'
+                raise ValueError(error_msg)
+
+        variance_measure = params.get('variance_measure')
+        if variance_measure and variance_measure not in VARIANCE_MEASURE:
+            error_msg = 'INPUT ERROR:\nInput variance measure [{}] is not valid.\n'.format(
+                                                                            variance_measure)
+            error_msg += 'Available variance measure: {}'.format(VARIANCE_MEASURE)
+            raise ValueError(error_msg)
+
     def _validate_run_pca_params(self, params):
         """
         _validate_run_pca_params:
@@ -66,6 +188,10 @@ class KnowledgeEngineAppsUtil:
             if p not in params:
                 raise ValueError('"{}" parameter is required, but missing'.format(p))
 
+        self._validate_matrix_params(params)
+
+        self._validate_variance_filter_params(params)
+
     def _validate_run_kmeans_cluster_params(self, params):
         """
         _validate_run_kmeans_cluster_params:
@@ -87,6 +213,11 @@ class KnowledgeEngineAppsUtil:
             error_msg += 'Available metric: {}'.format(self.METRIC)
             raise ValueError(error_msg)
 
+        self._validate_matrix_params(params)
+
+        self._validate_variance_filter_params(params)
+        self._validate_positive_int(params, 'n_jobs')
+
     def _validate_run_hierarchical_cluster_params(self, params):
         """
         _validate_run_hierarchical_cluster_params:
@@ -122,6 +253,263 @@ class KnowledgeEngineAppsUtil:
             error_msg += 'Available metric: {}'.format(self.CRITERION)
             raise ValueError(error_msg)
 
+        self._validate_matrix_params(params)
+
+        # check approximate (kNN graph) mode validation
+        if params.get('approximate'):
+            if method and method not in KNN_METHOD:
+                error_msg = 'INPUT ERROR:\nInput linkage algorithm [{}] is not valid '.format(
+                                                                                        method)
+                error_msg += 'for approximate mode.\n'
+                error_msg += 'Available method: {}'.format(KNN_METHOD)
+                raise ValueError(error_msg)
+
+            if metric and metric not in KNN_METRIC:
+                error_msg = 'INPUT ERROR:\nInput metric function [{}] is not valid '.format(
+                                                                                        metric)
+                error_msg += 'for approximate mode.\n'
+                error_msg += 'Available metric: {}'.format(KNN_METRIC)
+                raise ValueError(error_msg)
+
+        # check matrix-free (centroid) linkage validation
+        if params.get('matrix_free'):
+            if params.get('approximate'):
+                error_msg = 'INPUT ERROR:\nInput matrix_free and approximate are exclusive.\n'
+                error_msg += 'Select only one of them'
+                raise ValueError(error_msg)
+
+            if method and method not in CENTROID_METHOD:
+                error_msg = 'INPUT ERROR:\nInput linkage algorithm [{}] is not valid '.format(
+                                                                                        method)
+                error_msg += 'for matrix-free mode.\n'
+                error_msg += 'Available method: {}'.format(CENTROID_METHOD)
+                raise ValueError(error_msg)
+
+            if metric and metric != 'euclidean':
+                error_msg = 'INPUT ERROR:\nInput metric function [{}] is not valid '.format(
+                                                                                        metric)
+                error_msg += 'for matrix-free mode.\n'
+                error_msg += 'Available metric: {}'.format(['euclidean'])
+                raise ValueError(error_msg)
+
+        self._validate_positive_int(params, 'n_neighbors')
+
+        # check cutoff sweep validation
+        for axis in ['row', 'col']:
+            rates = params.get(axis + '_dist_cutoff_rates')
+            if rates is not None:
+                try:
+                    valid = isinstance(rates, list) and all([float(rate) >= 0
+                                                             for rate in rates])
+                except (TypeError, ValueError):
+                    valid = False
+                if not valid:
+                    error_msg = 'INPUT ERROR:\nInput {}_dist_cutoff_rates [{}] '.format(axis,
+                                                                                      rates)
+                    error_msg += 'is not valid.\n'
+                    error_msg += '{}_dist_cutoff_rates must be a list of non-negative '.format(
+                                                                                        axis)
+                    error_msg += 'numbers'
+                    raise ValueError(error_msg)
+
+            self._validate_positive_int(params, axis + '_maxclust', is_list=True)
+
+        self._validate_variance_filter_params(params)
+        self._validate_positive_int(params, 'n_jobs')
+
+    def _fetch_matrix_object(self, matrix_ref):
+        """
+        _fetch_matrix_object: fetch matrix object info and metadata (without data values)
+        """
+
+        matrix_object = self.ws.get_objects2({'objects': [{
+                                            'ref': matrix_ref,
+                                            'included': self.MATRIX_METADATA_PATHS}]})['data'][0]
+
+        return matrix_object['info'], matrix_object['data']
+
+    def _fetch_matrix(self, matrix_ref, matrix_info=None):
+        """
+        _fetch_matrix: fetch matrix as DataMatrix, reusing the on-disk matrix cache
+
+        matrix_info: workspace object info of matrix_ref (looked up if not given)
+        """
+
+        if matrix_info is None:
+            matrix_info = self.ws.get_object_info3({'objects': [{'ref': matrix_ref}]})['infos'][0]
+
+        # cache key must be a fully versioned X/Y/Z reference
+        versioned_ref = str(matrix_info[6]) + '/' + str(matrix_info[0]) + '/' + str(
+                                                                                matrix_info[4])
+
+        if matrix_info[9] > self.chunked_matrix_min_bytes:
+            return self._fetch_chunked_matrix(versioned_ref)
+
+        matrix = self.matrix_cache.get(versioned_ref)
+
+        if matrix is None:
+            log('fetching matrix data for {}'.format(versioned_ref))
+            matrix_object = self.ws.get_objects2({'objects': [{
+                                            'ref': versioned_ref,
+                                            'included': self.MATRIX_DATA_PATHS}]})['data'][0]
+            matrix_data = matrix_object['data']['data']
+            # missing values need the dense NaN-aware path, zeros would impute them
+            if (not SparseDataMatrix.has_missing(matrix_data) and
+                    SparseDataMatrix.zero_fraction(matrix_data) >= self.SPARSE_ZERO_FRACTION):
+                log('matrix is mostly zeros, building sparse matrix')
+                matrix = SparseDataMatrix.from_matrix_data(matrix_data)
+            else:
+                matrix = DataMatrix.from_matrix_data(matrix_data)
+            matrix = self.matrix_cache.put(versioned_ref, matrix)
+
+        return matrix
+
+    def _fetch_chunked_matrix(self, versioned_ref):
+        """
+        _fetch_chunked_matrix: fetch matrix into a column-blocked on-disk store in scratch
+
+        the values are fetched with a single workspace call whose response is streamed and
+        parsed a batch of rows at a time into the store, so neither the workspace response
+        nor the array has to fit in memory at once; the store (and every store derived from
+        it) lives in this run's matrix_store_dir and is deleted at the end of the run (see
+        _remove_matrix_stores)
+        """
+
+        store_dir = os.path.join(self.matrix_store_dir,
+                                 hashlib.sha1(versioned_ref.encode('utf-8')).hexdigest())
+
+        log('fetching matrix data for {} into chunked store'.format(versioned_ref))
+        labels = self.ws.get_objects2({'objects': [{
+                                'ref': versioned_ref,
+                                'included': ['/data/row_ids', '/data/col_ids']}]})['data'][0]
+        row_ids = labels['data']['data']['row_ids']
+        col_ids = labels['data']['data']['col_ids']
+
+        batch_rows = max(1, self.CHUNKED_FETCH_CELLS // max(len(col_ids), 1))
+        response = self._stream_ws_objects({'objects': [{'ref': versioned_ref,
+                                                         'included': ['/data/values']}]})
+        try:
+            return write_matrix_rows(response.raw, store_dir, row_ids, col_ids, batch_rows)
+        finally:
+            response.close()
+
+    def _stream_ws_objects(self, params):
+        """
+        _stream_ws_objects: call Workspace.get_objects2 and return the open HTTP response,
+                            whose body is read as a stream instead of being loaded at once
+        """
+
+        body = json.dumps({'method': 'Workspace.get_objects2',
+                           'params': [params],
+                           'version': '1.1',
+                           'id': str(uuid.uuid4())})
+        response = requests.post(self.ws_url, data=body, headers={'AUTHORIZATION': self.token},
+                                 stream=True)
+        if response.status_code != 200:
+            error_msg = 'Workspace get_objects2 failed with status {}: {}'.format(
+                                                    response.status_code, response.text[:1000])
+            response.close()
+            raise ValueError(error_msg)
+
+        # transparently decompress a gzip encoded body
+        response.raw.decode_content = True
+
+        return response
+
+    def _release_replaced(self, matrix, replaced):
+        """
+        _release_replaced: delete the on-disk store of a chunked matrix once a matrix derived
+                           from it (cast, dropped or filtered copy) replaced it
+
+        return matrix
+        """
+
+        if (isinstance(replaced, ChunkedDataMatrix) and
+                getattr(matrix, 'store_dir', None) != replaced.store_dir):
+            log('removing replaced chunked matrix store {}'.format(replaced.store_dir))
+            replaced.remove()
+
+        return matrix
+
+    def _remove_matrix_stores(self):
+        """
+        _remove_matrix_stores: delete every chunked matrix store written during this run
+        """
+
+        if os.path.isdir(self.matrix_store_dir):
+            log('removing chunked matrix stores of this run')
+            shutil.rmtree(self.matrix_store_dir, ignore_errors=True)
+
+    def _set_precision(self, matrix, precision):
+        """
+        _set_precision: cast matrix to the requested compute precision
+
+        float32 halves the memory of every downstream copy; the maximum deviation from the
+        float64 values is logged. Linkage updates are computed in float64, but heights read
+        from a float32 distance matrix keep float32 precision.
+        """
+
+        if not precision or precision == 'float64':
+            return matrix
+
+        log('casting matrix to {}'.format(precision))
+        single_matrix = matrix.astype(precision)
+
+        if isinstance(matrix, ChunkedDataMatrix):
+            return self._release_replaced(single_matrix, matrix)
+
+        if isinstance(matrix, SparseDataMatrix):
+            deviation = np.abs(single_matrix.values.data - matrix.values.data)
+        else:
+            deviation = np.abs(single_matrix.values - matrix.values)
+        deviation = np.max(deviation[np.isfinite(deviation)], initial=0)
+        log('max deviation from float64 matrix: {}'.format(deviation))
+
+        return single_matrix
+
+    def _prune_matrix(self, matrix, invalid_data_action):
+        """
+        _prune_matrix: pre-flight check for all-NaN, constant and non-finite rows and columns
+
+        runs before any distance computation or remote call, so bad input fails in
+        milliseconds instead of after the O(n^2) stages
+        """
+
+        log('checking matrix {} for invalid rows and columns'.format(matrix.shape))
+        pruned_matrix, _ = prune_invalid(matrix, invalid_data_action or 'keep')
+
+        return self._release_replaced(pruned_matrix, matrix)
+
+    def _filter_by_variance(self, matrix, params):
+        """
+        _filter_by_variance: keep the most variable rows before distance, kmeans or PCA
+
+        return filtered matrix and variance filter entries for clustering_parameters
+        (empty if no filter was requested)
+        """
+
+        top_n = params.get('top_n_by_variance')
+        min_variance = params.get('min_variance')
+        if top_n is None and min_variance is None:
+            return matrix, {}
+
+        variance_measure = params.get('variance_measure') or 'variance'
+        filtered_matrix, kept_row_ids = filter_by_variance(
+                                matrix,
+                                top_n=int(top_n) if top_n is not None else None,
+                                min_variance=float(min_variance) if min_variance is not None
+                                else None,
+                                measure=variance_measure)
+
+        filter_parameters = {'variance_measure': variance_measure,
+                             'kept_row_ids': json.dumps(kept_row_ids)}
+        if top_n is not None:
+            filter_parameters['top_n_by_variance'] = str(int(top_n))
+        if min_variance is not None:
+            filter_parameters['min_variance'] = str(float(min_variance))
+
+        return self._release_replaced(filtered_matrix, matrix), filter_parameters
+
     def _gen_clusters(self, clusters, conditionset_mapping):
         clusters_list = list()
 
@@ -136,17 +524,14 @@ class KnowledgeEngineAppsUtil:
 
         return clusters_list
 
-    def _gen_hierarchical_clusters(self, clusters, conditionset_mapping, data_matrix):
+    def _gen_hierarchical_clusters(self, clusters, conditionset_mapping, matrix):
         clusters_list = list()
 
-        df = pd.read_json(data_matrix)
-        index = df.index.tolist()
-
         for cluster in list(clusters.values()):
             labeled_cluster = {}
             id_to_data_position = {}
             for item in cluster:
-                id_to_data_position.update({item: index.index(item)})
+                id_to_data_position.update({item: matrix.row_index[item]})
 
             labeled_cluster.update({'id_to_data_position': id_to_data_position})
             if conditionset_mapping:
@@ -159,7 +544,7 @@ class KnowledgeEngineAppsUtil:
 
     def _build_hierarchical_cluster_set(self, clusters, cluster_set_name, genome_ref, matrix_ref,
                                         conditionset_mapping, conditionset_ref, workspace_name,
-                                        clustering_parameters, data_matrix):
+                                        clustering_parameters, matrix):
 
         """
         _build_kmeans_cluster_set: build KBaseExperiments.ClusterSet object
@@ -172,8 +557,7 @@ class KnowledgeEngineAppsUtil:
         else:
             workspace_id = self.dfu.ws_name_to_id(workspace_name)
 
-        clusters_list = self._gen_hierarchical_clusters(clusters, conditionset_mapping,
-                                                        data_matrix)
+        clusters_list = self._gen_hierarchical_clusters(clusters, conditionset_mapping, matrix)
 
         cluster_set_data = {'clusters': clusters_list,
                             'clustering_parameters': clustering_parameters,
@@ -390,6 +774,7 @@ class KnowledgeEngineAppsUtil:
         return html_report
 
     def _generate_hierarchical_cluster_report(self, cluster_set_refs, workspace_name,
+                                              row_newick, col_newick,
                                               row_dendrogram_path,
                                               row_dendrogram_truncate_path,
                                               col_dendrogram_path,
@@ -414,9 +799,19 @@ class KnowledgeEngineAppsUtil:
             objects_created.append({'ref': cluster_set_ref,
                                     'description': 'Hierarchical ClusterSet'})
 
+        output_files = []
+        for newick, axis in [(row_newick, 'row'), (col_newick, 'column')]:
+            if newick:
+                output_files.append({'path': newick,
+                                     'name': '{}_tree.nwk'.format(axis),
+                                     'label': '{}_tree.nwk'.format(axis),
+                                     'description': 'Newick tree of the {} clustering'.format(
+                                                                                        axis)})
+
         report_params = {'message': '',
                          'workspace_name': workspace_name,
                          'objects_created': objects_created,
+                         'file_links': output_files,
                          'html_links': output_html_files,
                          'direct_html_link_index': 0,
                          'html_window_height': 333,
@@ -613,48 +1008,323 @@ class KnowledgeEngineAppsUtil:
 
         return float_matrix_ref, pca_matrix_data
 
-    def _build_flat_cluster(self, data_matrix, dist_cutoff_rate,
-                            dist_metric=None, linkage_method=None, fcluster_criterion=None):
+    def _calc_dist_matrix(self, matrix, dist_metric=None, n_jobs=1, digest=None):
         """
-        _build_cluster: build flat clusters and dendrogram for data_matrix
+        _calc_dist_matrix: condensed distance matrix between matrix rows, looked up in the
+                           artifact cache by matrix content and metric before computing it
+
+        digest: matrix_digest of matrix, if already known
+
+        return dist_matrix (condensed, numpy array or memmap) and the row labels
         """
 
-        log('start building clusters')
-        # calculate distance matrix
-        log('calculating distance matrix')
-        pdist_params = {'data_matrix': data_matrix,
+        key = artifact_key('distance', digest or matrix_digest(matrix),
+                           metric=dist_metric or 'euclidean')
+        cached = self.artifact_cache.get(key)
+        if cached:
+            return cached[0], cached[1]['labels']
+
+        dist_matrix, labels = self._compute_dist_matrix(matrix, dist_metric=dist_metric,
+                                                        n_jobs=n_jobs)
+
+        if isinstance(dist_matrix, np.memmap):
+            # move the scratch file into the cache instead of copying it
+            dist_matrix.flush()
+            cached = self.artifact_cache.put_file(key, dist_matrix.filename,
+                                                  meta={'labels': labels})
+        else:
+            cached = self.artifact_cache.put(key, dist_matrix, meta={'labels': labels})
+
+        return (cached[0], labels) if cached else (dist_matrix, labels)
+
+    def _compute_dist_matrix(self, matrix, dist_metric=None, n_jobs=1):
+        """
+        _compute_dist_matrix: calculate condensed distance matrix between matrix rows
+
+        distances are computed in-process, one block of rows within the distance memory
+        budget at a time, straight into a memory mapped file in scratch; kb_ke_util.run_pdist
+        is used when the distance engine is set to remote or the metric is not available
+        locally; the distributed engine runs one run_pdist job per block of rows and pair of
+        blocks and assembles the result in the same memory mapped file
+
+        n_jobs: number of local worker processes
+
+        return dist_matrix (condensed, numpy array or memmap) and the row labels
+        """
+
+        if self.distance_engine == 'distributed':
+            dist_file = os.path.join(self.scratch, 'dist_matrix_' + str(uuid.uuid4()) + '.npy')
+            log('calculating distance matrix with distributed run_pdist jobs')
+            dist_matrix = distributed_pdist(matrix, dist_metric, self.ke_util,
+                                            block_rows=self.distance_block_rows,
+                                            max_jobs=self.distance_max_jobs,
+                                            out=open_condensed(dist_file, matrix.shape[0]))
+            return dist_matrix, matrix.row_ids.tolist()
+
+        if self.distance_engine == 'local':
+            dist_file = os.path.join(self.scratch, 'dist_matrix_' + str(uuid.uuid4()) + '.npy')
+            try:
+                log('calculating distance matrix locally')
+                dist_matrix = calc_dist_matrix(matrix, metric=dist_metric, out_path=dist_file,
+                                               memory_bytes=self.distance_memory_bytes,
+                                               n_jobs=n_jobs)
+                return dist_matrix, matrix.row_ids.tolist()
+            except ValueError as e:
+                log('local distance calculation failed ({}), falling back to run_pdist'.format(e))
+                self._release_dist_matrix(dist_file)
+
+        pdist_params = {'data_matrix': matrix.to_json(),
                         'metric': dist_metric}
         pdist_ret = self.ke_util.run_pdist(pdist_params)
 
-        dist_matrix = pdist_ret['dist_matrix']
-        labels = pdist_ret['labels']
+        return np.asarray(pdist_ret['dist_matrix'], dtype=float), pdist_ret['labels']
+
+    def _release_dist_matrix(self, dist_matrix):
+        """
+        _release_dist_matrix: remove the scratch file behind a memory mapped distance matrix
+
+        dist_matrix: distance matrix returned by _calc_dist_matrix or its file path
+        """
+        dist_file = getattr(dist_matrix, 'filename', dist_matrix)
+        # artifact cache entries are left to the cache
+        if (isinstance(dist_file, str) and os.path.isfile(dist_file) and
+                os.path.basename(dist_file).startswith('dist_matrix_')):
+            os.remove(dist_file)
+
+    def _run_linkage(self, dist_matrix, linkage_method=None):
+        """
+        _run_linkage: hierarchical/agglomerative clustering of a condensed distance matrix
+
+        reducible methods run the nearest-neighbor chain on the condensed buffer in place,
+        centroid and median use scipy (which works on a copy)
+        """
+
+        if self.distance_engine != 'remote':
+            linkage_method = linkage_method or 'ward'
+            if linkage_method in NN_CHAIN_METHOD:
+                return nn_chain_linkage(dist_matrix, method=linkage_method,
+                                        scratch_dir=self.scratch)
+            return hier.linkage(dist_matrix, method=linkage_method)
 
-        # performs hierarchical/agglomerative clustering
-        log('performing hierarchical/agglomerative clustering')
-        linkage_params = {'dist_matrix': dist_matrix,
+        linkage_params = {'dist_matrix': dist_matrix.tolist(),
                           'method': linkage_method}
         linkage_ret = self.ke_util.run_linkage(linkage_params)
 
-        linkage_matrix = linkage_ret['linkage_matrix']
+        return np.asarray(linkage_ret['linkage_matrix'], dtype=float)
 
-        # newick = self.ke_util.linkage_2_newick({'linkage_matrix': linkage_matrix,
-        #                                         'labels': labels})['newick']
+    def _run_fcluster(self, linkage_matrix, dist_threshold, labels, fcluster_criterion=None):
+        """
+        _run_fcluster: form flat clusters from linkage matrix
 
-        newick = None
+        return flat_cluster: cluster id -> list of labels
+        """
 
-        height = max([item[2] for item in linkage_matrix])
-        dist_threshold = height * dist_cutoff_rate
-        log('Height: {} Setting dist_threshold: {}'.format(height, dist_threshold))
-        merges = len(linkage_matrix)
+        if self.distance_engine != 'remote':
+            flat_cluster = {}
+            cluster_ids = hier.fcluster(linkage_matrix, dist_threshold,
+                                        criterion=fcluster_criterion or 'distance')
+            for label, cluster_id in zip(labels, cluster_ids):
+                flat_cluster.setdefault(str(cluster_id), []).append(label)
 
-        # generate flat clusters
-        fcluster_params = {'linkage_matrix': linkage_matrix,
+            return flat_cluster
+
+        fcluster_params = {'linkage_matrix': linkage_matrix.tolist(),
                            'dist_threshold': dist_threshold,
                            'labels': labels,
                            'criterion': fcluster_criterion}
         fcluster_ret = self.ke_util.run_fcluster(fcluster_params)
 
-        flat_cluster = fcluster_ret['flat_cluster']
+        return fcluster_ret['flat_cluster']
+
+    def _build_linkage(self, matrix, dist_metric=None, linkage_method=None,
+                       fcluster_criterion=None, collapse_duplicates=False, n_jobs=1,
+                       matrix_free=False):
+        """
+        _build_linkage: distance matrix and linkage of matrix rows
+
+        computed once per axis and shared by the heatmap, dendrogram and flat cluster stages;
+        linkage and distances are kept in the artifact cache, so a rerun with other cutoff
+        rates or another linkage method skips the distance computation; single linkage of
+        dense matrices is built from a streamed minimum spanning tree on the local engine,
+        without any distance matrix
+
+        matrix_free: build euclidean ward, centroid or median linkage from cluster centroids
+                     (see LinkageUtil.centroid_linkage), without any distance matrix
+        collapse_duplicates: compute the linkage of unique rows only and expand it back to
+                             every row (duplicates merge at height 0)
+
+        return linkage_matrix (numpy array) and the row labels (leaves of linkage_matrix)
+        """
+
+        if collapse_duplicates and not ((linkage_method or 'ward') in self.DEDUP_METHOD and
+                                        (fcluster_criterion or 'distance') in
+                                        self.DEDUP_CRITERION):
+            log('skip collapsing duplicate rows for linkage method [{}] and criterion '
+                '[{}]'.format(linkage_method, fcluster_criterion))
+            collapse_duplicates = False
+
+        digest = matrix_digest(matrix)
+        key = artifact_key('linkage', digest, metric=dist_metric or 'euclidean',
+                           method=linkage_method or 'ward',
+                           collapse_duplicates=collapse_duplicates)
+        cached = self.artifact_cache.get(key)
+        if cached:
+            return cached[0], cached[1]['labels']
+
+        duplicates = {}
+        unique_matrix = matrix
+        if collapse_duplicates:
+            unique_matrix, duplicates = collapse_duplicate_rows(matrix)
+            if unique_matrix.shape[0] < 2:
+                unique_matrix, duplicates = matrix, {}
+
+        linkage_matrix = None
+        if matrix_free and isinstance(unique_matrix, ChunkedDataMatrix):
+            log('skip matrix-free linkage for chunked matrix')
+        elif matrix_free:
+            # the linkage is the one of the distance matrix, only centroids are kept
+            try:
+                log('performing matrix-free {} linkage clustering on cluster centroids'.format(
+                                                                    linkage_method or 'ward'))
+                linkage_matrix = centroid_linkage(dense_values(unique_matrix),
+                                                  method=linkage_method or 'ward')
+                labels = unique_matrix.row_ids.tolist()
+            except ValueError as e:
+                log('matrix-free linkage failed ({}), using the distance matrix'.format(e))
+        elif (linkage_method == 'single' and self.distance_engine == 'local' and
+                not isinstance(unique_matrix, (SparseDataMatrix, ChunkedDataMatrix))):
+            # single linkage is the minimum spanning tree, no distance matrix needed
+            try:
+                log('performing single linkage clustering on a streamed minimum spanning tree')
+                linkage_matrix = mst_single_linkage(unique_matrix.values,
+                                                    metric=dist_metric or 'euclidean')
+                labels = unique_matrix.row_ids.tolist()
+            except ValueError as e:
+                log('minimum spanning tree failed ({}), using the distance matrix'.format(e))
+
+        if linkage_matrix is None:
+            # calculate distance matrix
+            log('calculating distance matrix')
+            dist_matrix, labels = self._calc_dist_matrix(unique_matrix,
+                                                         dist_metric=dist_metric,
+                                                         n_jobs=n_jobs,
+                                                         digest=None if duplicates else digest)
+
+            # performs hierarchical/agglomerative clustering
+            log('performing hierarchical/agglomerative clustering')
+            linkage_matrix = self._run_linkage(dist_matrix, linkage_method=linkage_method)
+            self._release_dist_matrix(dist_matrix)
+
+        # the unique rows are only needed for the linkage
+        self._release_replaced(matrix, unique_matrix)
+
+        if duplicates:
+            row_ids = matrix.row_ids.tolist()
+            linkage_matrix = expand_duplicate_linkage(linkage_matrix, labels, duplicates,
+                                                      row_ids)
+            labels = row_ids
+
+        linkage_matrix, _ = self.artifact_cache.put(key, linkage_matrix,
+                                                    meta={'labels': labels})
+
+        return linkage_matrix, labels
+
+    def _build_knn_linkage(self, matrix, dist_metric=None, linkage_method=None,
+                           n_neighbors=N_NEIGHBORS):
+        """
+        _build_knn_linkage: approximate linkage of matrix rows from their kNN graph
+
+        never builds the full distance matrix; the linkage is kept in the artifact cache
+
+        return linkage_matrix (numpy array) and the row labels (leaves of linkage_matrix)
+        """
+        dist_metric = dist_metric or 'euclidean'
+        linkage_method = linkage_method or 'average'
+
+        key = artifact_key('knn_linkage', matrix_digest(matrix), metric=dist_metric,
+                           method=linkage_method, n_neighbors=n_neighbors)
+        cached = self.artifact_cache.get(key)
+        if cached:
+            return cached[0], cached[1]['labels']
+
+        # sparse matrices stay CSR, chunked stores are read a block of rows at a time
+        values = row_values(matrix)
+
+        log('building approximate {}-nearest-neighbor graph'.format(n_neighbors))
+        knn_idx, knn_dist = knn_graph(values, metric=dist_metric, n_neighbors=n_neighbors,
+                                      random_state=0)
+
+        log('performing hierarchical/agglomerative clustering on kNN graph')
+        linkage_matrix = knn_linkage(values, knn_idx, knn_dist, metric=dist_metric,
+                                     method=linkage_method)
+
+        labels = matrix.row_ids.tolist()
+        linkage_matrix, _ = self.artifact_cache.put(key, linkage_matrix,
+                                                    meta={'labels': labels})
+
+        return linkage_matrix, labels
+
+    def _cluster_cuts(self, params, axis):
+        """
+        _cluster_cuts: flat cluster thresholds of an axis ('row' or 'col')
+
+        return list of ('dist_cutoff_rate', rate) and ('maxclust', count)
+        """
+        rates = params.get(axis + '_dist_cutoff_rates') or []
+        maxclust = params.get(axis + '_maxclust') or []
+        # the default rate only applies when no cluster counts are asked for
+        if not rates and (not maxclust or axis + '_dist_cutoff_rate' in params):
+            rates = [params.get(axis + '_dist_cutoff_rate', 0.5)]
+
+        cuts = [('dist_cutoff_rate', float(rate)) for rate in rates]
+        cuts += [('maxclust', int(k)) for k in maxclust]
+
+        return cuts
+
+    def _build_flat_cluster(self, linkage_matrix, labels, cuts, fcluster_criterion=None):
+        """
+        _build_cluster: build flat clusters and dendrogram from the linkage of matrix rows
+
+        cuts: thresholds as returned by _cluster_cuts, the (cheap) fcluster step runs once
+              per cut on the same linkage; the dendrogram marks the first cut
+
+        return flat clusters (one per cut), labels, newick file and dendrogram paths
+        """
+
+        log('start building clusters')
+
+        # tree written iteratively, any tree depth without a raised recursion limit
+        log('writing newick tree')
+        newick_directory = os.path.join(self.scratch, str(uuid.uuid4()))
+        self._mkdir_p(newick_directory)
+        newick = os.path.join(newick_directory, 'tree.nwk')
+        with open(newick, 'w') as newick_file:
+            write_newick(linkage_matrix, labels, newick_file)
+
+        height = float(linkage_matrix[:, 2].max())
+        merges = len(linkage_matrix)
+
+        # generate flat clusters
+        flat_clusters = []
+        dist_threshold = None
+        for cut_type, cut in cuts:
+            if cut_type == 'maxclust':
+                log('Forming at most {} clusters'.format(cut))
+                flat_cluster = self._run_fcluster(linkage_matrix, cut, labels,
+                                                  fcluster_criterion='maxclust')
+                # dendrogram line at the last merge kept
+                threshold = float(linkage_matrix[max(merges - cut, 0), 2])
+            else:
+                threshold = height * cut
+                log('Height: {} Setting dist_threshold: {}'.format(height, threshold))
+                flat_cluster = self._run_fcluster(linkage_matrix, threshold, labels,
+                                                  fcluster_criterion=fcluster_criterion)
+            flat_clusters.append(flat_cluster)
+            if dist_threshold is None:
+                dist_threshold = threshold
+
+        # dendrogram plots are rendered by kb_ke_util
+        linkage_matrix = linkage_matrix.tolist()
 
         # generate dendrogram
         try:
@@ -685,9 +1355,9 @@ class KnowledgeEngineAppsUtil:
         else:
             dendrogram_truncate_path = None
 
-        return flat_cluster, labels, newick, dendrogram_path, dendrogram_truncate_path
+        return flat_clusters, labels, newick, dendrogram_path, dendrogram_truncate_path
 
-    def _build_kmeans_cluster(self, data_matrix, k_num, dist_metric=None):
+    def _build_kmeans_cluster(self, matrix, k_num, dist_metric=None, n_jobs=1):
         """
         _build_kmeans_cluster: Build Kmeans cluster
         """
@@ -696,24 +1366,26 @@ class KnowledgeEngineAppsUtil:
 
         # calculate distance matrix
         log('calculating distance matrix')
-        pdist_params = {'data_matrix': data_matrix,
-                        'metric': dist_metric}
-        pdist_ret = self.ke_util.run_pdist(pdist_params)
-
-        dist_matrix = pdist_ret['dist_matrix']
-        labels = pdist_ret['labels']
+        dist_matrix, labels = self._calc_dist_matrix(matrix, dist_metric=dist_metric,
+                                                     n_jobs=n_jobs)
 
         # run kmeans algorithm
         log('performing kmeans algorithm')
-        kmeans_params = {'dist_matrix': dist_matrix,
-                         'k_num': k_num}
-        kmeans_ret = self.ke_util.run_kmeans2(kmeans_params)
+        if self.distance_engine != 'remote':
+            # in-process on the condensed buffer, no json round trip of the distances
+            centroid, idx = kmeans_condensed(dist_matrix, k_num)
+            idx = idx.tolist()
+            self._release_dist_matrix(dist_matrix)
+        else:
+            kmeans_params = {'dist_matrix': dist_matrix.tolist(),
+                             'k_num': k_num}
+            self._release_dist_matrix(dist_matrix)
+            kmeans_ret = self.ke_util.run_kmeans2(kmeans_params)
 
-        centroid = kmeans_ret.get('kmeans_ret')
-        idx = kmeans_ret.get('idx')
+            centroid = kmeans_ret.get('kmeans_ret')
+            idx = kmeans_ret.get('idx')
 
-        df = pd.read_json(data_matrix)
-        rows = df.index.tolist()
+        rows = matrix.row_ids
 
         clusters = {}
         for list_index, value in enumerate(idx):
@@ -725,9 +1397,9 @@ class KnowledgeEngineAppsUtil:
 
         return clusters
 
-    def _build_clustermap(self, data_matrix, metric, method):
+    def _build_clustermap(self, matrix, row_linkage, row_labels, col_linkage, col_labels):
         """
-        plot cluster heatmap
+        plot cluster heatmap from the precomputed row and column linkage
         https://seaborn.pydata.org/generated/seaborn.clustermap.html
         """
         log('start building seaborn clustermap')
@@ -735,15 +1407,19 @@ class KnowledgeEngineAppsUtil:
         self._mkdir_p(output_directory)
         plot_file = os.path.join(output_directory, 'clustermap.png')
 
-        df = pd.read_json(data_matrix)
-        df.fillna(0, inplace=True)
+        # missing values stay NaN (blank cells)
+        df = matrix.to_dataframe().loc[row_labels, col_labels]
 
-        sns_plot = sns.clustermap(df, method=method, metric=metric)
+        sns_plot = sns.clustermap(df, row_linkage=row_linkage, col_linkage=col_linkage)
         sns_plot.savefig(plot_file)
 
         return plot_file
 
-    def _build_plotly_clustermap(self, data_matrix, dist_metric, linkage_method):
+    def _build_plotly_clustermap(self, matrix, row_linkage, row_labels, col_linkage,
+                                 col_labels):
+        """
+        plot cluster heatmap from the precomputed row and column linkage
+        """
 
         log('start building plotly page')
 
@@ -751,25 +1427,23 @@ class KnowledgeEngineAppsUtil:
         self._mkdir_p(output_directory)
         plot_file = os.path.join(output_directory, 'clustermap.html')
 
-        df = pd.read_json(data_matrix)
-        df.fillna(0, inplace=True)
+        # missing values stay NaN (blank cells)
+        df = matrix.to_dataframe().loc[row_labels, col_labels]
 
         # Initialize figure by creating upper dendrogram
+        # (distfun skips the distance computation, the linkage is already known)
         log('initializing upper dendrogram')
         figure = ff.create_dendrogram(df.T, orientation='bottom', labels=df.T.index,
-                                      linkagefun=lambda x: hier.linkage(df.T.values,
-                                                                        method=linkage_method,
-                                                                        metric=dist_metric))
+                                      distfun=lambda x: None,
+                                      linkagefun=lambda x: col_linkage)
         for i in range(len(figure['data'])):
             figure['data'][i]['yaxis'] = 'y2'
 
         # Create Side Dendrogram
         log('creating side dendrogram')
         dendro_side = ff.create_dendrogram(df, orientation='right', labels=df.index,
-                                           linkagefun=lambda x: hier.linkage(
-                                                                        df.values,
-                                                                        method=linkage_method,
-                                                                        metric=dist_metric))
+                                           distfun=lambda x: None,
+                                           linkagefun=lambda x: row_linkage)
         for i in range(len(dendro_side['data'])):
             dendro_side['data'][i]['xaxis'] = 'x2'
 
@@ -846,13 +1520,31 @@ class KnowledgeEngineAppsUtil:
         self.scratch = config['scratch']
         self.dfu = DataFileUtil(self.callback_url)
         self.ke_util = kb_ke_util(self.callback_url, service_ver="dev")
-        self.gen_api = GenericsAPI(self.callback_url, service_ver="dev")
 
         self.ws = Workspace(self.ws_url, token=self.token)
         self.set_client = SetAPI(self.srv_wiz_url)
 
+        # chunked matrix stores of this run, deleted when the run ends
+        self.matrix_store_dir = os.path.join(self.scratch, 'matrix_store', str(uuid.uuid4()))
+        self.matrix_cache = MatrixCache(os.path.join(self.scratch, 'matrix_cache'),
+                                        max_bytes=config.get('matrix-cache-max-bytes',
+                                                             MatrixCache.DEFAULT_MAX_BYTES))
+        self.artifact_cache = ArtifactCache(os.path.join(self.scratch, 'artifact_cache'),
+                                            max_bytes=config.get('artifact-cache-max-bytes',
+                                                                 ArtifactCache.DEFAULT_MAX_BYTES))
+        self.chunked_matrix_min_bytes = int(config.get('chunked-matrix-min-bytes',
+                                                       self.CHUNKED_MATRIX_MIN_BYTES))
+        self.distance_engine = config.get('distance-engine', 'local')
+        if self.distance_engine not in DISTANCE_ENGINE:
+            raise ValueError('distance-engine [{}] is not valid. Available: {}'.format(
+                                                    self.distance_engine, DISTANCE_ENGINE))
+        self.distance_memory_bytes = int(config.get('distance-memory-bytes',
+                                                    DEFAULT_MEMORY_BYTES))
+        self.distance_block_rows = int(config.get('distance-block-rows',
+                                                  self.DISTANCE_BLOCK_ROWS))
+        self.distance_max_jobs = int(config.get('distance-max-jobs', self.DISTANCE_MAX_JOBS))
+
         plt.switch_backend('agg')
-        sys.setrecursionlimit(150000)
 
     def run_pca(self, params):
         """
@@ -862,6 +1554,12 @@ class KnowledgeEngineAppsUtil:
         workspace_name: the name of the workspace
         pca_matrix_name: name of PCA (KBaseFeatureValues.FloatMatrix2D) object
         n_components - number of components (default 2)
+        precision - compute precision, "float64" (default) or "float32"
+        invalid_data_action - all-NaN, constant or non-finite rows and columns are
+                              "keep" (default, only reported), "drop" or "fail"
+        top_n_by_variance - only project the top N most variable rows
+        min_variance - only project rows with at least this variance
+        variance_measure - "variance" (default), "mad" or "cv" (coefficient of variation)
 
         pca_ref: PCA object reference (as KBaseFeatureValues.FloatMatrix2D data type)
         report_name: report name generated by KBaseReport
@@ -874,6 +1572,8 @@ class KnowledgeEngineAppsUtil:
         workspace_name = params.get('workspace_name')
         pca_matrix_name = params.get('pca_matrix_name')
         n_components = int(params.get('n_components', 2))
+        precision = params.get('precision', 'float64')
+        invalid_data_action = params.get('invalid_data_action', 'keep')
 
         cluster_set_source = self.dfu.get_objects(
                     {"object_refs": [cluster_set_ref]})['data'][0]
@@ -885,28 +1585,74 @@ class KnowledgeEngineAppsUtil:
 
         matrix_ref = cluster_set_data.get('original_data')
 
-        data_matrix = self.gen_api.fetch_data({'obj_ref': matrix_ref}).get('data_matrix')
-
-        if '_column' in cluster_set_name:
-            data_matrix = pd.read_json(data_matrix).T.to_json()  # transpose matrix
+        try:
+            matrix = self._set_precision(self._fetch_matrix(matrix_ref), precision)
+
+            if '_column' in cluster_set_name:
+                matrix = matrix.T  # transpose matrix
+
+            # only project items that belong to a cluster
+            cluster_items = set()
+            for cluster in clusters:
+                cluster_items.update(list(cluster.get('id_to_data_position').keys()))
+            if len(cluster_items) < matrix.shape[0]:
+                cluster_rows = [pos for pos, row_id in enumerate(matrix.row_ids)
+                                if row_id in cluster_items]
+                matrix = self._release_replaced(matrix.take(row_pos=cluster_rows), matrix)
+
+            matrix = self._prune_matrix(matrix, invalid_data_action)
+            matrix, _ = self._filter_by_variance(matrix, params)
+
+            if len(matrix.row_index) < len(cluster_items):
+                clusters = [{'id_to_data_position': {
+                                item: pos
+                                for item, pos in cluster.get('id_to_data_position').items()
+                                if item in matrix.row_index}} for cluster in clusters]
+
+            # run pca algorithm, unless this matrix was decomposed before
+            key = artifact_key('pca', matrix_digest(matrix), n_components=n_components)
+            cached = self.artifact_cache.get(key)
+            if cached:
+                pca_values, pca_meta = cached
+                df = pd.DataFrame(np.asarray(pca_values), index=pca_meta['row_ids'],
+                                  columns=pca_meta['columns'])
+            elif (isinstance(matrix, (SparseDataMatrix, ChunkedDataMatrix)) or
+                    has_nan(matrix.values)):
+                if isinstance(matrix, SparseDataMatrix):
+                    log('running truncated SVD PCA on sparse matrix')
+                    pca_values = sparse_pca(matrix.values, n_components=n_components)
+                elif isinstance(matrix, ChunkedDataMatrix):
+                    log('running PCA block by block on chunked matrix')
+                    pca_values = chunked_pca(matrix, n_components=n_components)
+                else:
+                    log('running PCA skipping missing values')
+                    pca_values = nan_pca(matrix.values, n_components=n_components)
+                df = pd.DataFrame(pca_values, index=matrix.row_ids,
+                                  columns=['principal_component_{}'.format(i + 1)
+                                           for i in range(pca_values.shape[1])])
+            else:
+                pca_params = {'data_matrix': matrix.to_json(),
+                              'n_components': n_components}
+                PCA_matrix = self.ke_util.run_PCA(pca_params).get('PCA_matrix')
 
-        # run pca algorithm
-        pca_params = {'data_matrix': data_matrix,
-                      'n_components': n_components}
-        PCA_matrix = self.ke_util.run_PCA(pca_params).get('PCA_matrix')
+                df = DataMatrix.from_json(PCA_matrix).to_dataframe()
 
-        df = pd.read_json(PCA_matrix)
-        df.fillna(0, inplace=True)
+            if not cached:
+                self.artifact_cache.put(key, df.values, meta={'row_ids': df.index.tolist(),
+                                                              'columns': df.columns.tolist()})
 
-        pca_ref,  pca_matrix_data = self._save_2D_matrix(df, clusters,
-                                                         workspace_name, pca_matrix_name)
+            pca_ref,  pca_matrix_data = self._save_2D_matrix(df, clusters,
+                                                             workspace_name, pca_matrix_name)
 
-        returnVal = {'pca_ref': pca_ref}
+            returnVal = {'pca_ref': pca_ref}
 
-        report_output = self._generate_pca_report(pca_ref, pca_matrix_data, workspace_name)
+            report_output = self._generate_pca_report(pca_ref, pca_matrix_data, workspace_name)
 
-        returnVal.update(report_output)
-        return returnVal
+            returnVal.update(report_output)
+            return returnVal
+        finally:
+            # chunked stores are larger than memory, never leave them in scratch
+            self._remove_matrix_stores()
 
     def run_kmeans_cluster(self, params):
         """
@@ -927,6 +1673,25 @@ class KnowledgeEngineAppsUtil:
                      Details refer to:
                      https://docs.scipy.org/doc/scipy/reference/generated/scipy.spatial.distance.pdist.html
 
+        precision: The floating point precision to compute in. Default set to 'float64'.
+                   The precision can be ["float64", "float32"]
+                   float32 halves the memory of the matrix and distance data.
+
+        invalid_data_action: What to do with all-NaN, constant and non-finite rows and
+                             columns, checked before any distance computation.
+                             Default set to 'keep' (only reported).
+                             The action can be ["keep", "drop", "fail"]
+
+        top_n_by_variance: Only cluster the top N rows with the largest variance.
+        min_variance: Only cluster rows with a variance of at least min_variance.
+        variance_measure: The row variance measure used by top_n_by_variance and
+                          min_variance. Default set to 'variance'.
+                          The measure can be ["variance", "mad", "cv"]
+                          (median absolute deviation, coefficient of variation)
+                          The kept row ids are recorded in clustering_parameters.
+
+        n_jobs: Number of processes computing the distance matrix. Default set to 1.
+
         return:
         cluster_set_refs: KBaseExperiments.ClusterSet object references
         report_name: report name generated by KBaseReport
@@ -940,56 +1705,68 @@ class KnowledgeEngineAppsUtil:
         cluster_set_name = params.get('cluster_set_name')
         k_num = params.get('k_num')
         dist_metric = params.get('dist_metric')
+        precision = params.get('precision', 'float64')
+        invalid_data_action = params.get('invalid_data_action', 'keep')
+        n_jobs = int(params.get('n_jobs', 1))
 
-        matrix_object = self.ws.get_objects2({'objects': [{'ref': matrix_ref}]})['data'][0]
-        matrix_data = matrix_object['data']
-
-        data_matrix = self.gen_api.fetch_data({'obj_ref': matrix_ref}).get('data_matrix')
-        transpose_data_matrix = pd.read_json(data_matrix).T.to_json()
-
-        row_kmeans_clusters = self._build_kmeans_cluster(data_matrix, k_num,
-                                                         dist_metric=dist_metric)
-
-        col_kmeans_clusters = self._build_kmeans_cluster(transpose_data_matrix, k_num,
-                                                         dist_metric=dist_metric)
-
-        genome_ref = matrix_data.get('genome_ref')
-        clustering_parameters = {'k_num': str(k_num),
-                                 'dist_metric': str(dist_metric)}
-
-        cluster_set_refs = []
-
-        row_cluster_set_name = cluster_set_name + '_row'
-        row_cluster_set = self._build_kmeans_cluster_set(
-                                                    row_kmeans_clusters,
-                                                    row_cluster_set_name,
-                                                    genome_ref,
-                                                    matrix_ref,
-                                                    matrix_data.get('row_mapping'),
-                                                    matrix_data.get('row_conditionset_ref'),
-                                                    workspace_name,
-                                                    clustering_parameters)
-        cluster_set_refs.append(row_cluster_set)
-
-        col_cluster_set_name = cluster_set_name + '_column'
-        col_cluster_set = self._build_kmeans_cluster_set(
-                                                    col_kmeans_clusters,
-                                                    col_cluster_set_name,
-                                                    genome_ref,
-                                                    matrix_ref,
-                                                    matrix_data.get('col_mapping'),
-                                                    matrix_data.get('col_conditionset_ref'),
-                                                    workspace_name,
-                                                    clustering_parameters)
-        cluster_set_refs.append(col_cluster_set)
-
-        returnVal = {'cluster_set_refs': cluster_set_refs}
-
-        report_output = self._generate_kmeans_cluster_report(cluster_set_refs, workspace_name)
-
-        returnVal.update(report_output)
-
-        return returnVal
+        matrix_info, matrix_data = self._fetch_matrix_object(matrix_ref)
+        try:
+            matrix = self._set_precision(self._fetch_matrix(matrix_ref, matrix_info=matrix_info),
+                                         precision)
+            matrix = self._prune_matrix(matrix, invalid_data_action)
+            matrix, filter_parameters = self._filter_by_variance(matrix, params)
+
+            row_kmeans_clusters = self._build_kmeans_cluster(matrix, k_num,
+                                                             dist_metric=dist_metric,
+                                                             n_jobs=n_jobs)
+
+            col_kmeans_clusters = self._build_kmeans_cluster(matrix.T, k_num,
+                                                             dist_metric=dist_metric,
+                                                             n_jobs=n_jobs)
+
+            genome_ref = matrix_data.get('genome_ref')
+            clustering_parameters = {'k_num': str(k_num),
+                                     'dist_metric': str(dist_metric),
+                                     'precision': str(precision),
+                                     'invalid_data_action': str(invalid_data_action)}
+            clustering_parameters.update(filter_parameters)
+
+            cluster_set_refs = []
+
+            row_cluster_set_name = cluster_set_name + '_row'
+            row_cluster_set = self._build_kmeans_cluster_set(
+                                                        row_kmeans_clusters,
+                                                        row_cluster_set_name,
+                                                        genome_ref,
+                                                        matrix_ref,
+                                                        matrix_data.get('row_mapping'),
+                                                        matrix_data.get('row_conditionset_ref'),
+                                                        workspace_name,
+                                                        clustering_parameters)
+            cluster_set_refs.append(row_cluster_set)
+
+            col_cluster_set_name = cluster_set_name + '_column'
+            col_cluster_set = self._build_kmeans_cluster_set(
+                                                        col_kmeans_clusters,
+                                                        col_cluster_set_name,
+                                                        genome_ref,
+                                                        matrix_ref,
+                                                        matrix_data.get('col_mapping'),
+                                                        matrix_data.get('col_conditionset_ref'),
+                                                        workspace_name,
+                                                        clustering_parameters)
+            cluster_set_refs.append(col_cluster_set)
+
+            returnVal = {'cluster_set_refs': cluster_set_refs}
+
+            report_output = self._generate_kmeans_cluster_report(cluster_set_refs, workspace_name)
+
+            returnVal.update(report_output)
+
+            return returnVal
+        finally:
+            # chunked stores are larger than memory, never leave them in scratch
+            self._remove_matrix_stores()
 
     def run_hierarchical_cluster(self, params):
         """
@@ -1001,6 +1778,16 @@ class KnowledgeEngineAppsUtil:
         dist_cutoff_rate: the threshold to apply when forming flat clusters
 
         Optional arguments:
+        row_dist_cutoff_rates: Several row cutoff rates to sweep in one run, overriding
+                               row_dist_cutoff_rate. The linkage is computed once and one
+                               ClusterSet is saved per rate
+                               (<cluster_set_name>_row_cutoff_<rate>).
+        col_dist_cutoff_rates: Same for the columns (<cluster_set_name>_column_cutoff_<rate>).
+        row_maxclust: Row cluster counts to sweep, one ClusterSet per count formed with the
+                      "maxclust" criterion (<cluster_set_name>_row_maxclust_<count>).
+                      Without cutoff rates, only the given row_dist_cutoff_rate is added.
+        col_maxclust: Same for the columns (<cluster_set_name>_column_maxclust_<count>).
+
         dist_metric: The distance metric to use. Default set to 'euclidean'.
                      The distance function can be
                      ["braycurtis", "canberra", "chebyshev", "cityblock", "correlation", "cosine",
@@ -1023,6 +1810,46 @@ class KnowledgeEngineAppsUtil:
                             Details refer to:
                             https://docs.scipy.org/doc/scipy/reference/generated/scipy.cluster.hierarchy.fcluster.html
 
+        precision: The floating point precision to compute in. Default set to 'float64'.
+                   The precision can be ["float64", "float32"]
+                   float32 halves the memory of the matrix and distance data.
+
+        invalid_data_action: What to do with all-NaN, constant and non-finite rows and
+                             columns, checked before any distance computation.
+                             Default set to 'keep' (only reported).
+                             The action can be ["keep", "drop", "fail"]
+
+        top_n_by_variance: Only cluster the top N rows with the largest variance.
+        min_variance: Only cluster rows with a variance of at least min_variance.
+        variance_measure: The row variance measure used by top_n_by_variance and
+                          min_variance. Default set to 'variance'.
+                          The measure can be ["variance", "mad", "cv"]
+                          (median absolute deviation, coefficient of variation)
+                          The kept row ids are recorded in clustering_parameters.
+
+        collapse_duplicates: Cluster identical rows (and columns) once and expand the flat
+                             clusters back to every id. Default set to 0.
+                             Only applied with the "single", "complete", "weighted" and
+                             "median" linkage and the "distance" and "maxclust" criterion,
+                             where the clusters are identical to clustering every row.
+
+        n_jobs: Number of processes computing the distance matrix. Default set to 1.
+
+        approximate: Build the linkage from an approximate k-nearest-neighbor graph
+                     (random projection trees refined by NN-descent) instead of the full
+                     distance matrix, for matrices too large for exact clustering.
+                     Default set to 0.
+                     Only the "single" and "average" linkage (default 'average') and the
+                     "euclidean", "sqeuclidean", "cosine" and "correlation" metric apply.
+                     The heatmap is not built in this mode.
+        n_neighbors: Number of nearest neighbors per row in the approximate mode.
+                     Default set to 15.
+        matrix_free: Build the linkage from cluster centroids instead of the distance
+                     matrix, for matrices whose distance matrix does not fit in memory.
+                     Default set to 0.
+                     Only the "ward", "centroid" and "median" linkage (default 'ward') and
+                     the "euclidean" metric apply. The linkage is the same as the exact one.
+
         return:
         cluster_set_refs: KBaseExperiments.ClusterSet object references
         report_name: report name generated by KBaseReport
@@ -1036,92 +1863,157 @@ class KnowledgeEngineAppsUtil:
         matrix_ref = params.get('matrix_ref')
         workspace_name = params.get('workspace_name')
         cluster_set_name = params.get('cluster_set_name')
-        row_dist_cutoff_rate = float(params.get('row_dist_cutoff_rate', 0.5))
-        col_dist_cutoff_rate = float(params.get('col_dist_cutoff_rate', 0.5))
+        row_cuts = self._cluster_cuts(params, 'row')
+        col_cuts = self._cluster_cuts(params, 'col')
         dist_metric = params.get('dist_metric')
         linkage_method = params.get('linkage_method')
         fcluster_criterion = params.get('fcluster_criterion')
-
-        matrix_object = self.ws.get_objects2({'objects': [{'ref':
-                                                          matrix_ref}]})['data'][0]
-        matrix_data = matrix_object['data']
-
-        data_matrix = self.gen_api.fetch_data({'obj_ref': matrix_ref}).get('data_matrix')
-        transpose_data_matrix = pd.read_json(data_matrix).T.to_json()
-
+        precision = params.get('precision', 'float64')
+        invalid_data_action = params.get('invalid_data_action', 'keep')
+        collapse_duplicates = bool(params.get('collapse_duplicates', False))
+        n_jobs = int(params.get('n_jobs', 1))
+        approximate = bool(params.get('approximate', False))
+        n_neighbors = int(params.get('n_neighbors', self.N_NEIGHBORS))
+        matrix_free = bool(params.get('matrix_free', False))
+
+        matrix_info, matrix_data = self._fetch_matrix_object(matrix_ref)
         try:
-            plotly_heatmap = self._build_plotly_clustermap(data_matrix, dist_metric, linkage_method)
-            # plotly_heatmap = self._build_clustermap(data_matrix, dist_metric, linkage_method)
-        except:
-            plotly_heatmap = None
-
-        (row_flat_cluster,
-         row_labels,
-         row_newick,
-         row_dendrogram_path,
-         row_dendrogram_truncate_path) = self._build_flat_cluster(
-                                                            data_matrix,
-                                                            row_dist_cutoff_rate,
-                                                            dist_metric=dist_metric,
-                                                            linkage_method=linkage_method,
+            matrix = self._set_precision(self._fetch_matrix(matrix_ref, matrix_info=matrix_info),
+                                         precision)
+            matrix = self._prune_matrix(matrix, invalid_data_action)
+            matrix, filter_parameters = self._filter_by_variance(matrix, params)
+            transpose_matrix = matrix.T
+
+            # distance and linkage are computed once per axis and shared by every stage below
+            if approximate:
+                row_linkage, row_labels = self._build_knn_linkage(matrix,
+                                                                  dist_metric=dist_metric,
+                                                                  linkage_method=linkage_method,
+                                                                  n_neighbors=n_neighbors)
+                col_linkage, col_labels = self._build_knn_linkage(transpose_matrix,
+                                                                  dist_metric=dist_metric,
+                                                                  linkage_method=linkage_method,
+                                                                  n_neighbors=n_neighbors)
+            else:
+                row_linkage, row_labels = self._build_linkage(
+                                                        matrix,
+                                                        dist_metric=dist_metric,
+                                                        linkage_method=linkage_method,
+                                                        fcluster_criterion=fcluster_criterion,
+                                                        collapse_duplicates=collapse_duplicates,
+                                                        n_jobs=n_jobs,
+                                                        matrix_free=matrix_free)
+                col_linkage, col_labels = self._build_linkage(
+                                                        transpose_matrix,
+                                                        dist_metric=dist_metric,
+                                                        linkage_method=linkage_method,
+                                                        fcluster_criterion=fcluster_criterion,
+                                                        collapse_duplicates=collapse_duplicates,
+                                                        n_jobs=n_jobs,
+                                                        matrix_free=matrix_free)
+
+            if isinstance(matrix, ChunkedDataMatrix):
+                # heatmap needs the whole matrix in memory
+                log('skip building heatmap for chunked matrix')
+                plotly_heatmap = None
+            elif approximate:
+                log('skip building heatmap in approximate mode')
+                plotly_heatmap = None
+            elif max(tree_depth(row_linkage), tree_depth(col_linkage)) > self.HEATMAP_MAX_DEPTH:
+                # the plotly dendrograms walk the tree recursively
+                log('skip building heatmap for tree deeper than {} merges'.format(
+                                                                        self.HEATMAP_MAX_DEPTH))
+                plotly_heatmap = None
+            else:
+                try:
+                    plotly_heatmap = self._build_plotly_clustermap(matrix, row_linkage, row_labels,
+                                                                   col_linkage, col_labels)
+                    # plotly_heatmap = self._build_clustermap(matrix, row_linkage, row_labels,
+                    #                                         col_linkage, col_labels)
+                except:
+                    plotly_heatmap = None
+
+            (row_flat_clusters,
+             row_labels,
+             row_newick,
+             row_dendrogram_path,
+             row_dendrogram_truncate_path) = self._build_flat_cluster(
+                                                            row_linkage,
+                                                            row_labels,
+                                                            row_cuts,
                                                             fcluster_criterion=fcluster_criterion)
 
-        (col_flat_cluster,
-         col_labels,
-         col_newick,
-         col_dendrogram_path,
-         col_dendrogram_truncate_path) = self._build_flat_cluster(
-                                                            transpose_data_matrix,
-                                                            col_dist_cutoff_rate,
-                                                            dist_metric=dist_metric,
-                                                            linkage_method=linkage_method,
+            (col_flat_clusters,
+             col_labels,
+             col_newick,
+             col_dendrogram_path,
+             col_dendrogram_truncate_path) = self._build_flat_cluster(
+                                                            col_linkage,
+                                                            col_labels,
+                                                            col_cuts,
                                                             fcluster_criterion=fcluster_criterion)
 
-        genome_ref = matrix_data.get('genome_ref')
-
-        clustering_parameters = {'col_dist_cutoff_rate': str(col_dist_cutoff_rate),
-                                 'row_dist_cutoff_rate': str(row_dist_cutoff_rate),
-                                 'dist_metric': dist_metric,
-                                 'linkage_method': linkage_method,
-                                 'fcluster_criterion': fcluster_criterion}
-
-        cluster_set_refs = []
-
-        row_cluster_set_name = cluster_set_name + '_row'
-        row_cluster_set = self._build_hierarchical_cluster_set(
-                                                    row_flat_cluster,
-                                                    row_cluster_set_name,
-                                                    genome_ref,
-                                                    matrix_ref,
-                                                    matrix_data.get('row_mapping'),
-                                                    matrix_data.get('row_conditionset_ref'),
-                                                    workspace_name,
-                                                    clustering_parameters,
-                                                    data_matrix)
-        cluster_set_refs.append(row_cluster_set)
-
-        col_cluster_set_name = cluster_set_name + '_column'
-        col_cluster_set = self._build_hierarchical_cluster_set(
-                                                    col_flat_cluster,
-                                                    col_cluster_set_name,
-                                                    genome_ref,
-                                                    matrix_ref,
-                                                    matrix_data.get('col_mapping'),
-                                                    matrix_data.get('col_conditionset_ref'),
-                                                    workspace_name,
-                                                    clustering_parameters,
-                                                    transpose_data_matrix)
-        cluster_set_refs.append(col_cluster_set)
-
-        returnVal = {'cluster_set_refs': cluster_set_refs}
-
-        report_output = self._generate_hierarchical_cluster_report(cluster_set_refs,
-                                                                   workspace_name,
-                                                                   row_dendrogram_path,
-                                                                   row_dendrogram_truncate_path,
-                                                                   col_dendrogram_path,
-                                                                   col_dendrogram_truncate_path,
-                                                                   plotly_heatmap)
-        returnVal.update(report_output)
-
-        return returnVal
+            genome_ref = matrix_data.get('genome_ref')
+
+            clustering_parameters = {'dist_metric': dist_metric,
+                                     'linkage_method': linkage_method,
+                                     'fcluster_criterion': fcluster_criterion,
+                                     'precision': precision,
+                                     'invalid_data_action': invalid_data_action,
+                                     'collapse_duplicates': str(int(collapse_duplicates)),
+                                     'approximate': str(int(approximate)),
+                                     'matrix_free': str(int(matrix_free))}
+            if approximate:
+                clustering_parameters['n_neighbors'] = str(n_neighbors)
+            clustering_parameters.update(filter_parameters)
+
+            cluster_set_refs = []
+
+            # one ClusterSet per axis and threshold, all from the same linkage
+            axes = [('row', '_row', row_cuts, row_flat_clusters, matrix,
+                     matrix_data.get('row_mapping'), matrix_data.get('row_conditionset_ref')),
+                    ('col', '_column', col_cuts, col_flat_clusters, transpose_matrix,
+                     matrix_data.get('col_mapping'), matrix_data.get('col_conditionset_ref'))]
+            for (axis, suffix, cuts, flat_clusters, axis_matrix,
+                 conditionset_mapping, conditionset_ref) in axes:
+                for (cut_type, cut), flat_cluster in zip(cuts, flat_clusters):
+                    axis_cluster_set_name = cluster_set_name + suffix
+                    axis_parameters = dict(clustering_parameters)
+                    if cut_type == 'maxclust':
+                        axis_parameters.update({'fcluster_criterion': 'maxclust',
+                                                axis + '_maxclust': str(cut)})
+                    else:
+                        axis_parameters[axis + '_dist_cutoff_rate'] = str(cut)
+                    if len(cuts) > 1:
+                        axis_cluster_set_name += '_{}_{}'.format(
+                                        'maxclust' if cut_type == 'maxclust' else 'cutoff', cut)
+
+                    cluster_set_ref = self._build_hierarchical_cluster_set(
+                                                                flat_cluster,
+                                                                axis_cluster_set_name,
+                                                                genome_ref,
+                                                                matrix_ref,
+                                                                conditionset_mapping,
+                                                                conditionset_ref,
+                                                                workspace_name,
+                                                                axis_parameters,
+                                                                axis_matrix)
+                    cluster_set_refs.append(cluster_set_ref)
+
+            returnVal = {'cluster_set_refs': cluster_set_refs}
+
+            report_output = self._generate_hierarchical_cluster_report(cluster_set_refs,
+                                                                       workspace_name,
+                                                                       row_newick,
+                                                                       col_newick,
+                                                                       row_dendrogram_path,
+                                                                       row_dendrogram_truncate_path,
+                                                                       col_dendrogram_path,
+                                                                       col_dendrogram_truncate_path,
+                                                                       plotly_heatmap)
+            returnVal.update(report_output)
+
+            return returnVal
+        finally:
+            # chunked stores are larger than memory, never leave them in scratch
+            self._remove_matrix_stores()
@@ -0,0 +1,639 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+
+from kb_ke_apps.Utils.MatrixUtil import condensed_start
+from kb_ke_apps.Utils.DistanceUtil import BLAS_METRIC, _blas_prepare, _blas_tile, _shift
+from kb_ke_apps.Utils.NanUtil import NAN_METRIC, has_nan, nan_tile
+
+
+# reducible linkage methods computed by the nearest-neighbor chain
+NN_CHAIN_METHOD = ["complete", "average", "weighted", "ward"]
+
+# linkage methods computed from cluster centroids and sizes alone (euclidean distance)
+CENTROID_METHOD = ["ward", "centroid", "median"]
+
+# distances checked for finite values at a time
+CHECK_BLOCK_SIZE = 16 * 1024 ** 2
+
+# centroid k-d tree searches beat comparing to all clusters from this many rows, for up to
+# TREE_MAX_COLUMNS columns (k-d trees degrade with the dimension)
+TREE_MIN_ROWS = 16384
+TREE_MAX_COLUMNS = 8
+
+# clusters first queried from the centroid k-d tree per nearest cluster search
+TREE_QUERY_SIZE = 8
+
+# merged clusters compared directly before the centroid k-d tree is rebuilt, at least
+TREE_MIN_REBUILD = 32
+
+# Newick pieces buffered before a write
+NEWICK_BUFFER_PIECES = 8192
+
+# labels with any of these characters are quoted in Newick
+NEWICK_SPECIAL = set(" \t\n()[]',:;")
+
+
+class _UnionFind:
+    """
+    _UnionFind: disjoint sets of rows with the linkage node id of every set
+    """
+
+    def __init__(self, n_rows):
+        self.parent = list(range(n_rows))
+        self.node = list(range(n_rows))
+        self.size = [1] * n_rows
+
+    def find(self, row):
+        root = row
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[row] != root:
+            self.parent[row], row = root, self.parent[row]
+        return root
+
+    def union(self, first, second, node):
+        if self.size[first] < self.size[second]:
+            first, second = second, first
+        self.parent[second] = first
+        self.size[first] += self.size[second]
+        self.node[first] = node
+        return first
+
+
+def label_merges(rows, cols, dists, n_rows):
+    """
+    label_merges: linkage merges of the clusters holding rows and cols, in the given order
+
+    (rows, cols) pairs already in the same cluster are skipped.
+
+    return list of [node, node, height, size] and the union-find of the merged rows
+    """
+    sets = _UnionFind(n_rows)
+    merges = []
+    for row, col, dist in zip(np.asarray(rows).tolist(), np.asarray(cols).tolist(),
+                              np.asarray(dists, dtype=np.float64).tolist()):
+        first, second = sets.find(row), sets.find(col)
+        if first == second:
+            continue
+        first_node, second_node = sets.node[first], sets.node[second]
+        merged = sets.union(first, second, n_rows + len(merges))
+        merges.append([min(first_node, second_node), max(first_node, second_node), dist,
+                       sets.size[merged]])
+
+    return merges, sets
+
+
+def kruskal_merges(rows, cols, dists, n_rows):
+    """
+    kruskal_merges: merges of single linkage over the edges (rows, cols, dists) of a graph
+
+    return list of [node, node, height, size] and the union-find of the merged rows
+    """
+    order = np.argsort(dists, kind='stable')
+
+    return label_merges(rows[order], cols[order], dists[order], n_rows)
+
+
+def _row_kernel(values, metric):
+    """
+    _row_kernel: row data and distance function between one row and a block of rows
+
+    return tuple of per row arrays and dist(row, rows) taking tuples of slices of them
+    """
+    n_features = values.shape[1]
+
+    if metric in NAN_METRIC and has_nan(values):
+        shift = None
+        if metric in ['euclidean', 'sqeuclidean']:
+            with np.errstate(invalid='ignore'):
+                shift = np.nan_to_num(np.nanmean(values, axis=0))
+
+        def dist(row, rows):
+            return nan_tile(row[0], rows[0], metric, n_features, shift=shift)[0]
+        return (values,), dist
+
+    if metric in BLAS_METRIC:
+        def dist(row, rows):
+            return _blas_tile(row, rows, metric)[0]
+        return _blas_prepare(values, metric, shift=_shift(values)), dist
+
+    def dist(row, rows):
+        return cdist(row[0], rows[0], metric=metric)[0]
+    return (values,), dist
+
+
+def mst_single_linkage(values, metric='euclidean'):
+    """
+    mst_single_linkage: single linkage of matrix rows from a minimum spanning tree
+
+    The tree is grown with Prim's algorithm, computing the distances of each new tree row
+    to the rows still outside on the fly, so only O(rows) distances are held instead of
+    the condensed matrix (O(rows^2 * columns) time). Rows outside the tree are compacted
+    once half of them joined, so later steps scan fewer rows.
+
+    values: dense (rows x columns) array
+    metric: any scipy.spatial.distance.cdist metric (pairwise-complete for NAN_METRIC
+            metrics on rows with missing values)
+
+    return linkage matrix as scipy.cluster.hierarchy.linkage(method='single')
+    Raises ValueError for non-finite distances, as linkage does.
+    """
+    n_rows = values.shape[0]
+    data, dist = _row_kernel(values, metric)
+
+    # rows outside the tree, their closest tree distance and tree row
+    outside = np.arange(n_rows)
+    outside_data = data
+    min_dist = np.full(n_rows, np.inf)
+    nearest = np.zeros(n_rows, dtype=np.int64)
+    joined = np.zeros(n_rows, dtype=bool)
+
+    rows, cols, dists = [], [], []
+    pos = 0
+    for step in range(n_rows - 1):
+        row = outside[pos]
+        joined[pos] = True
+        min_dist[pos] = np.inf
+
+        if joined.sum() * 2 > len(outside):
+            keep = ~joined
+            outside, min_dist, nearest = outside[keep], min_dist[keep], nearest[keep]
+            outside_data = tuple(array[outside] for array in data)
+            joined = np.zeros(len(outside), dtype=bool)
+
+        row_dist = dist(tuple(array[row:row + 1] for array in data), outside_data)
+        closer = row_dist < min_dist
+        closer[joined] = False
+        min_dist[closer] = row_dist[closer]
+        nearest[closer] = row
+
+        pos = int(np.argmin(np.where(joined, np.inf, min_dist)))
+        if not np.isfinite(min_dist[pos]):
+            raise ValueError('The distance between rows [{}] and [{}] is not finite'.format(
+                                                                    row, outside[pos]))
+        rows.append(nearest[pos])
+        cols.append(outside[pos])
+        dists.append(min_dist[pos])
+
+    merges, sets = kruskal_merges(np.array(rows, dtype=np.int64),
+                                  np.array(cols, dtype=np.int64),
+                                  np.array(dists, dtype=np.float64), n_rows)
+
+    return np.array(merges, dtype=np.float64).reshape(-1, 4)
+
+
+def _condensed_positions(row, others, n_rows):
+    """
+    _condensed_positions: positions of the pairs (row, other) in a condensed matrix
+    """
+    low, high = np.minimum(row, others), np.maximum(row, others)
+    return condensed_start(low, n_rows) + high - low - 1
+
+
+def _lance_williams(method, dist_x, dist_y, dist_xy, size_x, size_y, size_k):
+    """
+    _lance_williams: distances of clusters k to the union of clusters x and y
+    """
+    if method == 'complete':
+        return np.maximum(dist_x, dist_y)
+    if method == 'average':
+        return (size_x * dist_x + size_y * dist_y) / (size_x + size_y)
+    if method == 'weighted':
+        return (dist_x + dist_y) / 2
+    # ward
+    total = size_x + size_y + size_k
+    return np.sqrt(((size_x + size_k) * dist_x ** 2 + (size_y + size_k) * dist_y ** 2 -
+                    size_k * dist_xy ** 2) / total)
+
+
+def _nn_chain(n_rows, cluster_dist, merge, nearest=None):
+    """
+    _nn_chain: merges of a reducible linkage by the nearest-neighbor chain
+
+    Follows chains of nearest neighbors until two clusters are each other's nearest and
+    merges them. Clusters are kept in the slot of one of their rows: the union of x < y
+    takes the slot of y.
+
+    cluster_dist(x, others): distances of cluster x to the clusters others
+    merge(x, y, others, dist_xy): update the state of cluster y to the union of x and y
+    nearest(x): nearest active cluster of x and its distance (default: distances to all
+                active clusters)
+
+    return the merged slots and heights (rows, cols, dists), in merge order
+    """
+    active = np.arange(n_rows)
+    rows, cols, dists = [], [], []
+    chain = []
+    while len(rows) < n_rows - 1:
+        if not chain:
+            chain = [int(active[0])]
+
+        while True:
+            x = chain[-1]
+            if nearest is None:
+                others = active[active != x]
+                others_dist = cluster_dist(x, others)
+                closest = int(np.argmin(others_dist))
+                y, min_dist = int(others[closest]), others_dist[closest]
+            else:
+                y, min_dist = nearest(x)
+            if len(chain) > 1:
+                # ties keep the previous chain cluster, so the chain terminates
+                previous_dist = cluster_dist(x, np.array([chain[-2]]))[0]
+                if previous_dist <= min_dist:
+                    y, min_dist = chain[-2], previous_dist
+            if len(chain) > 1 and y == chain[-2]:
+                break
+            chain.append(y)
+
+        chain = chain[:-2]
+        x, y = min(x, y), max(x, y)
+        rows.append(x)
+        cols.append(y)
+        dists.append(float(min_dist))
+
+        active = active[active != x]
+        merge(x, y, active[active != y], min_dist)
+
+    return rows, cols, dists
+
+
+def nn_chain_linkage(dist_matrix, method='ward', scratch_dir=None):
+    """
+    nn_chain_linkage: linkage of a condensed distance matrix by the nearest-neighbor chain
+
+    The merged cluster's distances are updated (Lance-Williams) in the condensed buffer
+    itself: O(rows^2) time and no copy of the buffer. A read-only memory mapped buffer
+    (e.g. from the artifact cache) is copied to a writable file in scratch_dir and the chain
+    runs on that file, so the updates page to disk and the cached file stays intact.
+
+    The updates are computed in float64 and stored at the buffer's precision: a float32
+    buffer gives heights rounded to float32.
+
+    method: one of NN_CHAIN_METHOD (ward expects euclidean distances)
+    scratch_dir: directory of the writable copy of a read-only memory map (default: system
+                 temporary directory)
+
+    return linkage matrix as scipy.cluster.hierarchy.linkage
+    """
+    if method not in NN_CHAIN_METHOD:
+        raise ValueError('Linkage method [{}] is not reducible. Available: {}'.format(
+                                                                    method, NN_CHAIN_METHOD))
+
+    if dist_matrix.flags.writeable:
+        return _nn_chain_linkage(dist_matrix, method)
+
+    file_path = getattr(dist_matrix, 'filename', None)
+    if not file_path:
+        return _nn_chain_linkage(dist_matrix.copy(), method)
+
+    handle, scratch_file = tempfile.mkstemp(prefix='nn_chain_', suffix='.npy', dir=scratch_dir)
+    os.close(handle)
+    try:
+        shutil.copyfile(file_path, scratch_file)
+        return _nn_chain_linkage(np.load(scratch_file, mmap_mode='r+'), method)
+    finally:
+        os.remove(scratch_file)
+
+
+def _nn_chain_linkage(dist_matrix, method):
+    """
+    _nn_chain_linkage: nn_chain_linkage on a writable condensed buffer
+    """
+    n_rows = int(np.ceil(np.sqrt(2 * len(dist_matrix))))
+    if n_rows * (n_rows - 1) // 2 != len(dist_matrix):
+        raise ValueError('Distance matrix is not a condensed distance matrix')
+    for start in range(0, len(dist_matrix), CHECK_BLOCK_SIZE):
+        if not np.all(np.isfinite(dist_matrix[start:start + CHECK_BLOCK_SIZE])):
+            raise ValueError('The condensed distance matrix must contain only finite values')
+
+    size = np.ones(n_rows)
+
+    def cluster_dist(x, others):
+        return dist_matrix[_condensed_positions(x, others, n_rows)]
+
+    def merge(x, y, others, dist_xy):
+        x_pos = _condensed_positions(x, others, n_rows)
+        y_pos = _condensed_positions(y, others, n_rows)
+        dist_matrix[y_pos] = _lance_williams(method,
+                                             dist_matrix[x_pos].astype(np.float64),
+                                             dist_matrix[y_pos].astype(np.float64),
+                                             float(dist_xy), size[x], size[y], size[others])
+        size[y] += size[x]
+
+    rows, cols, dists = _nn_chain(n_rows, cluster_dist, merge)
+
+    merges, sets = kruskal_merges(np.array(rows, dtype=np.int64),
+                                  np.array(cols, dtype=np.int64),
+                                  np.array(dists, dtype=np.float64), n_rows)
+
+    return np.array(merges, dtype=np.float64).reshape(-1, 4)
+
+
+def _centroid_dist(method, centroids, size, x, others):
+    """
+    _centroid_dist: linkage distances of cluster x (or clusters x) to the clusters others
+    """
+    x_rows = np.atleast_1d(x)
+    dist = cdist(centroids[x_rows], centroids[others])
+    if method == 'ward':
+        # increase of the within cluster sum of squares, as scipy reports it
+        x_size, others_size = size[x_rows][:, None], size[others][None, :]
+        dist *= np.sqrt(2 * x_size * others_size / (x_size + others_size))
+    return dist if np.ndim(x) else dist[0]
+
+
+def _nn_list(n_rows, cluster_dist, merge, nn_idx, nn_dist, nearest=None):
+    """
+    _nn_list: merges of any linkage from a list of the nearest neighbor of every cluster
+
+    The closest pair is the cluster with the smallest nearest neighbor distance. After a
+    merge only the merged cluster's distances are computed; clusters whose nearest
+    neighbor was merged and is not the union now look for a new one.
+
+    cluster_dist(x, others): distances of cluster x to the clusters others, a
+                             (len(x) x len(others)) array for an array of clusters x
+    nn_idx, nn_dist: nearest neighbor and its distance of every row
+    nearest(x): nearest active cluster of x and its distance (default: the clusters that
+                lost their neighbor are compared to all active clusters at once)
+
+    return the merged slots and heights (rows, cols, dists), in merge order
+    """
+    active = np.ones(n_rows, dtype=bool)
+    rows, cols, dists = [], [], []
+    for step in range(n_rows - 1):
+        x = int(np.argmin(nn_dist))
+        y, min_dist = int(nn_idx[x]), nn_dist[x]
+        x, y = min(x, y), max(x, y)
+        rows.append(x)
+        cols.append(y)
+        dists.append(float(min_dist))
+
+        active[x] = False
+        nn_dist[x] = np.inf
+        others = np.flatnonzero(active)
+        others = others[others != y]
+        merge(x, y, others, min_dist)
+        if not len(others):
+            break
+
+        union_dist = cluster_dist(y, others)
+        closest = int(np.argmin(union_dist))
+        nn_idx[y], nn_dist[y] = others[closest], union_dist[closest]
+
+        closer = union_dist < nn_dist[others]
+        stale = ~closer & ((nn_idx[others] == x) | (nn_idx[others] == y))
+        nn_idx[others[closer]] = y
+        nn_dist[others[closer]] = union_dist[closer]
+        if stale.any() and nearest is not None:
+            for row in others[stale]:
+                nn_idx[row], nn_dist[row] = nearest(row)
+        elif stale.any():
+            # all clusters that lost their nearest neighbor look for a new one at once
+            stale = others[stale]
+            candidates = np.flatnonzero(active)
+            stale_dist = cluster_dist(stale, candidates)
+            stale_dist[stale[:, None] == candidates[None, :]] = np.inf
+            closest = np.argmin(stale_dist, axis=1)
+            nn_idx[stale] = candidates[closest]
+            nn_dist[stale] = stale_dist[np.arange(len(stale)), closest]
+
+    return rows, cols, dists
+
+
+class _CentroidIndex:
+    """
+    _CentroidIndex: nearest cluster searches over a k-d tree of the cluster centroids
+
+    The tree holds a snapshot of the active centroids. Unions merged since are compared
+    directly and merged-away clusters are skipped; the tree is rebuilt once there are more
+    than sqrt(active clusters) such unions, so a search costs O(sqrt(rows) * columns) plus
+    the tree query instead of O(rows * columns).
+    """
+
+    def __init__(self, method, centroids, size, cluster_dist):
+        """
+        method: one of CENTROID_METHOD
+        centroids, size: centroid and size of every cluster slot, updated by the caller
+        cluster_dist(x, others): linkage distances of cluster x to the clusters others
+        """
+        self.method = method
+        self.centroids = centroids
+        self.size = size
+        self.cluster_dist = cluster_dist
+        self.active = np.ones(len(centroids), dtype=bool)
+        self._build()
+
+    def _build(self):
+        self.slots = np.flatnonzero(self.active)
+        self.tree = cKDTree(self.centroids[self.slots])
+        self.changed = np.zeros(len(self.centroids), dtype=bool)
+        self.changed_slots = set()
+        # clusters in the tree keep their size until they are merged
+        self.min_size = self.size[self.slots].min()
+
+    def merge(self, x, y):
+        """
+        merge: the union of clusters x and y took the slot of y
+        """
+        self.active[x] = False
+        self.changed[y] = True
+        self.changed_slots.discard(x)
+        self.changed_slots.add(y)
+        if len(self.changed_slots) > max(TREE_MIN_REBUILD, np.sqrt(len(self.slots))):
+            self._build()
+
+    def _dist_factor(self, x):
+        """
+        _dist_factor: lower bound of the linkage distance of x over the centroid distance
+        """
+        if self.method != 'ward':
+            return 1.0
+        # ward scales the centroid distance by a factor growing with both cluster sizes
+        return np.sqrt(2 * self.size[x] * self.min_size / (self.size[x] + self.min_size))
+
+    def nearest(self, x):
+        """
+        nearest: nearest active cluster of x and its linkage distance
+
+        The tree is queried for more and more clusters until the k-th tree distance bounds
+        the linkage distance of all clusters left out. Ties go to the lowest slot.
+        """
+        best, best_dist = -1, np.inf
+
+        def closer(candidates):
+            dist = self.cluster_dist(x, candidates)
+            closest = int(np.argmin(dist))
+            if (dist[closest], candidates[closest]) < (best_dist, best):
+                return int(candidates[closest]), dist[closest]
+            return best, best_dist
+
+        changed = np.fromiter(self.changed_slots, dtype=np.int64, count=len(self.changed_slots))
+        changed = changed[changed != x]
+        if len(changed):
+            best, best_dist = closer(np.sort(changed))
+
+        n_slots, queried = len(self.slots), 0
+        k = min(TREE_QUERY_SIZE, n_slots)
+        while True:
+            tree_dist, pos = self.tree.query(self.centroids[x], k=k)
+            tree_dist, pos = np.atleast_1d(tree_dist), np.atleast_1d(pos)
+            candidates = self.slots[pos[queried:]]
+            candidates = candidates[self.active[candidates] & ~self.changed[candidates] &
+                                    (candidates != x)]
+            if len(candidates):
+                best, best_dist = closer(np.sort(candidates))
+            if k == n_slots or best_dist < tree_dist[-1] * self._dist_factor(x):
+                break
+            queried, k = k, min(2 * k, n_slots)
+
+        if best < 0:
+            raise ValueError('Cluster {} has no active neighbor'.format(x))
+        return best, best_dist
+
+
+def centroid_linkage(values, method='ward'):
+    """
+    centroid_linkage: matrix-free euclidean linkage of matrix rows from cluster centroids
+
+    Ward, centroid and median merge costs only depend on the cluster centroids (the mean,
+    or for median the midpoint of the merged centroids) and sizes, so only those are kept:
+    O(rows * columns) memory and no distance matrix. Ward (reducible) runs the
+    nearest-neighbor chain, centroid and median keep the nearest neighbor of every cluster,
+    seeded by a k-d tree query of the rows. From TREE_MIN_ROWS rows of up to
+    TREE_MAX_COLUMNS columns, nearest cluster searches (the chain steps and the clusters
+    whose neighbor was merged) use a k-d tree of the centroids; otherwise they compare to
+    all clusters. Centroid and median always compute the union's distance to every cluster
+    once per merge, to update the neighbors it becomes closest to.
+
+    values: dense (rows x columns) array without missing values
+    method: one of CENTROID_METHOD
+
+    return linkage matrix as scipy.cluster.hierarchy.linkage(values, method=method)
+    """
+    if method not in CENTROID_METHOD:
+        raise ValueError('Linkage method [{}] has no centroid form. Available: {}'.format(
+                                                                    method, CENTROID_METHOD))
+
+    centroids = np.array(values, dtype=np.float64)
+    if not np.all(np.isfinite(centroids)):
+        raise ValueError('Centroid linkage requires finite values')
+    n_rows = centroids.shape[0]
+    size = np.ones(n_rows)
+
+    def cluster_dist(x, others):
+        return _centroid_dist(method, centroids, size, x, others)
+
+    def merge(x, y, others, dist_xy):
+        if method == 'median':
+            centroids[y] = (centroids[x] + centroids[y]) / 2
+        else:
+            centroids[y] = (size[x] * centroids[x] + size[y] * centroids[y]) / (size[x] +
+                                                                                size[y])
+        size[y] += size[x]
+        if index is not None:
+            index.merge(x, y)
+
+    index = None
+    if n_rows >= TREE_MIN_ROWS and centroids.shape[1] <= TREE_MAX_COLUMNS:
+        index = _CentroidIndex(method, centroids, size, cluster_dist)
+    nearest = index.nearest if index is not None else None
+
+    if method == 'ward':
+        rows, cols, dists = _nn_chain(n_rows, cluster_dist, merge, nearest=nearest)
+        merges, sets = kruskal_merges(np.array(rows, dtype=np.int64),
+                                      np.array(cols, dtype=np.int64),
+                                      np.array(dists, dtype=np.float64), n_rows)
+    else:
+        nn_dist, nn_idx = cKDTree(centroids).query(centroids, k=min(2, n_rows))
+        # duplicate rows may come before the row itself
+        first_self = nn_idx[:, 0] == np.arange(n_rows)
+        nn_idx = np.where(first_self, nn_idx[:, -1], nn_idx[:, 0])
+        nn_dist = np.where(first_self, nn_dist[:, -1], nn_dist[:, 0])
+
+        rows, cols, dists = _nn_list(n_rows, cluster_dist, merge, nn_idx, nn_dist,
+                                     nearest=nearest)
+        merges, sets = label_merges(rows, cols, dists, n_rows)
+
+    return np.array(merges, dtype=np.float64).reshape(-1, 4)
+
+
+def tree_depth(linkage_matrix):
+    """
+    tree_depth: number of merges on the longest path from the root of a linkage to a leaf
+    """
+    n_leaves = len(linkage_matrix) + 1
+    depth = np.zeros(2 * n_leaves - 1, dtype=np.int64)
+    children = np.asarray(linkage_matrix)[:, :2].astype(np.int64)
+    for merge, (left, right) in enumerate(children.tolist()):
+        depth[n_leaves + merge] = max(depth[left], depth[right]) + 1
+    return int(depth[-1])
+
+
+def _newick_label(label):
+    """
+    _newick_label: label quoted for Newick when it holds a special character
+    """
+    label = str(label)
+    if NEWICK_SPECIAL.intersection(label):
+        return "'" + label.replace("'", "''") + "'"
+    return label
+
+
+def write_newick(linkage_matrix, labels, out, precision=10):
+    """
+    write_newick: write the tree of a linkage as Newick to a text file (buffer)
+
+    Walks the tree with an explicit stack instead of recursion, so any tree depth works
+    without raising the interpreter recursion limit; O(rows) time and memory, written in
+    pieces as it goes. The left child of every merge comes first and branch lengths are
+    the height differences to the parent merge, as for scipy.cluster.hierarchy.to_tree.
+
+    labels: leaf names (row ids), in the order of the linkage leaves
+    out: text file object written to
+    precision: significant digits of the branch lengths
+    """
+    n_leaves = len(linkage_matrix) + 1
+    if len(labels) != n_leaves:
+        raise ValueError('Linkage of {} leaves has {} labels'.format(n_leaves, len(labels)))
+
+    linkage_matrix = np.asarray(linkage_matrix)
+    children = linkage_matrix[:, :2].astype(np.int64).tolist()
+    heights = linkage_matrix[:, 2].tolist()
+    length_format = ':{:.%dg}' % precision
+
+    def height(node):
+        return heights[node - n_leaves] if node >= n_leaves else 0.
+
+    pieces = []
+    # nodes to visit as (node, parent height), text pieces as (None, text)
+    stack = [(2 * n_leaves - 2, None)]
+    while stack:
+        node, parent_height = stack.pop()
+        if node is None:
+            pieces.append(parent_height)
+        else:
+            length = ('' if parent_height is None else
+                      length_format.format(parent_height - height(node)))
+            if node < n_leaves:
+                pieces.append(_newick_label(labels[node]) + length)
+            else:
+                left, right = children[node - n_leaves]
+                node_height = height(node)
+                pieces.append('(')
+                stack.append((None, ')' + length))
+                stack.append((right, node_height))
+                stack.append((None, ','))
+                stack.append((left, node_height))
+
+        if len(pieces) >= NEWICK_BUFFER_PIECES:
+            out.write(''.join(pieces))
+            pieces = []
+
+    pieces.append(';\n')
+    out.write(''.join(pieces))
@@ -0,0 +1,479 @@
+import os
+import re
+import json
+import time
+
+import pandas as pd
+import numpy as np
+import scipy.sparse as sp
+
+
+def log(message, prefix_newline=False):
+    time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time()))
+    print(('\n' if prefix_newline else '') + time_str + ': ' + message)
+
+
+def condensed_start(i, n):
+    """
+    condensed_start: position of pair (i, i + 1) in a condensed distance matrix of n rows
+    """
+    return i * n - i * (i + 1) // 2
+
+
+def fix_component_signs(scores):
+    """
+    fix_component_signs: flip principal component scores so the largest loading of each
+                         component is positive (deterministic signs)
+    """
+    signs = np.sign(scores[np.argmax(np.abs(scores), axis=0), np.arange(scores.shape[1])])
+    signs[signs == 0] = 1
+
+    return scores * signs
+
+
+class DataMatrix:
+    """
+    DataMatrix: numeric matrix parsed once per run and shared by every stage
+
+    values: 2D float ndarray (rows x columns, float64 or float32)
+    row_ids: row label array
+    col_ids: column label array
+    row_index / col_index: label to position mapping
+    """
+
+    def __init__(self, values, row_ids, col_ids, row_index=None, col_index=None):
+        self.values = np.asarray(values)
+        if self.values.dtype not in (np.float64, np.float32):
+            self.values = self.values.astype(np.float64)
+        self.row_ids = np.asarray(row_ids, dtype=object)
+        self.col_ids = np.asarray(col_ids, dtype=object)
+
+        if self.values.shape != (self.row_ids.size, self.col_ids.size):
+            raise ValueError('Matrix shape {} does not match {} row_ids and {} col_ids'.format(
+                                    self.values.shape, self.row_ids.size, self.col_ids.size))
+
+        if row_index is None:
+            row_index = {row_id: pos for pos, row_id in enumerate(self.row_ids)}
+        if col_index is None:
+            col_index = {col_id: pos for pos, col_id in enumerate(self.col_ids)}
+
+        self.row_index = row_index
+        self.col_index = col_index
+
+    @classmethod
+    def from_json(cls, data_matrix):
+        """
+        from_json: build DataMatrix from data_matrix json (pandas dataframe in json format)
+
+        data_matrix: json string or file object
+        """
+        return DataMatrixParser(data_matrix).parse()
+
+    @classmethod
+    def from_matrix_data(cls, data):
+        """
+        from_matrix_data: build DataMatrix from workspace matrix data
+                          (FloatMatrix2D with row_ids, col_ids and values, None as NaN)
+        """
+        return cls(np.array(data['values'], dtype=float), data['row_ids'], data['col_ids'])
+
+    @classmethod
+    def from_dataframe(cls, df):
+        """
+        from_dataframe: build DataMatrix from pandas dataframe
+        """
+        return cls(df.values, df.index.values, df.columns.values)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def T(self):
+        """
+        T: transposed matrix sharing the same buffers (zero-copy view)
+        """
+        return DataMatrix(self.values.T, self.col_ids, self.row_ids,
+                          row_index=self.col_index, col_index=self.row_index)
+
+    def astype(self, dtype):
+        """
+        astype: matrix with values cast to dtype (labels and indices are shared)
+        """
+        return DataMatrix(self.values.astype(dtype), self.row_ids, self.col_ids,
+                          row_index=self.row_index, col_index=self.col_index)
+
+    def take(self, row_pos=None, col_pos=None):
+        """
+        take: sub-matrix of the given row and column positions (None keeps the whole axis)
+        """
+        if row_pos is None and col_pos is None:
+            return self
+
+        values = self.values
+        row_ids, col_ids = self.row_ids, self.col_ids
+        row_index, col_index = self.row_index, self.col_index
+        if row_pos is not None:
+            values, row_ids, row_index = values[row_pos], row_ids[row_pos], None
+        if col_pos is not None:
+            values, col_ids, col_index = values[:, col_pos], col_ids[col_pos], None
+
+        return DataMatrix(values, row_ids, col_ids, row_index=row_index, col_index=col_index)
+
+    def to_dataframe(self):
+        """
+        to_dataframe: wrap values as pandas dataframe without copying
+        """
+        return pd.DataFrame(self.values, index=self.row_ids, columns=self.col_ids, copy=False)
+
+    def to_json(self):
+        """
+        to_json: serialize matrix as data_matrix json (as returned by GenericsAPI.fetch_data)
+        """
+        return self.to_dataframe().to_json()
+
+
+class SparseDataMatrix:
+    """
+    SparseDataMatrix: mostly-zero matrix kept in CSR form, same interface as DataMatrix
+
+    values: scipy.sparse.csr_matrix (rows x columns) without missing values; matrices with
+            missing values stay dense (DataMatrix) for the NaN-aware kernels
+    """
+
+    def __init__(self, values, row_ids, col_ids, row_index=None, col_index=None):
+        self.values = sp.csr_matrix(values)
+        if self.values.dtype not in (np.float64, np.float32):
+            self.values = self.values.astype(np.float64)
+        self.row_ids = np.asarray(row_ids, dtype=object)
+        self.col_ids = np.asarray(col_ids, dtype=object)
+
+        if self.values.shape != (self.row_ids.size, self.col_ids.size):
+            raise ValueError('Matrix shape {} does not match {} row_ids and {} col_ids'.format(
+                                    self.values.shape, self.row_ids.size, self.col_ids.size))
+
+        if row_index is None:
+            row_index = {row_id: pos for pos, row_id in enumerate(self.row_ids)}
+        if col_index is None:
+            col_index = {col_id: pos for pos, col_id in enumerate(self.col_ids)}
+
+        self.row_index = row_index
+        self.col_index = col_index
+
+    @staticmethod
+    def zero_fraction(data):
+        """
+        zero_fraction: fraction of zero cells in workspace matrix data (missing values are
+                       not zeros)
+        """
+        values = data['values']
+        cells = sum([len(row) for row in values])
+        if not cells:
+            return 0.
+
+        zeros = sum([row.count(0) for row in values])
+        return zeros / float(cells)
+
+    @staticmethod
+    def has_missing(data):
+        """
+        has_missing: whether workspace matrix data has missing (None) cells
+        """
+        return any([None in row for row in data['values']])
+
+    @classmethod
+    def from_matrix_data(cls, data):
+        """
+        from_matrix_data: build SparseDataMatrix from workspace matrix data without
+                          allocating the dense array (missing values are rejected)
+        """
+        indptr = [0]
+        indices = []
+        values = []
+        for row_pos, row in enumerate(data['values']):
+            for col_pos, value in enumerate(row):
+                if value is None:
+                    raise ValueError('Matrix value at row {} column {} is missing, '.format(
+                                                                        row_pos, col_pos) +
+                                     'sparse matrices cannot hold missing values')
+                if value:
+                    indices.append(col_pos)
+                    values.append(value)
+            indptr.append(len(indices))
+
+        csr = sp.csr_matrix((np.array(values, dtype=float), np.array(indices, dtype=np.int32),
+                             np.array(indptr, dtype=np.int64)),
+                            shape=(len(data['row_ids']), len(data['col_ids'])))
+
+        return cls(csr, data['row_ids'], data['col_ids'])
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def density(self):
+        n_rows, n_cols = self.values.shape
+        return self.values.nnz / float(max(n_rows * n_cols, 1))
+
+    @property
+    def T(self):
+        """
+        T: transposed matrix (CSR of the transpose, O(nnz) copy)
+        """
+        return SparseDataMatrix(self.values.T.tocsr(), self.col_ids, self.row_ids,
+                                row_index=self.col_index, col_index=self.row_index)
+
+    def astype(self, dtype):
+        """
+        astype: matrix with values cast to dtype (labels and indices are shared)
+        """
+        return SparseDataMatrix(self.values.astype(dtype), self.row_ids, self.col_ids,
+                                row_index=self.row_index, col_index=self.col_index)
+
+    def take(self, row_pos=None, col_pos=None):
+        """
+        take: sub-matrix of the given row and column positions (None keeps the whole axis)
+        """
+        if row_pos is None and col_pos is None:
+            return self
+
+        values = self.values
+        row_ids, col_ids = self.row_ids, self.col_ids
+        row_index, col_index = self.row_index, self.col_index
+        if row_pos is not None:
+            values, row_ids, row_index = values[row_pos], row_ids[row_pos], None
+        if col_pos is not None:
+            values, col_ids, col_index = values[:, col_pos], col_ids[col_pos], None
+
+        return SparseDataMatrix(values, row_ids, col_ids, row_index=row_index,
+                                col_index=col_index)
+
+    def to_dense(self):
+        """
+        to_dense: densify into DataMatrix
+        """
+        return DataMatrix(self.values.toarray(), self.row_ids, self.col_ids,
+                          row_index=self.row_index, col_index=self.col_index)
+
+    def to_dataframe(self):
+        """
+        to_dataframe: densify as pandas dataframe (plotting and remote calls only)
+        """
+        return self.to_dense().to_dataframe()
+
+    def to_json(self):
+        """
+        to_json: serialize matrix as data_matrix json (as returned by GenericsAPI.fetch_data)
+        """
+        return self.to_dataframe().to_json()
+
+
+class DataMatrixParser:
+    """
+    DataMatrixParser: incremental parser for data_matrix json payloads
+
+    data_matrix is a pandas dataframe in json format ({column: {row: value}}). The payload
+    is read in chunks and every value is written straight into a preallocated float array
+    (null as NaN), so the dict-of-dicts built by pd.read_json is never materialized.
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+
+    # payload name shown in parse errors
+    PAYLOAD_NAME = 'data_matrix json'
+
+    _STRING = r'"((?:[^"\\]|\\.)*)"'
+    _NUMBER = r'(null|true|false|NaN|-?Infinity|-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)'
+    _COLUMN_RE = re.compile(r'\s*' + _STRING + r'\s*:\s*\{')
+    _CELL_RE = re.compile(r'\s*' + _STRING + r'\s*:\s*' + _NUMBER + r'\s*([,}])')
+
+    _LITERALS = {'null': np.nan, 'true': 1., 'false': 0.}
+
+    def __init__(self, data_matrix, chunk_size=CHUNK_SIZE):
+        self._chunk_size = chunk_size
+        self._pos = 0
+        self._offset = 0  # number of characters dropped from the buffer
+
+        if isinstance(data_matrix, str):
+            # payload already in memory, scan it in place
+            self._stream = None
+            self._buf = data_matrix
+            self._eof = True
+            self._payload_size = len(data_matrix)
+        else:
+            self._stream = data_matrix
+            self._buf = ''
+            self._eof = False
+            self._payload_size = self._get_file_size(data_matrix)
+
+        self.row_ids = []
+        self.row_index = {}
+        self.col_ids = []
+        self._values = None
+
+    def _get_file_size(self, stream):
+        try:
+            return os.fstat(stream.fileno()).st_size
+        except (AttributeError, OSError, ValueError):
+            return None
+
+    def _fill(self):
+        """
+        _fill: append next chunk to buffer, dropping consumed characters
+        """
+        if self._eof:
+            return False
+
+        chunk = self._stream.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        if isinstance(chunk, bytes):
+            chunk = chunk.decode('utf-8')
+
+        self._offset += self._pos
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _match(self, regex):
+        """
+        _match: match regex at current position, reading more data when needed
+        """
+        while True:
+            match = regex.match(self._buf, self._pos)
+            if match or not self._fill():
+                return match
+
+    def _expect(self, chars):
+        """
+        _expect: consume and return next non-whitespace character if it is one of chars
+        """
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos].isspace():
+                self._pos += 1
+            if self._pos < len(self._buf):
+                char = self._buf[self._pos]
+                if char not in chars:
+                    return None
+                self._pos += 1
+                return char
+            if not self._fill():
+                return None
+
+    def _error(self, message):
+        raise ValueError('Invalid {} at character {}: {}'.format(
+                                        self.PAYLOAD_NAME, self._offset + self._pos, message))
+
+    def _decode_key(self, key):
+        return json.loads('"' + key + '"') if '\\' in key else key
+
+    def _ensure_capacity(self, rows, cols):
+        """
+        _ensure_capacity: grow value array (column-major, NaN filled) to hold rows x cols
+        """
+        cap_rows, cap_cols = self._values.shape
+        if rows <= cap_rows and cols <= cap_cols:
+            return
+
+        new_rows = max(rows, 2 * cap_rows) if rows > cap_rows else cap_rows
+        new_cols = max(cols, 2 * cap_cols) if cols > cap_cols else cap_cols
+
+        values = np.full((new_rows, new_cols), np.nan, order='F')
+        values[:cap_rows, :cap_cols] = self._values
+        self._values = values
+
+    def _parse_column(self, col_pos, first_column=None):
+        """
+        _parse_column: parse {row: value, ...} into column col_pos
+
+        first_column: list collecting values of the first column (before allocation)
+        """
+        if self._expect('}'):
+            return
+
+        if first_column is None:
+            self._ensure_capacity(len(self.row_ids), col_pos + 1)
+
+        cell_re = self._CELL_RE
+        row_index = self.row_index
+        literals = self._LITERALS
+
+        while True:
+            match = cell_re.match(self._buf, self._pos) or self._match(cell_re)
+            if not match:
+                self._error('expected "row_id": value')
+            self._pos = match.end()
+            row_id, token, separator = match.groups()
+
+            if '\\' in row_id:
+                row_id = self._decode_key(row_id)
+            row_pos = row_index.get(row_id)
+            if row_pos is None:
+                row_pos = len(self.row_ids)
+                row_index[row_id] = row_pos
+                self.row_ids.append(row_id)
+                if first_column is None:
+                    self._ensure_capacity(row_pos + 1, col_pos + 1)
+
+            value = literals[token] if token in literals else float(token)
+            if first_column is None:
+                self._values[row_pos, col_pos] = value
+            else:
+                first_column.append(value)
+
+            if separator == '}':
+                return
+
+    def _allocate(self, first_column, first_column_size):
+        """
+        _allocate: allocate value array once the first column is known
+
+        The column count is estimated from the payload size and the size of the first
+        column, the array only grows if the estimate turns out too small.
+        """
+        n_cols = 1
+        if self._payload_size and first_column_size:
+            n_cols = int(self._payload_size * 1.05 / first_column_size) + 1
+
+        self._values = np.full((len(first_column), n_cols), np.nan, order='F')
+        self._values[:, 0] = first_column
+
+    def parse(self):
+        """
+        parse: parse the payload and return DataMatrix
+        """
+        if not self._expect('{'):
+            self._error('expected "{"')
+
+        separator = self._expect('}')
+        while not separator:
+            match = self._match(self._COLUMN_RE)
+            if not match:
+                self._error('expected "col_id": {')
+            start = self._offset + self._pos
+            self._pos = match.end()
+
+            col_pos = len(self.col_ids)
+            self.col_ids.append(self._decode_key(match.group(1)))
+
+            if self._values is None:
+                first_column = []
+                self._parse_column(col_pos, first_column=first_column)
+                self._allocate(first_column, self._offset + self._pos - start)
+            else:
+                self._parse_column(col_pos)
+
+            separator = self._expect(',}')
+            if separator is None:
+                self._error('expected "," or "}"')
+            if separator == ',':
+                separator = None
+
+        n_rows, n_cols = len(self.row_ids), len(self.col_ids)
+        if self._values is None:
+            self._values = np.empty((n_rows, n_cols))
+
+        return DataMatrix(self._values[:n_rows, :n_cols], self.row_ids, self.col_ids,
+                          row_index=self.row_index)
@@ -0,0 +1,173 @@
+import numpy as np
+
+from kb_ke_apps.Utils.MatrixUtil import condensed_start, fix_component_signs
+
+
+# metrics with a pairwise-complete (missing values skipped) variant
+NAN_METRIC = ["euclidean", "sqeuclidean", "cityblock", "cosine", "correlation"]
+
+
+def has_nan(values, block_rows=4096):
+    """
+    has_nan: whether a dense (rows x columns) array holds any NaN, checked block by block
+    """
+    if values.dtype.kind != 'f':
+        return False
+    return any(np.isnan(values[start:start + block_rows]).any()
+               for start in range(0, values.shape[0], block_rows))
+
+
+def _masked(values, shift=None):
+    """
+    _masked: (values with NaN read as 0, float mask of the valid cells) of a row block
+    """
+    valid = ~np.isnan(values)
+    if shift is not None:
+        values = values - shift
+    return np.where(valid, values, 0), valid.astype(values.dtype)
+
+
+def nan_tile(block, other, metric, n_features, shift=None):
+    """
+    nan_tile: pairwise-complete distance tile between two row blocks containing NaN
+
+    Every pair is computed over the columns valid in both rows, from masked matrix
+    products. Sum based metrics (euclidean, sqeuclidean, cityblock) are rescaled by
+    n_features / valid pairs so rows with missing values stay comparable; cosine and
+    correlation use the valid columns only. Pairs without a common valid column are NaN.
+    """
+    values, valid = _masked(block, shift=shift)
+    other_values, other_valid = _masked(other, shift=shift)
+    count = valid.dot(other_valid.T)
+
+    if metric in ['euclidean', 'sqeuclidean']:
+        dist = (values * values).dot(other_valid.T)
+        dist += valid.dot((other_values * other_values).T)
+        dist -= 2 * values.dot(other_values.T)
+        np.maximum(dist, 0, out=dist)
+    elif metric == 'cityblock':
+        dist = np.zeros(count.shape, dtype=values.dtype)
+        for col in range(values.shape[1]):
+            # both masks zero the invalid cells, a missing cell adds nothing
+            diff = np.abs(values[:, col][:, None] - other_values[:, col][None, :])
+            diff *= valid[:, col][:, None]
+            diff *= other_valid[:, col][None, :]
+            dist += diff
+    elif metric in ['cosine', 'correlation']:
+        products = values.dot(other_values.T)
+        squares = (values * values).dot(other_valid.T)
+        other_squares = valid.dot((other_values * other_values).T)
+        if metric == 'correlation':
+            sums = values.dot(other_valid.T)
+            other_sums = valid.dot(other_values.T)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                products -= sums * other_sums / count
+                squares -= sums * sums / count
+                other_squares -= other_sums * other_sums / count
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dist = 1 - products / np.sqrt(squares * other_squares)
+        # rounding can push 1 - cos just outside [0, 2]
+        np.clip(dist, 0, 2, out=dist)
+    else:
+        raise ValueError('Metric [{}] has no pairwise-complete variant. Available: {}'.format(
+                                                                        metric, NAN_METRIC))
+
+    if metric in ['euclidean', 'sqeuclidean', 'cityblock']:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dist *= n_features / count
+        if metric == 'euclidean':
+            np.sqrt(dist, out=dist)
+
+    dist[count == 0] = np.nan
+
+    return dist
+
+
+def nan_pdist(values, metric='euclidean', block_rows=2048, out=None, rows=None):
+    """
+    nan_pdist: condensed pairwise-complete distances between rows with missing values
+
+    Works on the parsed array directly: NaN cells are masked tile by tile (see nan_tile),
+    no imputed copy of the matrix is made. Matches scipy.spatial.distance.pdist on rows
+    without NaN.
+
+    out: condensed output buffer (e.g. memory mapped), allocated if not given
+    rows: (first, last) only fill the pairs of rows first:last (for parallel workers)
+    """
+    if metric not in NAN_METRIC:
+        raise ValueError('Metric [{}] has no pairwise-complete variant. Available: {}'.format(
+                                                                        metric, NAN_METRIC))
+
+    n, n_features = values.shape
+    dtype = values.dtype if values.dtype == np.float32 else np.float64
+    dist_matrix = np.empty(n * (n - 1) // 2, dtype=dtype) if out is None else out
+
+    # euclidean distances are translation invariant, centered rows lose less precision
+    shift = None
+    if metric in ['euclidean', 'sqeuclidean'] and n:
+        with np.errstate(invalid='ignore'):
+            shift = np.nan_to_num(np.nanmean(values, axis=0)).astype(dtype)
+
+    first, last = rows or (0, n - 1)
+    for start in range(first, last, block_rows):
+        end = min(start + block_rows, last)
+        tile = nan_tile(values[start:end].astype(dtype, copy=False),
+                        values[start:].astype(dtype, copy=False), metric, n_features,
+                        shift=shift)
+        for i in range(start, end):
+            pos = condensed_start(i, n)
+            dist_matrix[pos:pos + n - i - 1] = tile[i - start, i - start + 1:]
+
+    return dist_matrix
+
+
+def nan_pca(values, n_components=2, block_rows=4096):
+    """
+    nan_pca: principal component scores of rows with missing values
+
+    The column covariance is accumulated over row blocks from the pairwise-complete
+    products of the centered columns; missing cells then project as the column mean.
+    Returns (rows x n_components) scores ordered by explained variance.
+    """
+    n_rows, n_cols = values.shape
+
+    def iter_row_blocks():
+        for start in range(0, n_rows, block_rows):
+            yield start, min(start + block_rows, n_rows), values[start:start + block_rows]
+
+    return nan_pca_blocks(iter_row_blocks, n_rows, n_cols, n_components=n_components)
+
+
+def nan_pca_blocks(iter_row_blocks, n_rows, n_cols, n_components=2):
+    """
+    nan_pca_blocks: nan_pca of a matrix read a row block at a time (e.g. a chunked store)
+
+    iter_row_blocks(): iterator of (start, end, values) row blocks, called once per pass
+    """
+    sums = np.zeros(n_cols)
+    counts = np.zeros(n_cols)
+    for start, end, values in iter_row_blocks():
+        block, valid = _masked(values.astype(np.float64))
+        sums += block.sum(axis=0)
+        counts += valid.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(counts > 0, sums / counts, 0)
+
+    gram = np.zeros((n_cols, n_cols))
+    count = np.zeros((n_cols, n_cols))
+    for start, end, values in iter_row_blocks():
+        block, valid = _masked(values.astype(np.float64), shift=mean)
+        gram += block.T.dot(block)
+        count += valid.T.dot(valid)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covariance = np.where(count > 1, gram / (count - 1), 0)
+    eigvals, eigvecs = np.linalg.eigh(covariance)
+    components = eigvecs[:, np.argsort(eigvals)[::-1][:n_components]]
+
+    scores = np.empty((n_rows, components.shape[1]))
+    for start, end, values in iter_row_blocks():
+        block, _ = _masked(values.astype(np.float64), shift=mean)
+        scores[start:end] = block.dot(components)
+
+    return fix_component_signs(scores)
@@ -0,0 +1,136 @@
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.linalg import LinearOperator, svds
+
+from kb_ke_apps.Utils.MatrixUtil import condensed_start, fix_component_signs
+
+
+SPARSE_METRIC = ["braycurtis", "cosine", "euclidean", "jaccard"]
+
+
+def _block_distance(metric, block, rest, block_stats, rest_stats, rest_csc):
+    """
+    _block_distance: dense (block rows x rest rows) distance tile computed from sparse rows
+    """
+    if metric in ['euclidean', 'cosine']:
+        gram = (block @ rest.T).toarray()
+
+        if metric == 'euclidean':
+            total = block_stats[:, None] + rest_stats[None, :]
+            dist = total - 2 * gram
+            np.maximum(dist, 0, out=dist)
+
+            # cancellation dominates for (near) identical rows, compute those pairs directly
+            tol = np.sqrt(np.finfo(dist.dtype).eps)
+            rows_pos, rest_pos = np.nonzero((dist <= tol * total) & (total > 0))
+            if rows_pos.size:
+                diff = block[rows_pos] - rest[rest_pos]
+                dist[rows_pos, rest_pos] = np.asarray(diff.multiply(diff).sum(axis=1)).ravel()
+
+            return np.sqrt(dist, out=dist)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return 1 - gram / np.outer(block_stats, rest_stats)
+
+    if metric == 'jaccard':
+        # presence/absence of the non-zero pattern
+        intersect = (block @ rest.T).toarray()
+        union = block_stats[:, None] + rest_stats[None, :] - intersect
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dist = (union - intersect) / union
+        dist[union == 0] = 0
+        return dist
+
+    if metric == 'braycurtis':
+        # sum|u - v| = sum(u) + sum(v) - 2 * sum(min(u, v)) for non-negative data
+        min_sum = np.empty((block.shape[0], rest.shape[0]), dtype=float)
+        for row in range(block.shape[0]):
+            start, end = block.indptr[row], block.indptr[row + 1]
+            columns = rest_csc[:, block.indices[start:end]]
+            column_pos = np.repeat(np.arange(columns.shape[1]), np.diff(columns.indptr))
+            min_values = np.minimum(columns.data, block.data[start:end][column_pos])
+            min_sum[row] = np.bincount(columns.indices, weights=min_values,
+                                       minlength=rest.shape[0])
+        total = block_stats[:, None] + rest_stats[None, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (total - 2 * min_sum) / total
+
+    raise ValueError('Metric [{}] is not supported for sparse matrices'.format(metric))
+
+
+def sparse_pdist(values, metric='euclidean', block_rows=256, out=None, rows=None):
+    """
+    sparse_pdist: condensed pairwise distances between rows of a CSR matrix
+
+    Computes row blocks against the remaining rows using sparse products only, so the
+    input is never densified. Matches scipy.spatial.distance.pdist on the dense matrix
+    (jaccard on the non-zero pattern, braycurtis for non-negative data).
+
+    out: condensed output buffer (e.g. memory mapped), allocated if not given
+    rows: (first, last) only fill the pairs of rows first:last (for parallel workers)
+    """
+    values = sp.csr_matrix(values)
+    n = values.shape[0]
+    dtype = values.dtype if values.dtype == np.float32 else np.float64
+
+    if metric == 'jaccard':
+        values = values.copy()
+        values.data = (values.data != 0).astype(dtype)
+        values.eliminate_zeros()
+        stats = np.asarray(values.sum(axis=1)).ravel()
+    elif metric == 'braycurtis':
+        if values.nnz and values.data.min() < 0:
+            raise ValueError('Sparse braycurtis distance requires non-negative values')
+        stats = np.asarray(values.sum(axis=1)).ravel()
+    elif metric in ['euclidean', 'cosine']:
+        stats = np.asarray(values.multiply(values).sum(axis=1)).ravel()
+        if metric == 'cosine':
+            stats = np.sqrt(stats)
+    else:
+        raise ValueError('Metric [{}] is not supported for sparse matrices'.format(metric))
+
+    dist_matrix = np.empty(n * (n - 1) // 2, dtype=dtype) if out is None else out
+
+    first, last = rows or (0, n - 1)
+    for block_start in range(first, last, block_rows):
+        block_end = min(block_start + block_rows, last)
+        rest = values[block_start:]
+        rest_csc = rest.tocsc() if metric == 'braycurtis' else None
+
+        tile = _block_distance(metric, values[block_start:block_end], rest,
+                               stats[block_start:block_end], stats[block_start:], rest_csc)
+
+        for i in range(block_start, block_end):
+            start = condensed_start(i, n)
+            dist_matrix[start:start + n - i - 1] = tile[i - block_start, i - block_start + 1:]
+
+    return dist_matrix
+
+
+def sparse_pca(values, n_components=2):
+    """
+    sparse_pca: principal component scores of a CSR matrix via truncated SVD
+
+    Rows are centered implicitly through a LinearOperator so the input stays sparse.
+    Returns (rows x n_components) scores ordered by explained variance.
+    """
+    values = sp.csr_matrix(values, dtype=np.float64)
+    n_rows, n_cols = values.shape
+    mean = np.asarray(values.mean(axis=0)).ravel()
+
+    if n_components >= min(n_rows, n_cols):
+        # too few dimensions for an iterative solver
+        centered = values.toarray() - mean
+        u, s, _ = np.linalg.svd(centered, full_matrices=False)
+        u, s = u[:, :n_components], s[:n_components]
+    else:
+        ones = np.ones(n_rows)
+        centered = LinearOperator(
+                        (n_rows, n_cols), dtype=np.float64,
+                        matvec=lambda v: values @ np.ravel(v) - mean.dot(np.ravel(v)) * ones,
+                        rmatvec=lambda u: values.T @ np.ravel(u) - mean * np.sum(u))
+        u, s, _ = svds(centered, k=n_components, v0=np.ones(min(n_rows, n_cols)))
+        order = np.argsort(s)[::-1]
+        u, s = u[:, order], s[order]
+
+    return fix_component_signs(u * s)
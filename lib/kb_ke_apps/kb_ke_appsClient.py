@@ -41,13 +41,22 @@ class kb_ke_apps(object):
            reference workspace_name: the name of the workspace
            cluster_set_name: KBaseExperiments.ClusterSet object name
            dist_cutoff_rate: the threshold to apply when forming flat
-           clusters Optional arguments: dist_metric: The distance metric to
-           use. Default set to 'euclidean'. The distance function can be
-           ["braycurtis", "canberra", "chebyshev", "cityblock",
-           "correlation", "cosine", "dice", "euclidean", "hamming",
-           "jaccard", "kulsinski", "matching", "rogerstanimoto",
-           "russellrao", "sokalmichener", "sokalsneath", "sqeuclidean",
-           "yule"] Details refer to:
+           clusters Optional arguments: row_dist_cutoff_rates: Several row
+           cutoff rates to sweep in one run, overriding row_dist_cutoff_rate.
+           The linkage is computed once and one ClusterSet is saved per rate
+           (<cluster_set_name>_row_cutoff_<rate>). col_dist_cutoff_rates:
+           Same for the columns (<cluster_set_name>_column_cutoff_<rate>).
+           row_maxclust: Row cluster counts to sweep, one ClusterSet per
+           count formed with the "maxclust" criterion
+           (<cluster_set_name>_row_maxclust_<count>). Without cutoff rates,
+           only the given row_dist_cutoff_rate is added. col_maxclust: Same
+           for the columns (<cluster_set_name>_column_maxclust_<count>).
+           dist_metric: The distance metric to use. Default set to
+           'euclidean'. The distance function can be ["braycurtis",
+           "canberra", "chebyshev", "cityblock", "correlation", "cosine",
+           "dice", "euclidean", "hamming", "jaccard", "kulsinski",
+           "matching", "rogerstanimoto", "russellrao", "sokalmichener",
+           "sokalsneath", "sqeuclidean", "yule"] Details refer to:
            https://docs.scipy.org/doc/scipy/reference/generated/scipy.spatial.
            distance.pdist.html linkage_method: The linkage algorithm to use.
            Default set to 'ward'. The method can be ["single", "complete",
@@ -58,13 +67,56 @@ class kb_ke_apps(object):
            forming flat clusters. Default set to 'distance'. The criterion
            can be ["inconsistent", "distance", "maxclust"] Details refer to:
            https://docs.scipy.org/doc/scipy/reference/generated/scipy.cluster.
-           hierarchy.fcluster.html) -> structure: parameter "matrix_ref" of
-           type "obj_ref" (An X/Y/Z style reference), parameter
-           "workspace_name" of String, parameter "cluster_set_name" of
-           String, parameter "row_dist_cutoff_rate" of Double, parameter
-           "col_dist_cutoff_rate" of Double, parameter "dist_metric" of
-           String, parameter "linkage_method" of String, parameter
-           "fcluster_criterion" of String
+           hierarchy.fcluster.html precision: The floating point precision to
+           compute in. Default set to 'float64'. The precision can be
+           ["float64", "float32"] float32 halves the memory of the matrix and
+           distance data. invalid_data_action: What to do with all-NaN,
+           constant and non-finite rows and columns, checked before any
+           distance computation. Default set to 'keep' (only reported). The
+           action can be ["keep", "drop", "fail"] top_n_by_variance: Only
+           cluster the top N rows with the largest variance. min_variance:
+           Only cluster rows with a variance of at least min_variance.
+           variance_measure: The row variance measure used by
+           top_n_by_variance and min_variance. Default set to 'variance'. The
+           measure can be ["variance", "mad", "cv"] (median absolute
+           deviation, coefficient of variation) The kept row ids are recorded
+           in clustering_parameters. collapse_duplicates: Cluster identical
+           rows (and columns) once and expand the flat clusters back to every
+           id. Default set to 0. Only applied with the "single", "complete",
+           "weighted" and "median" linkage and the "distance" and "maxclust"
+           criterion, where the clusters are identical to clustering every
+           row. n_jobs: Number of processes computing the distance matrix.
+           Default set to 1. approximate: Build the linkage from an
+           approximate k-nearest-neighbor graph (random projection trees
+           refined by NN-descent) instead of the full distance matrix, for
+           matrices too large for exact clustering. Default set to 0. Only
+           the "single" and "average" linkage (default 'average') and the
+           "euclidean", "sqeuclidean", "cosine" and "correlation" metric
+           apply. The heatmap is not built in this mode. n_neighbors: Number
+           of nearest neighbors per row in the approximate mode. Default set
+           to 15. matrix_free: Build the linkage from cluster centroids
+           instead of the distance matrix, for matrices whose distance matrix
+           does not fit in memory. Default set to 0. Only the "ward",
+           "centroid" and "median" linkage (default 'ward') and the
+           "euclidean" metric apply. The linkage is the same as the exact
+           one.) -> structure: parameter "matrix_ref" of type "obj_ref" (An
+           X/Y/Z style reference), parameter "workspace_name" of String,
+           parameter "cluster_set_name" of String, parameter
+           "row_dist_cutoff_rate" of Double, parameter "col_dist_cutoff_rate"
+           of Double, parameter "row_dist_cutoff_rates" of list of Double,
+           parameter "col_dist_cutoff_rates" of list of Double, parameter
+           "row_maxclust" of list of Long, parameter "col_maxclust" of list
+           of Long, parameter "dist_metric" of String, parameter
+           "linkage_method" of String, parameter "fcluster_criterion" of
+           String, parameter "precision" of String, parameter
+           "invalid_data_action" of String, parameter "collapse_duplicates"
+           of type "boolean" (A boolean - 0 for false, 1 for true. @range (0,
+           1)), parameter "top_n_by_variance" of Long, parameter
+           "min_variance" of Double, parameter "variance_measure" of String,
+           parameter "n_jobs" of Long, parameter "approximate" of type
+           "boolean" (A boolean - 0 for false, 1 for true. @range (0, 1)),
+           parameter "n_neighbors" of Long, parameter "matrix_free" of type
+           "boolean" (A boolean - 0 for false, 1 for true. @range (0, 1))
         :returns: instance of type "HierClusterOutput" (Ouput of the
            run_hierarchical_cluster function cluster_set_refs:
            KBaseExperiments.ClusterSet object references report_name: report
@@ -92,10 +144,28 @@ class kb_ke_apps(object):
            "russellrao", "sokalmichener", "sokalsneath", "sqeuclidean",
            "yule"] Details refer to:
            https://docs.scipy.org/doc/scipy/reference/generated/scipy.spatial.
-           distance.pdist.html) -> structure: parameter "matrix_ref" of type
-           "obj_ref" (An X/Y/Z style reference), parameter "workspace_name"
-           of String, parameter "cluster_set_name" of String, parameter
-           "k_num" of Long, parameter "dist_metric" of String
+           distance.pdist.html precision: The floating point precision to
+           compute in. Default set to 'float64'. The precision can be
+           ["float64", "float32"] float32 halves the memory of the matrix and
+           distance data. invalid_data_action: What to do with all-NaN,
+           constant and non-finite rows and columns, checked before any
+           distance computation. Default set to 'keep' (only reported). The
+           action can be ["keep", "drop", "fail"] top_n_by_variance: Only
+           cluster the top N rows with the largest variance. min_variance:
+           Only cluster rows with a variance of at least min_variance.
+           variance_measure: The row variance measure used by
+           top_n_by_variance and min_variance. Default set to 'variance'. The
+           measure can be ["variance", "mad", "cv"] (median absolute
+           deviation, coefficient of variation) The kept row ids are recorded
+           in clustering_parameters. n_jobs: Number of processes computing
+           the distance matrix. Default set to 1.) -> structure: parameter
+           "matrix_ref" of type "obj_ref" (An X/Y/Z style reference),
+           parameter "workspace_name" of String, parameter "cluster_set_name"
+           of String, parameter "k_num" of Long, parameter "dist_metric" of
+           String, parameter "precision" of String, parameter
+           "invalid_data_action" of String, parameter "top_n_by_variance" of
+           Long, parameter "min_variance" of Double, parameter
+           "variance_measure" of String, parameter "n_jobs" of Long
         :returns: instance of type "KmeansClusterOutput" (Ouput of the
            run_kmeans_cluster function cluster_set_refs:
            KBaseExperiments.ClusterSet object references report_name: report
@@ -115,10 +185,20 @@ class kb_ke_apps(object):
            function cluster_set_ref: KBaseExperiments.ClusterSet object
            references workspace_name: the name of the workspace
            pca_matrix_name: name of PCA (KBaseFeatureValues.FloatMatrix2D)
-           object n_components - number of components (default 2)) ->
-           structure: parameter "cluster_set_ref" of type "obj_ref" (An X/Y/Z
-           style reference), parameter "workspace_name" of String, parameter
-           "pca_matrix_name" of String, parameter "n_components" of Long
+           object n_components - number of components (default 2) precision -
+           compute precision, "float64" (default) or "float32"
+           invalid_data_action - all-NaN, constant or non-finite rows and
+           columns are "keep" (default, only reported), "drop" or "fail"
+           top_n_by_variance - only project the top N most variable rows
+           min_variance - only project rows with at least this variance
+           variance_measure - "variance" (default), "mad" or "cv"
+           (coefficient of variation)) -> structure: parameter
+           "cluster_set_ref" of type "obj_ref" (An X/Y/Z style reference),
+           parameter "workspace_name" of String, parameter "pca_matrix_name"
+           of String, parameter "n_components" of Long, parameter "precision"
+           of String, parameter "invalid_data_action" of String, parameter
+           "top_n_by_variance" of Long, parameter "min_variance" of Double,
+           parameter "variance_measure" of String
         :returns: instance of type "PCAOutput" (Ouput of the run_pca function
            pca_ref: PCA object reference (as KBaseFeatureValues.FloatMatrix2D
            data type) report_name: report name generated by KBaseReport
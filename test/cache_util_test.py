@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+import unittest
+import inspect
+import shutil
+import tempfile
+import os
+import io
+from contextlib import redirect_stdout
+
+import numpy as np
+
+from kb_ke_apps.Utils.MatrixUtil import DataMatrix, SparseDataMatrix
+from kb_ke_apps.Utils.CacheUtil import MatrixCache, ArtifactCache, matrix_digest, artifact_key
+
+
+class CacheUtilTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def start_test(self):
+        testname = inspect.stack()[1][3]
+        print(('\n*** starting test: ' + testname + ' **'))
+
+    def gen_matrix(self, rows, cols):
+        values = np.arange(rows * cols, dtype=float).reshape(rows, cols)
+        return DataMatrix(values,
+                          ['gene_{}'.format(i) for i in range(rows)],
+                          ['condition_{}'.format(i) for i in range(cols)])
+
+    def test_matrix_cache_hit_and_miss(self):
+        self.start_test()
+        cache = MatrixCache(self.cache_dir)
+        matrix = self.gen_matrix(3, 4)
+
+        self.assertIsNone(cache.get('1/2/3'))
+        cache.put('1/2/3', matrix)
+
+        cached_matrix = cache.get('1/2/3')
+        self.assertFalse(cached_matrix.values.flags.writeable)
+        np.testing.assert_array_equal(cached_matrix.values, matrix.values)
+        self.assertEqual(cached_matrix.row_ids.tolist(), matrix.row_ids.tolist())
+        self.assertEqual(cached_matrix.col_index['condition_2'], 2)
+
+        self.assertIsNone(cache.get('1/2/4'))
+
+    def test_matrix_cache_lru_eviction(self):
+        self.start_test()
+        matrix = self.gen_matrix(10, 10)
+        cache = MatrixCache(self.cache_dir)
+
+        cache.put('1/1/1', matrix)
+        # room for two entries but not three
+        cache.max_bytes = int(2.5 * cache._entry_size(cache._entry_dir('1/1/1')))
+        cache.put('1/2/1', matrix)
+        cache.get('1/1/1')  # 1/2/1 becomes least recently used
+        cache.put('1/3/1', matrix)
+
+        self.assertIsNotNone(cache.get('1/1/1'))
+        self.assertIsNone(cache.get('1/2/1'))
+        self.assertIsNotNone(cache.get('1/3/1'))
+
+    def test_matrix_cache_sparse(self):
+        self.start_test()
+        cache = MatrixCache(self.cache_dir)
+        values = np.zeros((5, 6))
+        values[1, 2] = 3.
+        values[4, 0] = 1.5
+        matrix = SparseDataMatrix(values, ['gene_{}'.format(i) for i in range(5)],
+                                  ['condition_{}'.format(i) for i in range(6)])
+
+        cache.put('1/2/3', matrix)
+        cached_matrix = cache.get('1/2/3')
+
+        self.assertIsInstance(cached_matrix, SparseDataMatrix)
+        self.assertEqual(cached_matrix.values.nnz, 2)
+        np.testing.assert_array_equal(cached_matrix.values.toarray(), values)
+
+    def test_matrix_digest(self):
+        self.start_test()
+        matrix = self.gen_matrix(4, 3)
+        digest = matrix_digest(matrix)
+
+        self.assertEqual(matrix_digest(self.gen_matrix(4, 3)), digest)
+        self.assertNotEqual(matrix_digest(matrix.T), digest)
+        self.assertNotEqual(matrix_digest(matrix.astype(np.float32)), digest)
+        self.assertNotEqual(matrix_digest(SparseDataMatrix(matrix.values, matrix.row_ids,
+                                                           matrix.col_ids)), digest)
+
+        changed_values = matrix.values.copy()
+        changed_values[2, 1] += 1e-9
+        self.assertNotEqual(matrix_digest(DataMatrix(changed_values, matrix.row_ids,
+                                                     matrix.col_ids)), digest)
+        self.assertNotEqual(matrix_digest(DataMatrix(matrix.values, matrix.row_ids[::-1],
+                                                     matrix.col_ids)), digest)
+
+        self.assertEqual(artifact_key('linkage', digest, method='ward', metric='euclidean'),
+                         artifact_key('linkage', digest, metric='euclidean', method='ward'))
+        self.assertNotEqual(artifact_key('linkage', digest, metric='euclidean'),
+                            artifact_key('distance', digest, metric='euclidean'))
+
+    def test_artifact_cache(self):
+        self.start_test()
+        cache = ArtifactCache(self.cache_dir)
+        key = artifact_key('distance', matrix_digest(self.gen_matrix(4, 3)), metric='euclidean')
+        dist_matrix = np.arange(6, dtype=float)
+
+        self.assertIsNone(cache.get(key))
+        cached_dist_matrix, meta = cache.put(key, dist_matrix, meta={'labels': ['a', 'b']})
+        self.assertFalse(cached_dist_matrix.flags.writeable)
+        np.testing.assert_array_equal(cached_dist_matrix, dist_matrix)
+
+        cached_dist_matrix, meta = cache.get(key)
+        np.testing.assert_array_equal(cached_dist_matrix, dist_matrix)
+        self.assertEqual(meta, {'labels': ['a', 'b']})
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # files are moved into the cache
+        file_path = os.path.join(self.cache_dir, 'dist_matrix.npy')
+        np.save(file_path, dist_matrix * 2)
+        cached_dist_matrix, meta = cache.put_file('other key', file_path, meta=None)
+        self.assertFalse(os.path.exists(file_path))
+        np.testing.assert_array_equal(cache.get('other key')[0], dist_matrix * 2)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+        # too large artifacts are not cached
+        cache.max_bytes = 10
+        self.assertIs(cache.put('large key', dist_matrix)[0], dist_matrix)
+        np.save(file_path, dist_matrix)
+        self.assertIsNone(cache.put_file('large key', file_path))
+        self.assertTrue(os.path.exists(file_path))
+        self.assertIsNone(cache.get('large key'))
+
+    def test_artifact_cache_lru_eviction(self):
+        self.start_test()
+        cache = ArtifactCache(self.cache_dir)
+        artifact = np.zeros(1000)
+
+        cache.put('a', artifact)
+        # room for two entries but not three
+        cache.max_bytes = int(2.5 * cache._entry_size(cache._entry_dir('a')))
+        cache.put('b', artifact)
+        cache.get('a')  # b becomes least recently used
+        output = io.StringIO()
+        with redirect_stdout(output):
+            cache.put('c', artifact)
+        self.assertIn('evicting artifact cache entry', output.getvalue())
+
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
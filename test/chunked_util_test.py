@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+import unittest
+import inspect
+import shutil
+import tempfile
+import os
+import io
+import json
+from unittest import mock
+
+import numpy as np
+from scipy.spatial.distance import pdist
+
+from kb_ke_apps.Utils.MatrixUtil import DataMatrix
+from kb_ke_apps.Utils.ChunkedUtil import (ChunkedMatrixWriter, ChunkedDataMatrix, MatrixRowsParser,
+                                          write_matrix_rows, chunked_pdist, chunked_pca)
+from kb_ke_apps.Utils.NanUtil import nan_pca
+from kb_ke_apps.Utils.FilterUtil import find_invalid, filter_by_variance
+
+
+class ChunkedUtilTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store_root = tempfile.mkdtemp()
+        np.random.seed(3)
+        self.values = np.random.randn(23, 9)
+        self.values[4, 2] = np.nan
+        self.row_ids = ['gene_{}'.format(i) for i in range(23)]
+        self.col_ids = ['condition_{}'.format(i) for i in range(9)]
+
+    def tearDown(self):
+        shutil.rmtree(self.store_root, ignore_errors=True)
+
+    def start_test(self):
+        testname = inspect.stack()[1][3]
+        print(('\n*** starting test: ' + testname + ' **'))
+
+    def gen_chunked_matrix(self, values=None):
+        values = self.values if values is None else values
+        # 4 columns per block
+        writer = ChunkedMatrixWriter(os.path.join(self.store_root, 'store'),
+                                     self.row_ids, self.col_ids,
+                                     block_bytes=4 * 8 * values.shape[0])
+        self.assertEqual(len(writer.blocks), 3)
+        for start in range(0, values.shape[0], 5):
+            rows = values[start:start + 5].tolist()
+            rows = [[None if np.isnan(value) else value for value in row] for row in rows]
+            writer.write_rows(rows)
+        return writer.close()
+
+    def test_write_and_read(self):
+        self.start_test()
+        self.assertIsNone(ChunkedDataMatrix.open(os.path.join(self.store_root, 'store')))
+        matrix = self.gen_chunked_matrix()
+
+        reopened = ChunkedDataMatrix.open(matrix.store_dir)
+        self.assertEqual(reopened.shape, (23, 9))
+        np.testing.assert_array_equal(reopened.read(), self.values)
+        np.testing.assert_array_equal(matrix.read(row_pos=[7, 1], col_pos=[8, 0, 5]),
+                                      self.values[np.ix_([7, 1], [8, 0, 5])])
+
+        blocks = list(matrix.iter_row_blocks(block_rows=10))
+        self.assertEqual([(start, end) for start, end, _ in blocks], [(0, 10), (10, 20),
+                                                                      (20, 23)])
+        np.testing.assert_array_equal(np.vstack([values for _, _, values in blocks]),
+                                      self.values)
+
+    def gen_ws_response(self, values):
+        # get_objects2 response as the workspace sends it, members off the values path
+        # (including keys named values) come first
+        rows = [[None if np.isnan(value) else value for value in row] for row in values.tolist()]
+        response = {'version': '1.1',
+                    'id': '12345678',
+                    'result': [{'data': [{
+                        'info': [1, 'matrix', 'KBaseMatrices.ExpressionMatrix-1.0',
+                                 '2018-01-01T00:00:00+0000', 3, 'user', 7, 'ws', 'md5',
+                                 10 ** 10, {'values': 'meta [1, 2]'}],
+                        'provenance': [{'method_params': [{'values': [[1, 2], [3]]}]}],
+                        'data': {'scale': 'raw', 'data': {'values': rows}}}]}]}
+        return json.dumps(response).encode('utf-8')
+
+    def test_matrix_rows_parser(self):
+        self.start_test()
+        payload = self.gen_ws_response(self.values)
+
+        for chunk_size in [7, 64, 1024 * 1024]:
+            parser = MatrixRowsParser(io.BytesIO(payload), chunk_size=chunk_size)
+            batches = list(parser.iter_rows(batch_rows=5))
+            self.assertEqual([len(rows) for rows in batches], [5, 5, 5, 5, 3])
+            rows = np.array([row for rows in batches for row in rows], dtype=float)
+            np.testing.assert_array_equal(rows, self.values)
+
+        empty = self.gen_ws_response(np.empty((0, 9)))
+        self.assertEqual(list(MatrixRowsParser(io.BytesIO(empty)).iter_rows(batch_rows=5)), [])
+
+        error = json.dumps({'version': '1.1', 'error': {'message': 'no access'}})
+        with self.assertRaisesRegex(ValueError, 'Invalid workspace response'):
+            list(MatrixRowsParser(io.BytesIO(error.encode('utf-8'))).iter_rows(batch_rows=5))
+
+    def test_write_matrix_rows(self):
+        self.start_test()
+        # mocked workspace: the streamed get_objects2 response body
+        stream = io.BytesIO(self.gen_ws_response(self.values))
+        store_dir = os.path.join(self.store_root, 'store')
+
+        with mock.patch.object(ChunkedMatrixWriter, 'write_rows', autospec=True,
+                               side_effect=ChunkedMatrixWriter.write_rows) as write_rows:
+            matrix = write_matrix_rows(stream, store_dir, self.row_ids, self.col_ids,
+                                       batch_rows=10)
+
+        # rows are written in order, a batch at a time
+        self.assertEqual([len(call[0][1]) for call in write_rows.call_args_list], [10, 10, 3])
+        self.assertEqual(matrix.row_ids.tolist(), self.row_ids)
+        np.testing.assert_array_equal(matrix.read(), self.values)
+
+    def test_transpose(self):
+        self.start_test()
+        matrix = self.gen_chunked_matrix()
+        transpose_matrix = matrix.T
+
+        self.assertEqual(transpose_matrix.shape, (9, 23))
+        self.assertIs(transpose_matrix.row_index, matrix.col_index)
+        np.testing.assert_array_equal(transpose_matrix.read(), self.values.T)
+        np.testing.assert_array_equal(
+                np.vstack([values for _, _, values in transpose_matrix.iter_row_blocks()]),
+                self.values.T)
+        np.testing.assert_array_equal(
+                np.hstack([values for _, _, values in transpose_matrix.iter_col_blocks()]),
+                self.values.T)
+
+    def test_take_and_astype(self):
+        self.start_test()
+        matrix = self.gen_chunked_matrix()
+
+        sub_matrix = matrix.T.take(row_pos=[1, 3], col_pos=[0, 4, 22])
+        self.assertEqual(sub_matrix.row_ids.tolist(), ['condition_1', 'condition_3'])
+        np.testing.assert_array_equal(sub_matrix.read(), self.values[np.ix_([0, 4, 22], [1, 3])].T)
+
+        single_matrix = matrix.astype('float32')
+        self.assertEqual(single_matrix.read().dtype, np.float32)
+        np.testing.assert_allclose(single_matrix.read(), self.values, rtol=1e-6)
+
+    def test_chunked_pdist(self):
+        self.start_test()
+        matrix = self.gen_chunked_matrix(np.abs(self.values))
+        values = np.abs(self.values)
+
+        for metric in ['euclidean', 'cityblock', 'correlation']:
+            for block_rows in [4, 7, 100]:
+                np.testing.assert_allclose(chunked_pdist(matrix, metric, block_rows=block_rows),
+                                           pdist(values, metric))
+        np.testing.assert_allclose(chunked_pdist(matrix.T, 'euclidean'), pdist(values.T))
+
+    def test_chunked_pca(self):
+        self.start_test()
+        values = self.values.copy()
+        values[4, 2] = 0.5
+        matrix = self.gen_chunked_matrix(values)
+
+        for chunked, dense in [(matrix, values), (matrix.T, values.T)]:
+            centered = dense - dense.mean(axis=0)
+            u, s, _ = np.linalg.svd(centered, full_matrices=False)
+            scores = chunked_pca(chunked, n_components=3)
+            np.testing.assert_allclose(np.abs(scores), np.abs(u[:, :3] * s[:3]), atol=1e-8)
+
+    def test_chunked_pca_missing_values(self):
+        self.start_test()
+        # missing values: same scores as the dense NaN-aware PCA
+        matrix = self.gen_chunked_matrix()
+        np.testing.assert_allclose(chunked_pca(matrix, n_components=3),
+                                   nan_pca(self.values, n_components=3), atol=1e-10)
+
+        with self.assertRaisesRegex(ValueError, 'missing values'):
+            chunked_pca(matrix.T, n_components=3)
+
+    def test_filter_chunked(self):
+        self.start_test()
+        values = self.values.copy()
+        values[6] = 1.
+        values[:, 3] = np.inf
+        matrix = self.gen_chunked_matrix(values)
+        dense_matrix = DataMatrix(values, self.row_ids, self.col_ids)
+
+        self.assertEqual(find_invalid(matrix), find_invalid(dense_matrix))
+        self.assertEqual(find_invalid(matrix.T), find_invalid(dense_matrix.T))
+        self.assertEqual(filter_by_variance(matrix.T, top_n=4)[1],
+                         filter_by_variance(dense_matrix.T, top_n=4)[1])
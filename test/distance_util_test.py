@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+import unittest
+import inspect
+import shutil
+import tempfile
+import os
+import io
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.spatial.distance import pdist, squareform
+from scipy.cluster.vq import kmeans2
+
+from kb_ke_apps.Utils.MatrixUtil import DataMatrix, SparseDataMatrix
+from kb_ke_apps.Utils.SparseUtil import sparse_pdist
+from kb_ke_apps.Utils.ChunkedUtil import ChunkedMatrixWriter, chunked_pdist
+from kb_ke_apps.Utils.DistanceUtil import (BLAS_METRIC, BOOLEAN_METRIC, TILE_COPIES,
+                                            calc_dist_matrix, blas_pdist, boolean_pdist,
+                                            tiled_pdist, budget_block_rows, pack_rows,
+                                            is_binary, balanced_row_bounds, shared_condensed,
+                                            parallel_fill, distributed_pdist, plane_jobs,
+                                            square_row_block,
+                                            kmeans_condensed, _popcount,
+                                            _POPCOUNT_TABLE)
+
+
+class LocalJobService:
+    """
+    LocalJobService: in-process stand-in for the kb_ke_util job service
+
+    run_pdist jobs run on a thread pool; jobs are reported unfinished for the first
+    check so callers have to poll.
+    """
+
+    def __init__(self, max_workers=4):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.jobs = {}
+        self.checks = {}
+        self.job_rows = []
+        self.max_running = 0
+
+    def _run_pdist(self, params):
+        data_matrix = pd.read_json(io.StringIO(params['data_matrix']))
+        return {'dist_matrix': pdist(data_matrix.values,
+                                     metric=params.get('metric') or 'euclidean').tolist(),
+                'labels': data_matrix.index.tolist()}
+
+    def _run_pdist_submit(self, params, context=None):
+        job_id = str(uuid.uuid4())
+        self.job_rows.append(len(pd.read_json(io.StringIO(params['data_matrix']))))
+        self.jobs[job_id] = self.executor.submit(self._run_pdist, params)
+        self.checks[job_id] = 0
+        self.max_running = max(self.max_running, len(self.jobs))
+        return job_id
+
+    def _check_job(self, job_id):
+        self.checks[job_id] += 1
+        job = self.jobs[job_id]
+        if self.checks[job_id] == 1 or not job.done():
+            return {'finished': 0}
+        del self.jobs[job_id]
+        return {'finished': 1, 'result': [job.result()]}
+
+
+class FlakyJobService(LocalJobService):
+    """
+    FlakyJobService: job service whose status checks fail with a connection error a given
+                     number of times in a row, or whose jobs fail
+    """
+
+    def __init__(self, check_failures=0, fail_jobs=False):
+        super(FlakyJobService, self).__init__()
+        self.check_failures = check_failures
+        self.fail_jobs = fail_jobs
+
+    def _check_job(self, job_id):
+        if self.check_failures:
+            self.check_failures -= 1
+            raise ConnectionError('connection reset')
+        if self.fail_jobs:
+            return {'finished': 1, 'error': {'message': 'out of memory'}}
+        return super(FlakyJobService, self)._check_job(job_id)
+
+
+class DistanceUtilTest(unittest.TestCase):
+
+    METRIC = ["braycurtis", "canberra", "chebyshev", "cityblock", "correlation", "cosine",
+              "dice", "euclidean", "hamming", "jaccard", "matching", "rogerstanimoto",
+              "russellrao", "sokalmichener", "sokalsneath", "sqeuclidean", "yule"]
+
+    BOOLEAN_METRIC = ["dice", "jaccard", "matching", "rogerstanimoto", "russellrao",
+                      "sokalmichener", "sokalsneath", "yule"]
+
+    @classmethod
+    def setUpClass(cls):
+        np.random.seed(4)
+        values = np.random.rand(30, 8)
+        values[values < 0.6] = 0
+        cls.values = values
+        cls.row_ids = ['gene_{}'.format(i) for i in range(30)]
+        cls.col_ids = ['condition_{}'.format(i) for i in range(8)]
+
+    def setUp(self):
+        self.store_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.store_root, ignore_errors=True)
+
+    def start_test(self):
+        testname = inspect.stack()[1][3]
+        print(('\n*** starting test: ' + testname + ' **'))
+
+    def gen_matrices(self, values):
+        writer = ChunkedMatrixWriter(os.path.join(self.store_root, str(len(os.listdir(
+                                                                        self.store_root)))),
+                                     self.row_ids, self.col_ids, block_bytes=3 * 8 * 30)
+        writer.write_rows(values)
+        return [DataMatrix(values, self.row_ids, self.col_ids),
+                SparseDataMatrix(sp.csr_matrix(values), self.row_ids, self.col_ids),
+                writer.close()]
+
+    def test_calc_dist_matrix(self):
+        self.start_test()
+        for metric in self.METRIC:
+            values = self.values
+            if metric in self.BOOLEAN_METRIC:
+                values = (values > 0).astype(float)
+            try:
+                expected = pdist(values, metric=metric)
+            except ValueError:
+                # metric dropped by the installed scipy, see test_boolean_pdist
+                continue
+
+            for matrix in self.gen_matrices(values):
+                dist_matrix = calc_dist_matrix(matrix, metric=metric)
+                self.assertIsInstance(dist_matrix, np.ndarray)
+                np.testing.assert_allclose(dist_matrix, expected, atol=1e-10,
+                                           err_msg='{} {}'.format(metric,
+                                                                  type(matrix).__name__))
+
+    def test_calc_dist_matrix_default_metric(self):
+        self.start_test()
+        matrix = self.gen_matrices(self.values)[0]
+        np.testing.assert_allclose(calc_dist_matrix(matrix, metric=None), pdist(self.values))
+
+    def reference_boolean_dist(self, u, v, metric):
+        # kulsinski and sokalmichener as defined by scipy before their removal
+        ntt = np.sum(u & v)
+        not_equal = np.sum(u != v)
+        nff = u.size - ntt - not_equal
+        if metric == 'kulsinski':
+            return float(not_equal - ntt + u.size) / (not_equal + u.size)
+        return 2. * not_equal / (ntt + nff + 2. * not_equal)
+
+    def test_boolean_pdist(self):
+        self.start_test()
+        np.random.seed(6)
+        values = (np.random.rand(70, 150) < 0.2).astype(float)
+        values[0] = values[1] = 0  # all false rows
+        values[2] = 1
+        bool_values = values.astype(bool)
+
+        for matrix in self.gen_matrices(values[:30, :8]) + [DataMatrix(values, range(70),
+                                                                        range(150))]:
+            self.assertTrue(is_binary(matrix))
+
+        packed = pack_rows(DataMatrix(values, range(70), range(150)))
+        self.assertEqual(packed.shape, (70, 3))
+        self.assertEqual(packed.dtype, np.uint64)
+
+        for metric in BOOLEAN_METRIC:
+            dist_matrix = boolean_pdist(packed, 150, metric, block_rows=16)
+            try:
+                expected = pdist(bool_values, metric=metric)
+            except ValueError:
+                expected = np.array([self.reference_boolean_dist(bool_values[i],
+                                                                 bool_values[j], metric)
+                                     for i in range(70) for j in range(i + 1, 70)])
+            np.testing.assert_allclose(dist_matrix, expected, equal_nan=True,
+                                       err_msg=metric)
+
+    def test_boolean_dispatch(self):
+        self.start_test()
+        values = np.array([[0, 2.5, 1], [1, 0, 0], [3, 3, 0]])
+        matrix = DataMatrix(values, ['gene_1', 'gene_2', 'gene_3'], ['c1', 'c2', 'c3'])
+        self.assertFalse(is_binary(matrix))
+
+        # removed scipy metrics use the non-zero pattern of any matrix
+        expected = [self.reference_boolean_dist(values[i] != 0, values[j] != 0, 'kulsinski')
+                    for i, j in [(0, 1), (0, 2), (1, 2)]]
+        np.testing.assert_allclose(calc_dist_matrix(matrix, 'kulsinski'), expected)
+
+        # value based metrics are left to scipy for non binary matrices
+        np.testing.assert_allclose(calc_dist_matrix(matrix, 'hamming'),
+                                   pdist(values, 'hamming'))
+
+    def test_popcount(self):
+        self.start_test()
+        words = np.random.randint(0, 2 ** 62, size=(5, 4)).astype(np.uint64)
+        expected = [[bin(int(word)).count('1') for word in row] for row in words]
+        np.testing.assert_array_equal(_popcount(words), expected)
+        np.testing.assert_array_equal(
+                _POPCOUNT_TABLE[words.view(np.uint8)].reshape(5, 4, 8).sum(axis=-1), expected)
+
+    def test_calc_dist_matrix_unknown_metric(self):
+        self.start_test()
+        matrix = self.gen_matrices(self.values)[0]
+        with self.assertRaises(ValueError):
+            calc_dist_matrix(matrix, metric='unknown_metric')
+
+    def test_blas_pdist(self):
+        self.start_test()
+        np.random.seed(5)
+        values = np.random.rand(300, 12) * 100 + 1000
+        values = np.vstack([values, values[:20]])  # exact duplicates
+        values[7, 3] = np.nan
+
+        for metric in BLAS_METRIC:
+            expected = pdist(values, metric=metric)
+            for block_rows in [64, 2048]:
+                dist_matrix = blas_pdist(values, metric=metric, block_rows=block_rows)
+                self.assertEqual(dist_matrix.dtype, np.float64)
+                np.testing.assert_allclose(dist_matrix, expected, rtol=1e-7, atol=1e-9)
+                if metric in ['euclidean', 'sqeuclidean']:
+                    # duplicates are recomputed directly instead of from the Gram matrix
+                    self.assertTrue((dist_matrix[expected == 0] == 0).all())
+
+            single_dist_matrix = blas_pdist(values.astype(np.float32), metric=metric)
+            self.assertEqual(single_dist_matrix.dtype, np.float32)
+            np.testing.assert_allclose(single_dist_matrix, expected, rtol=1e-3, atol=1e-3)
+
+        with self.assertRaisesRegex(ValueError, 'no BLAS fast path'):
+            blas_pdist(values, metric='cityblock')
+
+    def test_tiled_pdist(self):
+        self.start_test()
+        for metric in ['canberra', 'chebyshev', 'cityblock', 'euclidean']:
+            expected = pdist(self.values, metric=metric)
+            for block_rows in [1, 7, 29, 30, 64]:
+                np.testing.assert_allclose(tiled_pdist(self.values, metric=metric,
+                                                       block_rows=block_rows), expected)
+
+    def test_budget_block_rows(self):
+        self.start_test()
+        self.assertEqual(budget_block_rows(1000, memory_bytes=TILE_COPIES * 8 * 1000 * 10), 10)
+        self.assertEqual(budget_block_rows(1000, memory_bytes=1), 1)
+        self.assertEqual(budget_block_rows(1000, memory_bytes=10 ** 12), 1000)
+        self.assertEqual(budget_block_rows(1000, memory_bytes=100, row_bytes=10), 10)
+
+    def test_calc_dist_matrix_memmap(self):
+        self.start_test()
+        for metric in ['euclidean', 'cityblock', 'jaccard', 'yule']:
+            values = (self.values > 0).astype(float) if metric == 'yule' else self.values
+            expected = pdist(values, metric=metric)
+            for matrix in self.gen_matrices(values):
+                # budgets from a single row per block to the whole matrix
+                for memory_bytes in [1, 5 * TILE_COPIES * 8 * 30, 2 ** 30]:
+                    out_path = os.path.join(self.store_root, 'dist_matrix.npy')
+                    dist_matrix = calc_dist_matrix(matrix, metric=metric, out_path=out_path,
+                                                   memory_bytes=memory_bytes)
+                    self.assertIsInstance(dist_matrix, np.memmap)
+                    np.testing.assert_allclose(dist_matrix, expected, atol=1e-12)
+
+                    dist_matrix.flush()
+                    np.testing.assert_allclose(np.load(out_path, mmap_mode='r'), expected,
+                                               atol=1e-12)
+                    del dist_matrix
+                    os.remove(out_path)
+
+        # float32 matrices are written as float32
+        out_path = os.path.join(self.store_root, 'dist_matrix.npy')
+        matrix = DataMatrix(self.values.astype(np.float32), self.row_ids, self.col_ids)
+        dist_matrix = calc_dist_matrix(matrix, out_path=out_path)
+        self.assertEqual(dist_matrix.dtype, np.float32)
+        np.testing.assert_allclose(dist_matrix, pdist(self.values), rtol=1e-4, atol=1e-4)
+
+    def test_balanced_row_bounds(self):
+        self.start_test()
+        for n_rows in [2, 3, 30, 1000]:
+            for n_tiles in [1, 2, 7, 64]:
+                row_bounds = balanced_row_bounds(n_rows, n_tiles)
+                # contiguous ranges covering every row with pairs
+                self.assertEqual(row_bounds[0][0], 0)
+                self.assertEqual(row_bounds[-1][1], n_rows - 1)
+                for (first, last), (next_first, next_last) in zip(row_bounds, row_bounds[1:]):
+                    self.assertEqual(last, next_first)
+                self.assertLessEqual(len(row_bounds), n_tiles)
+
+        pairs = [sum([1000 - i - 1 for i in range(first, last)])
+                 for first, last in balanced_row_bounds(1000, 8)]
+        self.assertLess(max(pairs) - min(pairs), 1000)
+
+        self.assertEqual(balanced_row_bounds(30, 3, boundaries=[0, 10, 20]),
+                         [(0, 10), (10, 20), (20, 29)])
+
+    def test_parallel_fill(self):
+        self.start_test()
+        dense_matrix, sparse_matrix, chunked_matrix = self.gen_matrices(self.values)
+        expected = pdist(self.values, 'euclidean')
+        boundaries = [start for start, end in chunked_matrix._row_bounds()]
+
+        tasks = [(lambda out, rows: tiled_pdist(self.values, 'euclidean', block_rows=4,
+                                                out=out, rows=rows), None),
+                 (lambda out, rows: blas_pdist(self.values, 'euclidean', block_rows=4,
+                                               out=out, rows=rows), None),
+                 (lambda out, rows: sparse_pdist(sparse_matrix.values, 'euclidean',
+                                                 block_rows=4, out=out, rows=rows), None),
+                 (lambda out, rows: chunked_pdist(chunked_matrix, 'euclidean', out=out,
+                                                  rows=rows), boundaries)]
+
+        for task, task_boundaries in tasks:
+            dist_matrix = shared_condensed(30)
+            row_bounds = balanced_row_bounds(30, 5, boundaries=task_boundaries)
+            parallel_fill(lambda rows: task(dist_matrix, rows), row_bounds, 3)
+            np.testing.assert_allclose(dist_matrix, expected, atol=1e-12)
+
+        # worker errors reach the caller
+        def fail(rows):
+            raise ValueError('bad rows {}'.format(rows))
+        with self.assertRaisesRegex(ValueError, 'bad rows'):
+            parallel_fill(fail, [(0, 1)], 2)
+
+    def test_distributed_pdist(self):
+        self.start_test()
+        for matrix in self.gen_matrices(self.values):
+            for metric in ['euclidean', 'cityblock']:
+                expected = pdist(self.values, metric=metric)
+                for block_rows, max_jobs in [(7, 3), (10, 16), (29, 2), (30, 1), (64, 4)]:
+                    job_service = LocalJobService()
+                    dist_matrix = distributed_pdist(matrix, metric, job_service,
+                                                    block_rows=block_rows, max_jobs=max_jobs,
+                                                    check_time=0.001)
+                    np.testing.assert_allclose(dist_matrix, expected, atol=1e-12)
+                    self.assertLessEqual(job_service.max_running, max_jobs)
+                    self.assertFalse(job_service.jobs)
+                    # jobs hold at most two blocks' worth of rows, one line of the plane each
+                    n_jobs = len(plane_jobs(len(self.values), 2 * block_rows)[1])
+                    self.assertEqual(len(job_service.checks), n_jobs)
+                    self.assertLessEqual(max(job_service.job_rows), 2 * block_rows)
+
+        # results land in the given output buffer
+        out_path = os.path.join(self.store_root, 'dist_matrix.npy')
+        out = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.float64,
+                                        shape=(len(expected),))
+        dist_matrix = distributed_pdist(self.gen_matrices(self.values)[0], 'euclidean',
+                                        LocalJobService(), block_rows=8, out=out,
+                                        check_time=0.001)
+        self.assertIs(dist_matrix, out)
+        np.testing.assert_allclose(np.load(out_path), pdist(self.values), atol=1e-12)
+
+    def test_plane_jobs(self):
+        self.start_test()
+        self.assertEqual(plane_jobs(1, 10), ([(0, 1)], []))
+        self.assertEqual(plane_jobs(10, 10), ([(0, 10)], [([0], {0})]))
+
+        for n_rows, job_rows in [(30, 20), (30, 14), (100, 7), (1000, 64), (5, 2)]:
+            block_bounds, jobs = plane_jobs(n_rows, job_rows)
+            sizes = np.array([end - start for start, end in block_bounds])
+            self.assertEqual(sizes.sum(), n_rows)
+            self.assertEqual(block_bounds[0][0], 0)
+
+            # every pair of non-empty blocks in exactly one job
+            pair_count = {}
+            for blocks, own_blocks in jobs:
+                self.assertLessEqual(sizes[blocks].sum(), job_rows)
+                for pos, block in enumerate(blocks):
+                    for other in blocks[pos + 1:]:
+                        pair = (min(block, other), max(block, other))
+                        pair_count[pair] = pair_count.get(pair, 0) + 1
+            filled = [block for block in range(len(sizes)) if sizes[block]]
+            self.assertEqual(sorted(pair_count),
+                             [(block, other) for pos, block in enumerate(filled)
+                              for other in filled[pos + 1:]])
+            self.assertEqual(set(pair_count.values()), {1})
+
+            # in-block pairs of every block with pairs filled by exactly one job
+            owners = [block for blocks, own_blocks in jobs for block in own_blocks
+                      if sizes[block] > 1]
+            self.assertEqual(sorted(owners), [block for block in filled if sizes[block] > 1])
+
+            # about one in q computed pairs is a duplicate
+            computed = sum(sizes[blocks].sum() * (sizes[blocks].sum() - 1) // 2
+                           for blocks, own_blocks in jobs)
+            prime = int(round(len(sizes) ** 0.5))
+            self.assertLessEqual(computed, n_rows * (n_rows - 1) // 2 * (1 + 1.0 / prime) + 1)
+
+    def test_distributed_pdist_failures(self):
+        self.start_test()
+        matrix = self.gen_matrices(self.values)[0]
+
+        # connection errors while polling are retried
+        dist_matrix = distributed_pdist(matrix, 'euclidean', FlakyJobService(check_failures=2),
+                                        block_rows=10, check_time=0.001)
+        np.testing.assert_allclose(dist_matrix, pdist(self.values), atol=1e-12)
+
+        with self.assertRaises(ConnectionError):
+            distributed_pdist(matrix, 'euclidean', FlakyJobService(check_failures=3),
+                              block_rows=10, max_jobs=1, check_time=0.001)
+
+        with self.assertRaisesRegex(ValueError, r'row blocks \[0:7\], \[15:22\] failed'):
+            distributed_pdist(matrix, 'euclidean', FlakyJobService(fail_jobs=True),
+                              block_rows=10, max_jobs=1, check_time=0.001)
+
+    def test_square_row_block(self):
+        self.start_test()
+        dist_matrix = pdist(self.values)
+        square = squareform(dist_matrix)
+        n = len(self.values)
+        for start, end in [(0, 1), (0, n), (3, 11), (29, 30), (12, 13)]:
+            np.testing.assert_array_equal(square_row_block(dist_matrix, n, start, end),
+                                          square[start:end])
+
+    def test_kmeans_condensed(self):
+        self.start_test()
+        np.random.seed(7)
+        centers = np.array([[0, 0], [10, 0], [0, 10]])
+        values = np.vstack([center + np.random.rand(20, 2) for center in centers])
+        dist_matrix = pdist(values)
+
+        for block_rows in [7, 1024]:
+            centroids, idx = kmeans_condensed(dist_matrix, 3, block_rows=block_rows)
+            self.assertEqual(centroids.shape, (3, len(values)))
+            self.assertEqual(len(idx), len(values))
+            # same clustering as kmeans2 on the square rows, up to cluster numbering
+            expected = kmeans2(squareform(dist_matrix), centroids, minit='matrix')[1]
+            self.assertEqual(len(set(zip(idx.tolist(), expected.tolist()))), 3)
+            self.assertEqual(len(set(idx[:20])), 1)
+            self.assertEqual(len(set(idx)), 3)
+
+        with self.assertRaises(ValueError):
+            kmeans_condensed(dist_matrix[:-1], 3)
+        with self.assertRaises(ValueError):
+            kmeans_condensed(dist_matrix, len(values) + 1)
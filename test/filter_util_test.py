@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import unittest
+import inspect
+
+import numpy as np
+from scipy.cluster.hierarchy import linkage, fcluster, is_valid_linkage
+from scipy.spatial.distance import pdist
+
+from kb_ke_apps.Utils.MatrixUtil import DataMatrix, SparseDataMatrix
+from kb_ke_apps.Utils.FilterUtil import (find_invalid, prune_invalid,
+                                         collapse_duplicate_rows, expand_duplicate_linkage,
+                                         row_dispersion, filter_by_variance)
+
+
+class FilterUtilTest(unittest.TestCase):
+
+    def setUp(self):
+        self.matrix = DataMatrix([[0.1, 0.2, 0.3, 0.4],
+                                  [0.3, 0.4, 0.5, 0.6],
+                                  [np.nan, np.nan, np.nan, np.nan],
+                                  [1., 1., np.nan, 1.],
+                                  [0.5, np.inf, 0.1, 0.2]],
+                                 ['gene_{}'.format(i) for i in range(1, 6)],
+                                 ['condition_{}'.format(i) for i in range(1, 5)])
+
+    def start_test(self):
+        testname = inspect.stack()[1][3]
+        print(('\n*** starting test: ' + testname + ' **'))
+
+    def test_find_invalid(self):
+        self.start_test()
+        invalid = find_invalid(self.matrix)
+
+        self.assertEqual(invalid['rows'], {'all_nan': ['gene_3'],
+                                           'constant': ['gene_4'],
+                                           'non_finite': ['gene_5']})
+        self.assertEqual(invalid['cols'], {'all_nan': [],
+                                           'constant': [],
+                                           'non_finite': ['condition_2']})
+
+    def test_find_invalid_sparse(self):
+        self.start_test()
+        values = np.zeros((4, 5))
+        values[0, 1] = 2.
+        values[1, :] = 3.
+        values[2, 3] = np.inf
+        matrix = SparseDataMatrix(values, ['gene_{}'.format(i) for i in range(4)],
+                                  ['condition_{}'.format(i) for i in range(5)])
+        invalid = find_invalid(matrix)
+
+        self.assertEqual(invalid['rows'], {'all_nan': [],
+                                           'constant': ['gene_1', 'gene_3'],
+                                           'non_finite': ['gene_2']})
+        self.assertEqual(invalid['cols']['non_finite'], ['condition_3'])
+        self.assertEqual(invalid['cols']['constant'], [])
+
+    def test_prune_invalid(self):
+        self.start_test()
+        matrix, invalid = prune_invalid(self.matrix, 'keep')
+        self.assertIs(matrix, self.matrix)
+
+        matrix, invalid = prune_invalid(self.matrix, 'drop')
+        self.assertEqual(matrix.row_ids.tolist(), ['gene_1', 'gene_2'])
+        self.assertEqual(matrix.col_ids.tolist(), ['condition_1', 'condition_3', 'condition_4'])
+        self.assertEqual(matrix.row_index, {'gene_1': 0, 'gene_2': 1})
+        np.testing.assert_array_equal(matrix.values, [[0.1, 0.3, 0.4], [0.3, 0.5, 0.6]])
+
+        with self.assertRaisesRegex(ValueError, 'Matrix contains invalid rows or columns'):
+            prune_invalid(self.matrix, 'fail')
+
+        valid_matrix = matrix
+        matrix, invalid = prune_invalid(valid_matrix, 'fail')
+        self.assertIs(matrix, valid_matrix)
+
+    def partition(self, cluster_ids):
+        clusters = {}
+        for pos, cluster_id in enumerate(cluster_ids):
+            clusters.setdefault(cluster_id, []).append(pos)
+        return sorted(clusters.values())
+
+    def test_collapse_duplicate_rows(self):
+        self.start_test()
+        matrix = DataMatrix([[1., -0., 2.], [1., 0., 2.], [np.nan, 1., 1.],
+                             [3., 3., 3.], [np.nan, 1., 1.], [1., 0., 2.]],
+                            ['gene_{}'.format(i) for i in range(6)],
+                            ['condition_{}'.format(i) for i in range(3)])
+
+        unique_matrix, duplicates = collapse_duplicate_rows(matrix)
+
+        self.assertEqual(unique_matrix.row_ids.tolist(), ['gene_0', 'gene_2', 'gene_3'])
+        self.assertEqual(duplicates, {'gene_0': ['gene_1', 'gene_5'], 'gene_2': ['gene_4']})
+
+        sparse_matrix, sparse_duplicates = collapse_duplicate_rows(
+                                        SparseDataMatrix(np.nan_to_num(matrix.values),
+                                                         matrix.row_ids, matrix.col_ids))
+        self.assertEqual(sparse_matrix.row_ids.tolist(), ['gene_0', 'gene_2', 'gene_3'])
+        self.assertEqual(sparse_duplicates, duplicates)
+
+        self.assertIs(collapse_duplicate_rows(unique_matrix)[0], unique_matrix)
+
+    def test_expand_duplicate_linkage(self):
+        self.start_test()
+        np.random.seed(3)
+        unique_values = np.random.rand(30, 5)
+        row_pos = np.concatenate([np.arange(30), np.random.randint(0, 30, 60)])
+        np.random.shuffle(row_pos)
+        matrix = DataMatrix(unique_values[row_pos],
+                            ['gene_{}'.format(i) for i in range(90)],
+                            ['condition_{}'.format(i) for i in range(5)])
+        unique_matrix, duplicates = collapse_duplicate_rows(matrix)
+
+        for method in ['single', 'complete', 'weighted', 'median']:
+            full_linkage = linkage(pdist(matrix.values), method)
+            expanded_linkage = expand_duplicate_linkage(
+                                    linkage(pdist(unique_matrix.values), method),
+                                    unique_matrix.row_ids.tolist(), duplicates,
+                                    matrix.row_ids.tolist())
+
+            self.assertTrue(is_valid_linkage(expanded_linkage, throw=True))
+            np.testing.assert_allclose(np.sort(expanded_linkage[:, 2]),
+                                       np.sort(full_linkage[:, 2]))
+            for criterion, t in [('distance', 0.5), ('maxclust', 5)]:
+                self.assertEqual(
+                    self.partition(fcluster(full_linkage, t, criterion=criterion)),
+                    self.partition(fcluster(expanded_linkage, t, criterion=criterion)))
+
+        unique_linkage = linkage(pdist(unique_matrix.values), 'single')
+        np.testing.assert_array_equal(
+                expand_duplicate_linkage(unique_linkage, unique_matrix.row_ids.tolist(), {},
+                                         unique_matrix.row_ids.tolist()), unique_linkage)
+
+    def test_row_dispersion(self):
+        self.start_test()
+        values = np.array([[1., 2., 3., 10.], [0., 0., 0., 4.], [2., np.nan, 2., 4.]])
+        matrix = DataMatrix(values, ['gene_1', 'gene_2', 'gene_3'],
+                            ['condition_{}'.format(i) for i in range(4)])
+
+        np.testing.assert_allclose(row_dispersion(matrix, 'variance'),
+                                   [np.var([1, 2, 3, 10]), 3., np.var([2, 2, 4])])
+        np.testing.assert_allclose(row_dispersion(matrix, 'mad'), [1., 0., 0.])
+        np.testing.assert_allclose(row_dispersion(matrix, 'cv'),
+                                   [np.std([1, 2, 3, 10]) / 4., np.sqrt(3.),
+                                    np.std([2, 2, 4]) / (8 / 3.)])
+
+        sparse_matrix = SparseDataMatrix(np.nan_to_num(values), matrix.row_ids, matrix.col_ids)
+        np.testing.assert_allclose(row_dispersion(sparse_matrix, 'variance', block_rows=2),
+                                   np.var(np.nan_to_num(values), axis=1))
+
+    def test_filter_by_variance(self):
+        self.start_test()
+        np.random.seed(2)
+        values = np.random.randn(100, 6) * np.arange(1, 101)[:, None]
+        variance = np.var(values, axis=1)
+        values[10] = variance[10] = np.nan
+        matrix = DataMatrix(values, ['gene_{}'.format(i) for i in range(100)],
+                            ['condition_{}'.format(i) for i in range(6)])
+
+        filtered_matrix, kept_row_ids = filter_by_variance(matrix, top_n=20)
+        expected = sorted(np.argsort(-np.nan_to_num(variance, nan=-1))[:20])
+        self.assertEqual(kept_row_ids, ['gene_{}'.format(i) for i in expected])
+        self.assertEqual(filtered_matrix.row_ids.tolist(), kept_row_ids)
+
+        filtered_matrix, kept_row_ids = filter_by_variance(matrix, min_variance=100.)
+        self.assertEqual(len(kept_row_ids), np.sum(variance >= 100.))
+
+        filtered_matrix, kept_row_ids = filter_by_variance(matrix, top_n=5, min_variance=10.,
+                                                           measure='mad')
+        self.assertEqual(len(kept_row_ids), 5)
+
+        with self.assertRaisesRegex(ValueError, 'No matrix rows left'):
+            filter_by_variance(matrix, min_variance=1e12)
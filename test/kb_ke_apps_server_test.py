@@ -19,6 +19,7 @@ from biokbase.workspace.client import Workspace as workspaceService
 from kb_ke_apps.kb_ke_appsImpl import kb_ke_apps
 from kb_ke_apps.kb_ke_appsServer import MethodContext
 from kb_ke_apps.authclient import KBaseAuth as _KBaseAuth
+from kb_ke_apps.Utils.CacheUtil import ArtifactCache
 from GenomeFileUtil.GenomeFileUtilClient import GenomeFileUtil
 from DataFileUtil.DataFileUtilClient import DataFileUtil
 from GenericsAPI.GenericsAPIClient import GenericsAPI
@@ -210,6 +211,12 @@ class kb_ke_appsTest(unittest.TestCase):
         self.assertTrue('report_name' in ret)
         self.assertTrue('report_ref' in ret)
 
+        # row and column trees are attached as Newick files
+        report = self.wsClient.get_objects2({'objects': [{'ref': ret['report_ref']}]})
+        file_links = report['data'][0]['data']['file_links']
+        self.assertEqual([link['name'] for link in file_links],
+                         ['row_tree.nwk', 'column_tree.nwk'])
+
     def check_run_kmeans_cluster_output(self, ret):
         self.assertTrue('cluster_set_refs' in ret)
         self.assertTrue('report_name' in ret)
@@ -259,6 +266,107 @@ class kb_ke_appsTest(unittest.TestCase):
         error_msg = "INPUT ERROR:\nInput criterion [invalidate_criterion] is not valid.\n"
         self.fail_run_hierarchical_cluster(invalidate_params, error_msg, contains=True)
 
+        invalidate_params = {'matrix_ref': 'matrix_ref',
+                             'workspace_name': 'workspace_name',
+                             'cluster_set_name': 'cluster_set_name',
+                             'precision': 'float16'}
+        error_msg = "INPUT ERROR:\nInput precision [float16] is not valid.\n"
+        self.fail_run_hierarchical_cluster(invalidate_params, error_msg, contains=True)
+
+        invalidate_params = {'matrix_ref': 'matrix_ref',
+                             'workspace_name': 'workspace_name',
+                             'cluster_set_name': 'cluster_set_name',
+                             'invalid_data_action': 'ignore'}
+        error_msg = "INPUT ERROR:\nInput invalid data action [ignore] is not valid.\n"
+        self.fail_run_hierarchical_cluster(invalidate_params, error_msg, contains=True)
+
+        invalidate_params = {'matrix_ref': 'matrix_ref',
+                             'workspace_name': 'workspace_name',
+                             'cluster_set_name': 'cluster_set_name',
+                             'top_n_by_variance': 0}
+        error_msg = "INPUT ERROR:\nInput top_n_by_variance [0] is not valid.\n"
+        self.fail_run_hierarchical_cluster(invalidate_params, error_msg, contains=True)
+
+        invalidate_params = {'matrix_ref': 'matrix_ref',
+                             'workspace_name': 'workspace_name',
+                             'cluster_set_name': 'cluster_set_name',
+                             'variance_measure': 'range'}
+        error_msg = "INPUT ERROR:\nInput variance measure [range] is not valid.\n"
+        self.fail_run_hierarchical_cluster(invalidate_params, error_msg, contains=True)
+
+        invalidate_params = {'matrix_ref': 'matrix_ref',
+                             'workspace_name': 'workspace_name',
+                             'cluster_set_name': 'cluster_set_name',
+                             'n_jobs': 0}
+        error_msg = "INPUT ERROR:\nInput n_jobs [0] is not valid.\n"
+        self.fail_run_hierarchical_cluster(invalidate_params, error_msg, contains=True)
+
+        invalidate_params = {'matrix_ref': 'matrix_ref',
+                             'workspace_name': 'workspace_name',
+                             'cluster_set_name': 'cluster_set_name',
+                             'approximate': 1,
+                             'linkage_method': 'ward'}
+        error_msg = "INPUT ERROR:\nInput linkage algorithm [ward] is not valid "
+        error_msg += "for approximate mode.\n"
+        self.fail_run_hierarchical_cluster(invalidate_params, error_msg, contains=True)
+
+        invalidate_params = {'matrix_ref': 'matrix_ref',
+                             'workspace_name': 'workspace_name',
+                             'cluster_set_name': 'cluster_set_name',
+                             'approximate': 1,
+                             'dist_metric': 'cityblock'}
+        error_msg = "INPUT ERROR:\nInput metric function [cityblock] is not valid "
+        error_msg += "for approximate mode.\n"
+        self.fail_run_hierarchical_cluster(invalidate_params, error_msg, contains=True)
+
+        invalidate_params = {'matrix_ref': 'matrix_ref',
+                             'workspace_name': 'workspace_name',
+                             'cluster_set_name': 'cluster_set_name',
+                             'approximate': 1,
+                             'n_neighbors': -3}
+        error_msg = "INPUT ERROR:\nInput n_neighbors [-3] is not valid.\n"
+        self.fail_run_hierarchical_cluster(invalidate_params, error_msg, contains=True)
+
+        invalidate_params = {'matrix_ref': 'matrix_ref',
+                             'workspace_name': 'workspace_name',
+                             'cluster_set_name': 'cluster_set_name',
+                             'matrix_free': 1,
+                             'linkage_method': 'average'}
+        error_msg = "INPUT ERROR:\nInput linkage algorithm [average] is not valid "
+        error_msg += "for matrix-free mode.\n"
+        self.fail_run_hierarchical_cluster(invalidate_params, error_msg, contains=True)
+
+        invalidate_params = {'matrix_ref': 'matrix_ref',
+                             'workspace_name': 'workspace_name',
+                             'cluster_set_name': 'cluster_set_name',
+                             'matrix_free': 1,
+                             'dist_metric': 'cosine'}
+        error_msg = "INPUT ERROR:\nInput metric function [cosine] is not valid "
+        error_msg += "for matrix-free mode.\n"
+        self.fail_run_hierarchical_cluster(invalidate_params, error_msg, contains=True)
+
+        invalidate_params = {'matrix_ref': 'matrix_ref',
+                             'workspace_name': 'workspace_name',
+                             'cluster_set_name': 'cluster_set_name',
+                             'matrix_free': 1,
+                             'approximate': 1}
+        error_msg = "INPUT ERROR:\nInput matrix_free and approximate are exclusive.\n"
+        self.fail_run_hierarchical_cluster(invalidate_params, error_msg, contains=True)
+
+        invalidate_params = {'matrix_ref': 'matrix_ref',
+                             'workspace_name': 'workspace_name',
+                             'cluster_set_name': 'cluster_set_name',
+                             'row_dist_cutoff_rates': [0.2, 'high']}
+        error_msg = "INPUT ERROR:\nInput row_dist_cutoff_rates [[0.2, 'high']] is not valid.\n"
+        self.fail_run_hierarchical_cluster(invalidate_params, error_msg, contains=True)
+
+        invalidate_params = {'matrix_ref': 'matrix_ref',
+                             'workspace_name': 'workspace_name',
+                             'cluster_set_name': 'cluster_set_name',
+                             'col_maxclust': [2, 0]}
+        error_msg = "INPUT ERROR:\nInput col_maxclust [[2, 0]] is not valid.\n"
+        self.fail_run_hierarchical_cluster(invalidate_params, error_msg, contains=True)
+
     def test_bad_run_kmeans_cluster_params(self):
         self.start_test()
         invalidate_params = {'missing_matrix_ref': 'matrix_ref',
@@ -276,6 +384,46 @@ class kb_ke_appsTest(unittest.TestCase):
         error_msg = 'INPUT ERROR:\nInput metric function [invalidate_metric] is not valid.\n'
         self.fail_run_kmeans_cluster(invalidate_params, error_msg, contains=True)
 
+        invalidate_params = {'matrix_ref': 'matrix_ref',
+                             'workspace_name': 'workspace_name',
+                             'cluster_set_name': 'cluster_set_name',
+                             'k_num': 'k_num',
+                             'precision': 'float16'}
+        error_msg = "INPUT ERROR:\nInput precision [float16] is not valid.\n"
+        self.fail_run_kmeans_cluster(invalidate_params, error_msg, contains=True)
+
+        invalidate_params = {'matrix_ref': 'matrix_ref',
+                             'workspace_name': 'workspace_name',
+                             'cluster_set_name': 'cluster_set_name',
+                             'k_num': 'k_num',
+                             'invalid_data_action': 'ignore'}
+        error_msg = "INPUT ERROR:\nInput invalid data action [ignore] is not valid.\n"
+        self.fail_run_kmeans_cluster(invalidate_params, error_msg, contains=True)
+
+        invalidate_params = {'matrix_ref': 'matrix_ref',
+                             'workspace_name': 'workspace_name',
+                             'cluster_set_name': 'cluster_set_name',
+                             'k_num': 'k_num',
+                             'top_n_by_variance': 0}
+        error_msg = "INPUT ERROR:\nInput top_n_by_variance [0] is not valid.\n"
+        self.fail_run_kmeans_cluster(invalidate_params, error_msg, contains=True)
+
+        invalidate_params = {'matrix_ref': 'matrix_ref',
+                             'workspace_name': 'workspace_name',
+                             'cluster_set_name': 'cluster_set_name',
+                             'k_num': 'k_num',
+                             'variance_measure': 'range'}
+        error_msg = "INPUT ERROR:\nInput variance measure [range] is not valid.\n"
+        self.fail_run_kmeans_cluster(invalidate_params, error_msg, contains=True)
+
+        invalidate_params = {'matrix_ref': 'matrix_ref',
+                             'workspace_name': 'workspace_name',
+                             'cluster_set_name': 'cluster_set_name',
+                             'k_num': 'k_num',
+                             'n_jobs': 'all'}
+        error_msg = "INPUT ERROR:\nInput n_jobs [all] is not valid.\n"
+        self.fail_run_kmeans_cluster(invalidate_params, error_msg, contains=True)
+
     def test_run_hierarchical_cluster(self):
         self.start_test()
 
@@ -299,6 +447,144 @@ class kb_ke_appsTest(unittest.TestCase):
         ret = self.getImpl().run_hierarchical_cluster(self.ctx, params)[0]
         self.check_run_hierarchical_cluster_output(ret)
 
+        params = {'matrix_ref': self.matrix_obj_ref,
+                  'workspace_name': self.getWsName(),
+                  'cluster_set_name': 'test_hierarchical_cluster_float32',
+                  'dist_metric': 'euclidean',
+                  'linkage_method': 'single',
+                  'fcluster_criterion': 'distance',
+                  'precision': 'float32'}
+        ret = self.getImpl().run_hierarchical_cluster(self.ctx, params)[0]
+        self.check_run_hierarchical_cluster_output(ret)
+
+    def test_hierarchical_cluster_invalid_data(self):
+        self.start_test()
+
+        # gene_3 of the test expression matrix has no values
+        params = {'matrix_ref': self.expression_matrix_ref,
+                  'workspace_name': self.getWsName(),
+                  'cluster_set_name': 'test_hierarchical_cluster_invalid_data',
+                  'invalid_data_action': 'fail'}
+        error_msg = 'INPUT ERROR:\nMatrix contains invalid rows or columns.\n'
+        self.fail_run_hierarchical_cluster(params, error_msg, contains=True)
+
+        params['invalid_data_action'] = 'drop'
+        ret = self.getImpl().run_hierarchical_cluster(self.ctx, params)[0]
+        self.check_run_hierarchical_cluster_output(ret)
+
+    def test_hierarchical_cluster_collapse_duplicates(self):
+        self.start_test()
+
+        params = {'matrix_ref': self.matrix_obj_ref,
+                  'workspace_name': self.getWsName(),
+                  'cluster_set_name': 'test_hierarchical_cluster_collapse_duplicates',
+                  'dist_metric': 'euclidean',
+                  'linkage_method': 'single',
+                  'fcluster_criterion': 'distance',
+                  'collapse_duplicates': 1}
+        ret = self.getImpl().run_hierarchical_cluster(self.ctx, params)[0]
+        self.check_run_hierarchical_cluster_output(ret)
+
+    def test_hierarchical_cluster_top_n_by_variance(self):
+        self.start_test()
+
+        params = {'matrix_ref': self.matrix_obj_ref,
+                  'workspace_name': self.getWsName(),
+                  'cluster_set_name': 'test_hierarchical_cluster_top_n_by_variance',
+                  'dist_metric': 'euclidean',
+                  'linkage_method': 'single',
+                  'fcluster_criterion': 'distance',
+                  'top_n_by_variance': 5,
+                  'variance_measure': 'mad'}
+        ret = self.getImpl().run_hierarchical_cluster(self.ctx, params)[0]
+        self.check_run_hierarchical_cluster_output(ret)
+
+    def test_hierarchical_cluster_n_jobs(self):
+        self.start_test()
+
+        params = {'matrix_ref': self.matrix_obj_ref,
+                  'workspace_name': self.getWsName(),
+                  'cluster_set_name': 'test_hierarchical_cluster_n_jobs',
+                  'dist_metric': 'cityblock',
+                  'linkage_method': 'average',
+                  'fcluster_criterion': 'distance',
+                  'n_jobs': 2}
+        ret = self.getImpl().run_hierarchical_cluster(self.ctx, params)[0]
+        self.check_run_hierarchical_cluster_output(ret)
+
+    def test_hierarchical_cluster_approximate(self):
+        self.start_test()
+
+        params = {'matrix_ref': self.matrix_obj_ref,
+                  'workspace_name': self.getWsName(),
+                  'cluster_set_name': 'test_hierarchical_cluster_approximate',
+                  'dist_metric': 'euclidean',
+                  'linkage_method': 'average',
+                  'fcluster_criterion': 'distance',
+                  'approximate': 1,
+                  'n_neighbors': 2}
+        ret = self.getImpl().run_hierarchical_cluster(self.ctx, params)[0]
+        self.check_run_hierarchical_cluster_output(ret)
+
+    def test_hierarchical_cluster_matrix_free(self):
+        self.start_test()
+
+        params = {'matrix_ref': self.matrix_obj_ref,
+                  'workspace_name': self.getWsName(),
+                  'cluster_set_name': 'test_hierarchical_cluster_matrix_free',
+                  'dist_metric': 'euclidean',
+                  'linkage_method': 'centroid',
+                  'fcluster_criterion': 'distance',
+                  'matrix_free': 1}
+        ret = self.getImpl().run_hierarchical_cluster(self.ctx, params)[0]
+        self.check_run_hierarchical_cluster_output(ret)
+
+    def test_hierarchical_cluster_cutoff_sweep(self):
+        self.start_test()
+
+        params = {'matrix_ref': self.matrix_obj_ref,
+                  'workspace_name': self.getWsName(),
+                  'cluster_set_name': 'test_hierarchical_cluster_cutoff_sweep',
+                  'dist_metric': 'cityblock',
+                  'linkage_method': 'average',
+                  'fcluster_criterion': 'distance',
+                  'row_dist_cutoff_rates': [0.2, 0.5, 0.8],
+                  'col_maxclust': [2, 3]}
+        ret = self.getImpl().run_hierarchical_cluster(self.ctx, params)[0]
+        self.check_run_hierarchical_cluster_output(ret)
+
+        # one ClusterSet per threshold and axis, one report
+        self.assertEqual(len(ret['cluster_set_refs']), 5)
+        names = [info[1] for info in self.wsClient.get_object_info3(
+                    {'objects': [{'ref': ref} for ref in ret['cluster_set_refs']]})['infos']]
+        self.assertEqual(names, ['test_hierarchical_cluster_cutoff_sweep_row_cutoff_0.2',
+                                 'test_hierarchical_cluster_cutoff_sweep_row_cutoff_0.5',
+                                 'test_hierarchical_cluster_cutoff_sweep_row_cutoff_0.8',
+                                 'test_hierarchical_cluster_cutoff_sweep_column_maxclust_2',
+                                 'test_hierarchical_cluster_cutoff_sweep_column_maxclust_3'])
+
+    def test_hierarchical_cluster_artifact_cache(self):
+        self.start_test()
+
+        params = {'matrix_ref': self.matrix_obj_ref,
+                  'workspace_name': self.getWsName(),
+                  'cluster_set_name': 'test_hierarchical_cluster_artifact_cache',
+                  'dist_metric': 'cityblock',
+                  'linkage_method': 'complete',
+                  'row_dist_cutoff_rate': 0.5}
+        ret = self.getImpl().run_hierarchical_cluster(self.ctx, params)[0]
+        self.check_run_hierarchical_cluster_output(ret)
+
+        artifact_cache = ArtifactCache(os.path.join(self.scratch, 'artifact_cache'))
+        entries = len(artifact_cache._list_entries())
+        self.assertTrue(entries)
+
+        # new cutoff rate reuses the cached distances and linkage
+        params['row_dist_cutoff_rate'] = 0.8
+        ret = self.getImpl().run_hierarchical_cluster(self.ctx, params)[0]
+        self.check_run_hierarchical_cluster_output(ret)
+        self.assertEqual(len(artifact_cache._list_entries()), entries)
+
     def test_run_kmeans_cluster(self):
         self.start_test()
 
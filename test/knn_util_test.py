@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import unittest
+import inspect
+import shutil
+import tempfile
+
+import numpy as np
+from scipy.cluster.hierarchy import linkage, fcluster, is_valid_linkage
+import scipy.sparse as sp
+from scipy.spatial.distance import pdist, squareform
+
+from kb_ke_apps.Utils.MatrixUtil import DataMatrix, SparseDataMatrix
+from kb_ke_apps.Utils.ChunkedUtil import ChunkedMatrixWriter
+from kb_ke_apps.Utils.KnnUtil import (KNN_METRIC, dense_values, row_values, knn_graph,
+                                      knn_linkage)
+
+
+class KnnUtilTest(unittest.TestCase):
+
+    def setUp(self):
+        # well separated blobs, so exact single and average linkage agree on the clusters
+        random_state = np.random.RandomState(0)
+        centers = random_state.randn(6, 20) * 6
+        self.values = np.vstack([center + random_state.randn(150, 20) for center in centers])
+        self.n_clusters = len(centers)
+        self.store_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.store_root, ignore_errors=True)
+
+    def start_test(self):
+        testname = inspect.stack()[1][3]
+        print(('\n*** starting test: ' + testname + ' **'))
+
+    def exact_neighbors(self, metric, n_neighbors):
+        dist = squareform(pdist(self.values, metric=metric))
+        np.fill_diagonal(dist, np.inf)
+        return np.argsort(dist, axis=1)[:, :n_neighbors], dist
+
+    def assertSameClusters(self, first, second):
+        # same partition up to the cluster labels
+        self.assertEqual(len(set(zip(first, second))), len(set(first)))
+        self.assertEqual(len(set(first)), len(set(second)))
+
+    def test_knn_graph_recall(self):
+        self.start_test()
+        n_neighbors = 10
+
+        for metric in KNN_METRIC:
+            knn_idx, knn_dist = knn_graph(self.values, metric=metric, n_neighbors=n_neighbors,
+                                          random_state=0)
+            exact_idx, exact_dist = self.exact_neighbors(metric, n_neighbors)
+
+            self.assertEqual(knn_idx.shape, (self.values.shape[0], n_neighbors))
+            recall = np.mean([len(set(found) & set(exact)) / float(n_neighbors)
+                              for found, exact in zip(knn_idx, exact_idx)])
+            self.assertGreaterEqual(recall, 0.9, msg=metric)
+
+            # reported distances are the metric distances, closest first
+            np.testing.assert_allclose(knn_dist,
+                                       np.take_along_axis(exact_dist, knn_idx, axis=1),
+                                       atol=1e-8)
+            self.assertTrue(np.all(np.diff(knn_dist, axis=1) >= 0))
+            self.assertFalse(np.any(knn_idx == np.arange(len(knn_idx))[:, None]))
+
+    def test_knn_graph_few_rows(self):
+        self.start_test()
+        knn_idx, knn_dist = knn_graph(self.values[:4], n_neighbors=10)
+
+        # every other row is a neighbor
+        self.assertEqual(knn_idx.shape, (4, 3))
+        for row, neighbors in enumerate(knn_idx):
+            self.assertEqual(sorted(neighbors), [other for other in range(4) if other != row])
+
+        with self.assertRaises(ValueError):
+            knn_graph(self.values, metric='cityblock')
+
+    def test_knn_linkage(self):
+        self.start_test()
+
+        for metric in ['euclidean', 'cosine']:
+            knn_idx, knn_dist = knn_graph(self.values, metric=metric, n_neighbors=10,
+                                          random_state=0)
+            for method in ['single', 'average']:
+                linkage_matrix = knn_linkage(self.values, knn_idx, knn_dist, metric=metric,
+                                             method=method)
+
+                self.assertTrue(is_valid_linkage(linkage_matrix))
+                self.assertEqual(linkage_matrix.shape, (self.values.shape[0] - 1, 4))
+                self.assertTrue(np.all(np.diff(linkage_matrix[:, 2]) >= -1e-12))
+
+                approximate = fcluster(linkage_matrix, self.n_clusters, 'maxclust')
+                exact = fcluster(linkage(pdist(self.values, metric=metric), method=method),
+                                 self.n_clusters, 'maxclust')
+                self.assertSameClusters(approximate, exact)
+
+        with self.assertRaises(ValueError):
+            knn_linkage(self.values, knn_idx, knn_dist, method='ward')
+
+    def test_knn_linkage_connected_graph(self):
+        self.start_test()
+        # a single blob gives a connected graph, single linkage heights match the exact ones
+        values = self.values[:150]
+        knn_idx, knn_dist = knn_graph(values, n_neighbors=15, random_state=0)
+        linkage_matrix = knn_linkage(values, knn_idx, knn_dist, method='single')
+        exact = linkage(pdist(values), method='single')
+
+        self.assertTrue(is_valid_linkage(linkage_matrix))
+        np.testing.assert_allclose(np.sort(linkage_matrix[:, 2]), np.sort(exact[:, 2]))
+
+    def test_dense_values(self):
+        self.start_test()
+        values = np.array([[0., 1.], [2., 0.]])
+        matrix = DataMatrix(values, ['gene_1', 'gene_2'], ['condition_1', 'condition_2'])
+        sparse_matrix = SparseDataMatrix(values, ['gene_1', 'gene_2'],
+                                         ['condition_1', 'condition_2'])
+
+        np.testing.assert_array_equal(dense_values(matrix), values)
+        np.testing.assert_array_equal(dense_values(sparse_matrix), values)
+
+    def test_knn_sparse_and_chunked_rows(self):
+        self.start_test()
+        # mostly zero rows; disconnected blobs make knn_linkage join components
+        values = self.values * (np.abs(self.values) > 4)
+        row_ids = ['gene_{}'.format(i) for i in range(values.shape[0])]
+        col_ids = ['condition_{}'.format(i) for i in range(values.shape[1])]
+        writer = ChunkedMatrixWriter(self.store_root + '/store', row_ids, col_ids,
+                                     block_bytes=values.shape[0] * 8 * 3)
+        writer.write_rows(values)
+        sources = [row_values(SparseDataMatrix(values, row_ids, col_ids)),
+                   row_values(writer.close())]
+        self.assertTrue(sp.issparse(sources[0]))
+
+        for metric in ['euclidean', 'correlation']:
+            knn_idx, knn_dist = knn_graph(values, metric=metric, n_neighbors=5,
+                                          random_state=0)
+            expected = knn_linkage(values, knn_idx, knn_dist, metric=metric,
+                                   method='average')
+            for source in sources:
+                source_idx, source_dist = knn_graph(source, metric=metric, n_neighbors=5,
+                                                    random_state=0)
+                np.testing.assert_array_equal(source_idx, knn_idx)
+                np.testing.assert_allclose(source_dist, knn_dist, atol=1e-10)
+                np.testing.assert_allclose(knn_linkage(source, knn_idx, knn_dist,
+                                                       metric=metric, method='average'),
+                                           expected, atol=1e-10)
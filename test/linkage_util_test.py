@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+import unittest
+import inspect
+import io
+import os
+import shutil
+import sys
+import tempfile
+from unittest import mock
+
+import numpy as np
+from scipy.cluster.hierarchy import linkage, fcluster, is_valid_linkage, to_tree
+from scipy.spatial.distance import pdist
+
+from kb_ke_apps.Utils import LinkageUtil
+from kb_ke_apps.Utils.NanUtil import nan_pdist
+from kb_ke_apps.Utils.DistanceUtil import open_condensed
+from kb_ke_apps.Utils.LinkageUtil import (NN_CHAIN_METHOD, CENTROID_METHOD, kruskal_merges,
+                                          mst_single_linkage, nn_chain_linkage,
+                                          centroid_linkage, tree_depth, write_newick)
+
+
+class LinkageUtilTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.values = random_state.randn(120, 7)
+
+    def start_test(self):
+        testname = inspect.stack()[1][3]
+        print(('\n*** starting test: ' + testname + ' **'))
+
+    def test_mst_single_linkage(self):
+        self.start_test()
+        for metric in ['euclidean', 'sqeuclidean', 'cosine', 'correlation', 'cityblock',
+                       'chebyshev', 'canberra']:
+            linkage_matrix = mst_single_linkage(self.values, metric=metric)
+            expected = linkage(pdist(self.values, metric=metric), method='single')
+
+            self.assertTrue(is_valid_linkage(linkage_matrix))
+            np.testing.assert_array_equal(linkage_matrix[:, [0, 1, 3]], expected[:, [0, 1, 3]],
+                                          err_msg=metric)
+            np.testing.assert_allclose(linkage_matrix[:, 2], expected[:, 2], atol=1e-12)
+            np.testing.assert_array_equal(fcluster(linkage_matrix, 5, 'maxclust'),
+                                          fcluster(expected, 5, 'maxclust'))
+
+    def test_mst_single_linkage_missing_values(self):
+        self.start_test()
+        values = self.values.copy()
+        values[np.random.RandomState(1).rand(*values.shape) < 0.1] = np.nan
+
+        linkage_matrix = mst_single_linkage(values, metric='euclidean')
+        expected = linkage(nan_pdist(values, metric='euclidean'), method='single')
+        np.testing.assert_allclose(linkage_matrix[:, 2], expected[:, 2], atol=1e-12)
+
+    def test_mst_single_linkage_small(self):
+        self.start_test()
+        self.assertEqual(mst_single_linkage(self.values[:1]).shape, (0, 4))
+        np.testing.assert_allclose(mst_single_linkage(self.values[:2]),
+                                   linkage(pdist(self.values[:2]), method='single'))
+
+        # zero rows have no cosine distance
+        values = self.values[:5].copy()
+        values[2] = 0
+        with self.assertRaises(ValueError):
+            mst_single_linkage(values, metric='cosine')
+
+    def test_kruskal_merges(self):
+        self.start_test()
+        # path 0 - 1 - 2 and a separate edge 3 - 4
+        merges, sets = kruskal_merges(np.array([0, 1, 3]), np.array([1, 2, 4]),
+                                      np.array([2., 1., 3.]), 5)
+
+        self.assertEqual(merges, [[1, 2, 1., 2], [0, 5, 2., 3], [3, 4, 3., 2]])
+        self.assertEqual(len(set([sets.find(row) for row in range(5)])), 2)
+
+    def test_nn_chain_linkage(self):
+        self.start_test()
+        for method in NN_CHAIN_METHOD:
+            dist_matrix = pdist(self.values)
+            expected = linkage(dist_matrix, method=method)
+            linkage_matrix = nn_chain_linkage(dist_matrix.copy(), method=method)
+
+            self.assertTrue(is_valid_linkage(linkage_matrix))
+            np.testing.assert_array_equal(linkage_matrix[:, [0, 1, 3]], expected[:, [0, 1, 3]],
+                                          err_msg=method)
+            np.testing.assert_allclose(linkage_matrix[:, 2], expected[:, 2], atol=1e-12)
+
+        # float32 buffers stay float32, the updates are widened to float64
+        dist_matrix = pdist(self.values).astype(np.float32)
+        linkage_matrix = nn_chain_linkage(dist_matrix, method='average')
+        np.testing.assert_allclose(linkage_matrix[:, 2],
+                                   linkage(pdist(self.values), method='average')[:, 2],
+                                   rtol=1e-5)
+
+        with self.assertRaises(ValueError):
+            nn_chain_linkage(pdist(self.values), method='centroid')
+
+        dist_matrix = pdist(self.values)
+        dist_matrix[3] = np.nan
+        with self.assertRaises(ValueError):
+            nn_chain_linkage(dist_matrix, method='complete')
+
+    def test_nn_chain_linkage_in_place(self):
+        self.start_test()
+        scratch = tempfile.mkdtemp()
+        try:
+            dist_file = os.path.join(scratch, 'dist_matrix.npy')
+            dist_matrix = open_condensed(dist_file, self.values.shape[0])
+            dist_matrix[:] = pdist(self.values)
+            dist_matrix.flush()
+            expected = linkage(pdist(self.values), method='ward')
+
+            # writable buffers are updated in place, no copy
+            buffer = dist_matrix.copy()
+            np.testing.assert_allclose(nn_chain_linkage(buffer, method='ward'), expected)
+            self.assertFalse(np.allclose(buffer, pdist(self.values)))
+
+            # read-only memory maps run on a scratch copy, the file is left intact
+            copy_dir = os.path.join(scratch, 'copy')
+            os.mkdir(copy_dir)
+            read_only = np.load(dist_file, mmap_mode='r')
+            np.testing.assert_allclose(nn_chain_linkage(read_only, method='ward',
+                                                        scratch_dir=copy_dir), expected)
+            np.testing.assert_array_equal(np.load(dist_file), pdist(self.values))
+            self.assertEqual(os.listdir(copy_dir), [])
+        finally:
+            shutil.rmtree(scratch)
+
+    def test_centroid_linkage(self):
+        self.start_test()
+        for method in CENTROID_METHOD:
+            expected = linkage(self.values, method=method)
+            linkage_matrix = centroid_linkage(self.values, method=method)
+
+            self.assertTrue(is_valid_linkage(linkage_matrix))
+            np.testing.assert_array_equal(linkage_matrix[:, [0, 1, 3]], expected[:, [0, 1, 3]],
+                                          err_msg=method)
+            np.testing.assert_allclose(linkage_matrix[:, 2], expected[:, 2], atol=1e-12)
+
+        # input values are left untouched
+        values = self.values.astype(np.float32)
+        centroid_linkage(values, method='ward')
+        np.testing.assert_array_equal(values, self.values.astype(np.float32))
+
+        with self.assertRaises(ValueError):
+            centroid_linkage(self.values, method='average')
+
+        values = self.values.copy()
+        values[3, 2] = np.nan
+        with self.assertRaises(ValueError):
+            centroid_linkage(values, method='ward')
+
+    def test_centroid_linkage_duplicate_rows(self):
+        self.start_test()
+        # duplicate rows merge at height 0, whichever copy the k-d tree reports first
+        values = np.vstack([self.values[:30], self.values[:10], self.values[5:15]])
+        for method in CENTROID_METHOD:
+            linkage_matrix = centroid_linkage(values, method=method)
+            expected = linkage(values, method=method)
+
+            self.assertTrue(is_valid_linkage(linkage_matrix))
+            self.assertEqual(np.sum(linkage_matrix[:, 2] == 0), 20)
+            np.testing.assert_array_equal(fcluster(linkage_matrix, 8, 'maxclust'),
+                                          fcluster(expected, 8, 'maxclust'), err_msg=method)
+            np.testing.assert_allclose(np.sort(linkage_matrix[:, 2]), np.sort(expected[:, 2]),
+                                       atol=1e-12)
+
+    def test_centroid_linkage_tree_search(self):
+        self.start_test()
+        # nearest cluster searches on the centroid k-d tree, rebuilt every few merges
+        random_state = np.random.RandomState(1)
+        values = np.vstack([random_state.randn(400, 3), self.values[:40, :3]])
+        values = np.vstack([values, values[:25]])
+        with mock.patch.object(LinkageUtil, 'TREE_MIN_ROWS', 0), \
+                mock.patch.object(LinkageUtil, 'TREE_MIN_REBUILD', 4):
+            for method in CENTROID_METHOD:
+                linkage_matrix = centroid_linkage(values, method=method)
+                expected = linkage(values, method=method)
+
+                self.assertTrue(is_valid_linkage(linkage_matrix))
+                np.testing.assert_array_equal(fcluster(linkage_matrix, 12, 'maxclust'),
+                                              fcluster(expected, 12, 'maxclust'),
+                                              err_msg=method)
+                np.testing.assert_allclose(np.sort(linkage_matrix[:, 2]),
+                                           np.sort(expected[:, 2]), atol=1e-12)
+
+    def recursive_newick(self, linkage_matrix, labels):
+        # reference: recursive walk of the scipy tree
+        def newick(node, parent_height):
+            length = '' if parent_height is None else ':{:.10g}'.format(parent_height -
+                                                                         node.dist)
+            if node.is_leaf():
+                return labels[node.id] + length
+            return '({},{}){}'.format(newick(node.get_left(), node.dist),
+                                      newick(node.get_right(), node.dist), length)
+        return newick(to_tree(linkage_matrix), None) + ';\n'
+
+    def test_write_newick(self):
+        self.start_test()
+        labels = ['gene_{}'.format(i) for i in range(self.values.shape[0])]
+        for method in ['single', 'average', 'centroid']:
+            linkage_matrix = linkage(self.values, method=method)
+            newick = io.StringIO()
+            write_newick(linkage_matrix, labels, newick)
+            self.assertEqual(newick.getvalue(), self.recursive_newick(linkage_matrix, labels))
+
+        # special characters are quoted
+        newick = io.StringIO()
+        write_newick(np.array([[0, 1, 0.5, 2]]), ["gene 1", "gene's:2"], newick)
+        self.assertEqual(newick.getvalue(), "('gene 1':0.5,'gene''s:2':0.5);\n")
+
+        newick = io.StringIO()
+        write_newick(np.empty((0, 4)), ['gene_1'], newick)
+        self.assertEqual(newick.getvalue(), 'gene_1;\n')
+
+        with self.assertRaises(ValueError):
+            write_newick(linkage(self.values), labels[1:], io.StringIO())
+
+    def test_write_newick_deep_tree(self):
+        self.start_test()
+        # a chain of merges deeper than the recursion limit
+        n_leaves = sys.getrecursionlimit() * 3
+        linkage_matrix = np.array([[0 if merge == 0 else n_leaves + merge - 1, merge + 1,
+                                    merge + 1, merge + 2] for merge in range(n_leaves - 1)],
+                                  dtype=np.float64)
+        self.assertTrue(is_valid_linkage(linkage_matrix))
+        self.assertEqual(tree_depth(linkage_matrix), n_leaves - 1)
+        self.assertEqual(tree_depth(linkage(self.values[:2])), 1)
+
+        newick = io.StringIO()
+        write_newick(linkage_matrix, [str(leaf) for leaf in range(n_leaves)], newick)
+        tree = newick.getvalue()
+        self.assertTrue(tree.startswith('(' * (n_leaves - 1) + '0:1,1:1):1,2:2)'))
+        self.assertTrue(tree.endswith(',{}:{});\n'.format(n_leaves - 1, n_leaves - 1)))
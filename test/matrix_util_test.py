@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import unittest
+import inspect
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+
+from kb_ke_apps.Utils.MatrixUtil import DataMatrix, DataMatrixParser
+
+
+class MatrixUtilTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.df = pd.DataFrame([[0.1, 0.2, 0.3, 0.4],
+                               [0.3, 0.4, 0.5, 0.6],
+                               [None, None, None, None]],
+                              index=['gene_1', 'gene_2', 'gene_3'],
+                              columns=['condition_1', 'condition_2',
+                                       'condition_3', 'condition_4'])
+        cls.data_matrix = cls.df.to_json()
+
+    def start_test(self):
+        testname = inspect.stack()[1][3]
+        print(('\n*** starting test: ' + testname + ' **'))
+
+    def test_from_json(self):
+        self.start_test()
+        matrix = DataMatrix.from_json(self.data_matrix)
+
+        self.assertEqual(matrix.shape, (3, 4))
+        self.assertEqual(matrix.values.dtype, np.float64)
+        self.assertEqual(matrix.row_ids.tolist(), ['gene_1', 'gene_2', 'gene_3'])
+        self.assertEqual(matrix.row_index['gene_2'], 1)
+        self.assertEqual(matrix.col_index['condition_4'], 3)
+        self.assertTrue(np.isnan(matrix.values[2]).all())
+
+    def test_transpose_is_view(self):
+        self.start_test()
+        matrix = DataMatrix.from_json(self.data_matrix)
+        transpose_matrix = matrix.T
+
+        self.assertEqual(transpose_matrix.shape, (4, 3))
+        self.assertTrue(np.shares_memory(matrix.values, transpose_matrix.values))
+        self.assertIs(transpose_matrix.row_index, matrix.col_index)
+        self.assertEqual(transpose_matrix.row_ids.tolist(), matrix.col_ids.tolist())
+
+    def test_to_json_round_trip(self):
+        self.start_test()
+        matrix = DataMatrix.from_json(self.data_matrix)
+        df = pd.read_json(StringIO(matrix.T.to_json()))
+
+        self.assertEqual(df.index.tolist(), self.df.columns.tolist())
+        np.testing.assert_allclose(df.values, self.df.T.values.astype(float))
+
+    def test_from_matrix_data(self):
+        self.start_test()
+        matrix = DataMatrix.from_matrix_data({'row_ids': self.df.index.tolist(),
+                                              'col_ids': self.df.columns.tolist(),
+                                              'values': [[0.1, 0.2, 0.3, 0.4],
+                                                         [0.3, 0.4, 0.5, 0.6],
+                                                         [None, None, None, None]]})
+
+        self.assertEqual(matrix.shape, (3, 4))
+        np.testing.assert_allclose(matrix.values, DataMatrix.from_json(self.data_matrix).values)
+
+    def test_parse_data_matrix_in_chunks(self):
+        self.start_test()
+        np.random.seed(0)
+        values = np.random.randn(50, 7)
+        values[values > 1.5] = np.nan
+        df = pd.DataFrame(values,
+                          index=['gene_{}'.format(i) for i in range(50)],
+                          columns=['condition "{}"'.format(i) for i in range(7)])
+        data_matrix = df.to_json(double_precision=15)
+
+        for chunk_size in [7, 64, DataMatrixParser.CHUNK_SIZE]:
+            matrix = DataMatrixParser(StringIO(data_matrix), chunk_size=chunk_size).parse()
+
+            self.assertEqual(matrix.row_ids.tolist(), df.index.tolist())
+            self.assertEqual(matrix.col_ids.tolist(), df.columns.tolist())
+            np.testing.assert_allclose(matrix.values, values, rtol=1e-12)
+
+    def test_parse_data_matrix_ragged_rows(self):
+        self.start_test()
+        data_matrix = '{"c1": {"r1": 1, "r2": null}, "c2": {"r2": 2.5e1, "r3": -3}, "c3": {}}'
+        matrix = DataMatrix.from_json(data_matrix)
+
+        self.assertEqual(matrix.row_ids.tolist(), ['r1', 'r2', 'r3'])
+        np.testing.assert_array_equal(matrix.values, [[1, np.nan, np.nan],
+                                                      [np.nan, 25, np.nan],
+                                                      [np.nan, -3, np.nan]])
+
+    def test_parse_bad_data_matrix(self):
+        self.start_test()
+        with self.assertRaisesRegex(ValueError, 'Invalid data_matrix json'):
+            DataMatrix.from_json('{"c1": {"r1": "a"}}')
+
+    def test_astype(self):
+        self.start_test()
+        matrix = DataMatrix.from_json(self.data_matrix)
+        single_matrix = matrix.astype('float32')
+
+        self.assertEqual(single_matrix.values.dtype, np.float32)
+        self.assertEqual(single_matrix.T.values.dtype, np.float32)
+        self.assertIs(single_matrix.row_index, matrix.row_index)
+        np.testing.assert_allclose(single_matrix.values, matrix.values, rtol=1e-7)
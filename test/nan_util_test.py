@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import unittest
+import inspect
+
+import numpy as np
+from scipy.spatial.distance import pdist
+
+from kb_ke_apps.Utils.MatrixUtil import DataMatrix
+from kb_ke_apps.Utils.DistanceUtil import calc_dist_matrix
+from kb_ke_apps.Utils.NanUtil import NAN_METRIC, has_nan, nan_pdist, nan_pca
+
+
+class NanUtilTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self.values = random_state.randn(40, 9) + 2
+        self.missing = self.values.copy()
+        self.missing[random_state.rand(*self.values.shape) < 0.25] = np.nan
+
+    def start_test(self):
+        testname = inspect.stack()[1][3]
+        print(('\n*** starting test: ' + testname + ' **'))
+
+    def pairwise_complete(self, values, metric):
+        # reference: every pair on the columns valid in both rows, sums rescaled
+        dist = []
+        n_features = values.shape[1]
+        for i in range(values.shape[0]):
+            for j in range(i + 1, values.shape[0]):
+                valid = ~np.isnan(values[i]) & ~np.isnan(values[j])
+                if not valid.any():
+                    dist.append(np.nan)
+                    continue
+                pair = pdist([values[i][valid], values[j][valid]], metric=metric)[0]
+                if metric in ['euclidean']:
+                    pair *= np.sqrt(float(n_features) / valid.sum())
+                elif metric in ['sqeuclidean', 'cityblock']:
+                    pair *= float(n_features) / valid.sum()
+                dist.append(pair)
+        return np.array(dist)
+
+    def test_nan_pdist_complete_rows(self):
+        self.start_test()
+        for metric in NAN_METRIC:
+            np.testing.assert_allclose(nan_pdist(self.values, metric=metric, block_rows=7),
+                                       pdist(self.values, metric=metric), atol=1e-12,
+                                       err_msg=metric)
+
+    def test_nan_pdist(self):
+        self.start_test()
+        for metric in NAN_METRIC:
+            dist = nan_pdist(self.missing, metric=metric, block_rows=7)
+            np.testing.assert_allclose(dist, self.pairwise_complete(self.missing, metric),
+                                       atol=1e-12, err_msg=metric)
+
+        # rows without a common valid column have no distance
+        values = np.array([[1., np.nan], [np.nan, 2.], [3., 4.]])
+        dist = nan_pdist(values, metric='euclidean')
+        self.assertTrue(np.isnan(dist[0]))
+        self.assertTrue(np.all(np.isfinite(dist[1:])))
+
+        with self.assertRaises(ValueError):
+            nan_pdist(self.missing, metric='chebyshev')
+
+    def test_nan_pdist_rows(self):
+        self.start_test()
+        n = self.missing.shape[0]
+        out = np.full(n * (n - 1) // 2, -1.)
+        nan_pdist(self.missing, metric='correlation', block_rows=4, out=out, rows=(0, 10))
+        nan_pdist(self.missing, metric='correlation', block_rows=4, out=out, rows=(10, n - 1))
+
+        np.testing.assert_allclose(out, nan_pdist(self.missing, metric='correlation'))
+
+    def test_calc_dist_matrix_missing_values(self):
+        self.start_test()
+        matrix = DataMatrix(self.missing, ['gene_{}'.format(i) for i in range(40)],
+                            ['condition_{}'.format(i) for i in range(9)])
+
+        dist = calc_dist_matrix(matrix, metric='euclidean')
+        np.testing.assert_allclose(dist, self.pairwise_complete(self.missing, 'euclidean'))
+
+    def test_has_nan(self):
+        self.start_test()
+        self.assertFalse(has_nan(self.values))
+        self.assertTrue(has_nan(self.missing))
+        self.assertTrue(has_nan(self.missing, block_rows=3))
+        self.assertFalse(has_nan(np.arange(6).reshape(2, 3)))
+
+    def test_nan_pca(self):
+        self.start_test()
+        # complete rows: same scores as an SVD of the centered matrix (up to sign)
+        scores = nan_pca(self.values, n_components=2, block_rows=7)
+        centered = self.values - self.values.mean(axis=0)
+        u, s, _ = np.linalg.svd(centered, full_matrices=False)
+        np.testing.assert_allclose(np.abs(scores), np.abs(u[:, :2] * s[:2]), atol=1e-10)
+
+        scores = nan_pca(self.missing, n_components=3)
+        self.assertEqual(scores.shape, (40, 3))
+        self.assertTrue(np.all(np.isfinite(scores)))
+        np.testing.assert_allclose(nan_pca(self.missing, n_components=3, block_rows=6), scores)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import unittest
+import inspect
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.spatial.distance import pdist
+
+from kb_ke_apps.Utils.MatrixUtil import SparseDataMatrix
+from kb_ke_apps.Utils.SparseUtil import SPARSE_METRIC, sparse_pdist, sparse_pca
+
+
+class SparseUtilTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        np.random.seed(0)
+        values = np.random.rand(40, 30)
+        values[values < 0.85] = 0
+        values[3] = 0  # all zero row
+        cls.values = values
+        cls.csr = sp.csr_matrix(values)
+
+    def start_test(self):
+        testname = inspect.stack()[1][3]
+        print(('\n*** starting test: ' + testname + ' **'))
+
+    def test_from_matrix_data(self):
+        self.start_test()
+        data = {'row_ids': ['gene_{}'.format(i) for i in range(3)],
+                'col_ids': ['condition_{}'.format(i) for i in range(4)],
+                'values': [[0, 0, 1.5, 0], [0, 0, 0, 0], [2, 0, 0, 0]]}
+
+        self.assertEqual(SparseDataMatrix.zero_fraction(data), 10 / 12.)
+        self.assertFalse(SparseDataMatrix.has_missing(data))
+
+        matrix = SparseDataMatrix.from_matrix_data(data)
+        self.assertEqual(matrix.values.nnz, 2)
+        np.testing.assert_array_equal(matrix.values.toarray(),
+                                      [[0, 0, 1.5, 0], [0, 0, 0, 0], [2, 0, 0, 0]])
+        self.assertEqual(matrix.T.shape, (4, 3))
+        self.assertEqual(matrix.T.row_index['condition_2'], 2)
+
+    def test_missing_values(self):
+        self.start_test()
+        # missing values are not zeros, they keep the matrix dense
+        data = {'row_ids': ['gene_{}'.format(i) for i in range(3)],
+                'col_ids': ['condition_{}'.format(i) for i in range(3)],
+                'values': [[0, None, 0], [0, 0, 0], [0, 0, 1]]}
+
+        self.assertEqual(SparseDataMatrix.zero_fraction(data), 7 / 9.)
+        self.assertTrue(SparseDataMatrix.has_missing(data))
+        with self.assertRaisesRegex(ValueError, 'missing'):
+            SparseDataMatrix.from_matrix_data(data)
+
+    def test_sparse_pdist_near_duplicates(self):
+        self.start_test()
+        # large norms and tiny differences: the Gram expansion alone cancels to 0
+        values = np.zeros((6, 50))
+        values[:, :10] = 1e4
+        values[np.arange(6), 10 + np.arange(6)] = [1e-3, 2e-3, 0, 1e-4, 5e-4, 0]
+        expected = pdist(values)
+
+        dist_matrix = sparse_pdist(sp.csr_matrix(values), metric='euclidean', block_rows=4)
+        np.testing.assert_allclose(dist_matrix, expected, rtol=1e-9)
+
+    def test_sparse_pdist(self):
+        self.start_test()
+        for metric in SPARSE_METRIC:
+            expected = pdist(self.values != 0 if metric == 'jaccard' else self.values,
+                             metric=metric)
+            for block_rows in [7, 256]:
+                dist_matrix = sparse_pdist(self.csr, metric=metric, block_rows=block_rows)
+                valid = np.isfinite(expected)
+                np.testing.assert_allclose(dist_matrix[valid], expected[valid], atol=1e-10)
+
+    def test_sparse_pdist_bad_metric(self):
+        self.start_test()
+        with self.assertRaisesRegex(ValueError, 'not supported'):
+            sparse_pdist(self.csr, metric='chebyshev')
+        with self.assertRaisesRegex(ValueError, 'non-negative'):
+            sparse_pdist(-self.csr, metric='braycurtis')
+
+    def test_sparse_pca(self):
+        self.start_test()
+        centered = self.values - self.values.mean(axis=0)
+        u, s, _ = np.linalg.svd(centered, full_matrices=False)
+        expected = u[:, :3] * s[:3]
+
+        scores = sparse_pca(self.csr, n_components=3)
+
+        self.assertEqual(scores.shape, (40, 3))
+        # principal components are defined up to sign
+        np.testing.assert_allclose(np.abs(scores), np.abs(expected), atol=1e-8)